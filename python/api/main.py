@@ -1,27 +1,36 @@
-import copy
+import os
 import uvicorn
 from fastapi import FastAPI, Depends, Query, Response, Header
 from fastapi_utils.tasks import repeat_every
 from typing import Optional
 from datetime import datetime
 
-from api.services.glad import update_layers, get_meta, filter_dates
+from api.services.glad import update_layers, get_meta, get_tiles, LayersIndex
 from api.services.keycloak import TokenVerifier
 from api.services.cookie import SessionIDCookieMiddleware
-from api.services.util import generate_etag
+from api.services.util import PreparedResponse, parse_bbox
 
 
 app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
-app.state.layers_cache = {}
+app.state.layers_cache = None
+app.state.meta = PreparedResponse(get_meta())
 
 # SessionID Cookie 
 app.add_middleware(SessionIDCookieMiddleware)
 
 # Tasks
+# Layers are refreshed from the manifest index, a conditional read when nothing changed
 @app.on_event("startup")
-@repeat_every(seconds=86400)
+@repeat_every(seconds=int(os.environ.get('LAYERS_REFRESH_SECONDS', 300)))
 def task_update_tiles() -> None:
-  app.state.layers_cache = update_layers()
+  app.state.layers_cache = update_layers(app.state.layers_cache)
+
+# Meta (attributions and the tile grid) doesn't depend on the layers. It is serialized and compressed at startup and
+# then re-prepared once a day, not on every layers refresh
+@app.on_event("startup")
+@repeat_every(seconds=86400, wait_first=86400)
+def task_update_meta() -> None:
+  app.state.meta = PreparedResponse(get_meta())
 
 # Routes
 @app.head("/")
@@ -30,23 +39,37 @@ def head_root():
 
 @app.get("/")
 def get_root(_: dict = Depends(TokenVerifier(roles=['access'])), 
-             response: Response = None,
+             bbox: Optional[str] = Query(None),
+             simplify: Optional[float] = Query(None, gt=0),
+             accept_encoding: str | None = Header(default=None),
              if_none_match: str | None = Header(default=None)):
-  meta = get_meta()
-  # Cloudflare tunnel requires string ETag
-  response.headers["ETag"] = f'"{generate_etag(meta)}"'
-  
-  if if_none_match in [response.headers["ETag"], f'W/{response.headers["ETag"]}']:
-    return Response(status_code=304)
-  else:
-    return meta
+  # Tiles in a viewport, the whole grid is prepared
+  if bbox is not None or simplify is not None:
+    return get_meta(bbox=parse_bbox(bbox), simplify=simplify)
+
+  return app.state.meta.response(accept_encoding=accept_encoding, if_none_match=if_none_match)
 
 @app.get("/layers")
 def get_geojson(_: dict = Depends(TokenVerifier(roles=['access'])), 
-                date: Optional[datetime] = Query(None)):
-  layers = copy.deepcopy(app.state.layers_cache)
-  layers = filter_dates(layers, date=date)
-  return layers
+                date: Optional[datetime] = Query(None),
+                bbox: Optional[str] = Query(None)):
+  layers = app.state.layers_cache or LayersIndex([])
+  tile_ids = None
+  if bbox is not None:
+    tile_ids = set(get_tiles(bbox=parse_bbox(bbox), tile_ids=layers.index.keys()))
+
+  # Serialized responses are memoized by the index
+  return Response(content=layers.to_json(date=date, tile_ids=tile_ids), media_type='application/json')
+
+@app.get("/tiles")
+def get_tile_ids(_: dict = Depends(TokenVerifier(roles=['access'])),
+                 bbox: Optional[str] = Query(None),
+                 lon: Optional[float] = Query(None, ge=-180, le=180),
+                 lat: Optional[float] = Query(None, ge=-90, le=90),
+                 processed: bool = Query(False)):
+  point = (lon, lat) if lon is not None and lat is not None else None
+  tile_ids = set((app.state.layers_cache or LayersIndex([])).index.keys()) if processed else None
+  return {'tiles': get_tiles(bbox=parse_bbox(bbox), point=point, tile_ids=tile_ids)}
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=4000, reload=True)
\ No newline at end of file
@@ -1,6 +1,10 @@
+import json
+from bisect import bisect_left, bisect_right
 from datetime import datetime
+from functools import lru_cache
 
 from lib.glad import GLAD
+from lib.xyz import TREECOVER_RAMP, RGBA_GAMMA
 
 
 glad = GLAD()
@@ -11,12 +15,26 @@ Landsat analysis ready data for global land cover and land cover change mapping.
 Remote Sens. 2020, 12, 426; doi:10.3390/rs12030426
 '''
 base_url = glad.get_image_base_url()
+xyz_source = glad.get_xyz_source()
 
 
-def update_layers():
+def update_layers(previous: 'LayersIndex' = None):
+  '''
+    Update the layers from the manifest index. Only the tiles which changed since the `previous` layers are listed,
+    and `previous` is returned as is if the index has not changed.
+
+    Parameters
+    ----------
+    - previous: LayersIndex optional - Layers from the previous update
+  '''
+  index, etag = glad.get_tiles_index(etag=previous.etag if previous is not None else None)
+  if index is None:
+    return previous
+
   print('Updating layers cache...')
 
-  tiles = glad.list_tiles(full=True)
+  changed = [tile for tile, ids in index['tiles'].items() if previous is None or previous.index.get(tile) != ids]
+  tiles = glad.list_tiles(full=True, index=index, tile_ids=changed)
 
   layers = [{
     'zlevel': 2,
@@ -30,9 +48,8 @@ def update_layers():
         'case',
         ['==', ['band', 2], 0],
         [0, 0, 0, 0],
-        # Tree cover is green and non-treecover is red
-        ["interpolate", ["linear"], ["band", 1],
-          0, [20, 90, 50], 1, [250, 0, 0]]
+        # Tree cover is green and non-treecover is red. The ramp is shared with the pre-rendered XYZ tiles.
+        ["interpolate", ["linear"], ["band", 1], *[v for value, color in TREECOVER_RAMP for v in (value, color)]]
       ]
     },
     'min': 0,
@@ -46,58 +63,186 @@ def update_layers():
     'style': {
       # RGBA
       'color': ["array", ['band', 1], ['band', 2], ['band', 3], ['band', 4]],
-      'gamma': 1.1
+      'gamma': RGBA_GAMMA
     },
     'min': 0,
     'max': 255
   }]
 
   for layer in layers:
+    # Images with pre-rendered XYZ tiles also have their TileJSON as an alternative source to the COG. The zooms are
+    # the default of the renders.
+    layer['xyz'] = {'minzoom': xyz_source['minzoom'], 'maxzoom': xyz_source['maxzoom']}
     layer['tiles'] = []
     for tile, images in tiles.items():
       for image in images:
-        layer['tiles'].append({
+        # Images which don't have the level (yet) eg only the raw image is ingested
+        if layer['layer'] not in image['Levels']:
+          continue
+
+        entry = {
           'url': f'{base_url}/{tile}/{image["ID"]}/{layer["layer"]}.tif',
           'tile': tile,
           'id': image['ID'],
           'date': image['Date']
-        })
+        }
+        if f'{layer["layer"]}-xyz' in image['Levels']:
+          # TileJSON of the tiles as they were rendered with their zooms and format
+          entry['xyz'] = f'{base_url}/{tile}/{image["ID"]}/{layer["layer"]}-xyz.json'
+        layer['tiles'].append(entry)
 
-  print('Updated layers cache...')
-  return layers
+  print(f'Updated layers cache ({len(changed)} tiles changed)...')
+  return LayersIndex(layers, etag=etag, index=index['tiles'], previous=previous, listed=set(tiles.keys()))
 
 
-def filter_dates(layers: dict, date: datetime):
+class LayersIndex():
   '''
-    Return layers filtered to a date. Return the closest previous image to the date.
+    Layers metadata indexed for filtering to a date. The images of each Tile ID are sorted by date so the closest
+    previous image to a date is a binary search, and the serialized responses are memoized per date bucket (the
+    dates between two consecutive image dates return the same images).
 
     Parameters
     ----------
-    - layers: dict - All layers metadata.
-    - date: datetime - Date to filter to. Defaults to today.
+    - layers: list - Layers metadata with the images of the tiles in `tiles`.
+    - etag: str optional - ETag of the manifest index the layers were listed from
+    - index: dict optional - Tiles of the manifest index {tile_id: {interval_id: [level]}}. Tiles in it which were 
+      not listed are taken from `previous`, tiles not in it are dropped.
+    - previous: LayersIndex optional - Layers of the previous update
+    - listed: set optional - Tiles listed in `layers`, even if a layer has no images of them. Defaults to the tiles 
+      with images in each layer.
   '''
-  if date is None:
-    date = datetime.now()
-
-  def _filter_dates(row):
-    return date > row['date']
 
-  # Get only latest image of each Tile
-  for layer in layers:
-    tiles = []
-    tiles_set = set()
-    layer['tiles'] = list(filter(_filter_dates, layer['tiles']))
-    for tile in reversed(layer['tiles']):
-      if tile['tile'] not in tiles_set:
-        tiles.append(tile)
-        tiles_set.add(tile['tile'])
-    layer['tiles'] = tiles
-
-  return layers
+  _memo_size = 128
+
+  def __init__(self, layers: list, etag: str = None, index: dict = None, previous: 'LayersIndex' = None, 
+               listed: set = None):
+    self.etag = etag
+    self.index = index or {}
+    self._layers = []
+    for layer in layers:
+      tiles = {}
+      for tile in layer['tiles']:
+        tiles.setdefault(tile['tile'], []).append(tile)
+
+      # Images sorted by date
+      tiles = {tile: self._sort(images) for tile, images in tiles.items()}
+      if previous is not None:
+        previous_tiles = previous._tiles(layer['layer'])
+        tiles.update({tile: previous_tiles[tile] for tile in self.index
+                      if tile not in (listed if listed is not None else tiles) and tile in previous_tiles})
+      if index is not None:
+        tiles = {tile: images for tile, images in tiles.items() if tile in index}
+
+      self._layers.append(({key: value for key, value in layer.items() if key != 'tiles'}, tiles))
+
+    self._dates = sorted(set(date for _, tiles in self._layers for dates, _ in tiles.values() for date in dates))
+    # Tiles in the order of the previous responses
+    self._tile_ids = [sorted(tiles.keys(), reverse=True) for _, tiles in self._layers]
+    self._to_json = lru_cache(maxsize=self._memo_size)(self._to_json)
+
+  def filter_dates(self, date: datetime = None, tile_ids: set = None):
+    '''
+      Return layers filtered to a date. Return the closest previous image to the date.
+
+      Parameters
+      ----------
+      - date: datetime optional - Date to filter to. Defaults to today.
+      - tile_ids: set optional - Only include these Tile IDs eg the tiles in a viewport
+    '''
+    return self._filter_bucket(self._bucket(date), tile_ids)
+
+  def to_json(self, date: datetime = None, tile_ids: set = None):
+    '''
+      Return the layers filtered to a date serialized to JSON. Only the responses for all tiles are memoized.
+
+      Parameters
+      ----------
+      - date: datetime optional - Date to filter to. Defaults to today.
+      - tile_ids: set optional - Only include these Tile IDs eg the tiles in a viewport
+    '''
+    if tile_ids is not None:
+      return self._serialize(self.filter_dates(date, tile_ids))
+
+    return self._to_json(self._bucket(date))
+
+  def _bucket(self, date: datetime):
+    if date is None:
+      date = datetime.now()
+
+    # Number of image dates before the date
+    return bisect_left(self._dates, date)
+
+  def _filter_bucket(self, bucket: int, tile_ids: set = None):
+    if bucket == 0:
+      return [{**layer, 'tiles': []} for layer, _ in self._layers]
+
+    date = self._dates[bucket - 1]
+    layers = []
+    for (layer, tiles), order in zip(self._layers, self._tile_ids):
+      if tile_ids is not None:
+        order = sorted((tile for tile in tile_ids if tile in tiles), reverse=True)
+
+      images = []
+      for tile in order:
+        dates, tile_images = tiles[tile]
+        i = bisect_right(dates, date)
+        if i > 0:
+          images.append(tile_images[i - 1])
+      layers.append({**layer, 'tiles': images})
+
+    return layers
+
+  def _tiles(self, layer: str):
+    for meta, tiles in self._layers:
+      if meta['layer'] == layer:
+        return tiles
+
+    return {}
+
+  def _sort(self, images: list):
+    images = sorted(images, key=lambda x: (x['date'], x['id']))
+    return [image['date'] for image in images], images
+
+  def _to_json(self, bucket: int):
+    return self._serialize(self._filter_bucket(bucket))
+
+  def _serialize(self, layers: list):
+    return json.dumps(layers, default=lambda x: x.isoformat(), separators=(',', ':')).encode()
+
+
+def get_meta(bbox: tuple = None, simplify: float = None):
+  '''
+    Return the attributions and the tile grid GeoJSON.
 
+    Parameters
+    ----------
+    - bbox: tuple optional - Only the tiles intersecting (min lon, min lat, max lon, max lat)
+    - simplify: float optional - Tolerance in degrees to simplify the tile geometries with
+  '''
+  if bbox is None and simplify is None:
+    geojson = glad.get_tile_geojson().to_geo_dict()
+  else:
+    geojson = glad.get_tile_index().to_geo_dict(bbox=bbox, simplify=simplify)
 
-def get_meta():
   return {
     'attributions': attributions,
-    'geojson': glad.get_tile_geojson().to_geo_dict()
-  }
\ No newline at end of file
+    'geojson': geojson
+  }
+
+
+def get_tiles(bbox: tuple = None, point: tuple = None, tile_ids: set = None):
+  '''
+    Return the Tile IDs intersecting a bbox, or the Tile ID at a point.
+
+    Parameters
+    ----------
+    - bbox: tuple optional - (min lon, min lat, max lon, max lat)
+    - point: tuple optional - (lon, lat)
+    - tile_ids: set optional - Only return these Tile IDs eg the processed tiles
+  '''
+  tile_index = glad.get_tile_index()
+  if point is not None:
+    tile = tile_index.query_point(*point)
+    return [tile] if tile is not None and (tile_ids is None or tile in tile_ids) else []
+
+  return tile_index.query_bbox(bbox if bbox is not None else (-180, -90, 180, 90), tile_ids=tile_ids)
\ No newline at end of file
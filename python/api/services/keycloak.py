@@ -1,6 +1,9 @@
 import os
 import jwt
+import time
 import requests
+from collections import OrderedDict
+from threading import Thread, Lock
 from fastapi import HTTPException, Header
 from keycloak import KeycloakOpenID
 
@@ -13,7 +16,125 @@ keycloak_openid = KeycloakOpenID(
 )
 
 jwks_url = f"{os.environ['KEYCLOAK_URL']}/realms/default/protocol/openid-connect/certs"
-jwks = requests.get(jwks_url).json()
+
+
+class KeyStore():
+  '''
+    Public keys of the JWKS by kid, parsed once. The JWKS is refreshed in the background every `_refresh_interval`
+    seconds and on an unknown kid, at most once every `_min_refresh_interval` seconds so tokens with a bogus kid
+    can't flood Keycloak.
+
+    Parameters
+    ----------
+    - url: str - JWKS URL
+  '''
+
+  _refresh_interval = 3600
+  _min_refresh_interval = 30
+  _timeout = 10
+
+  def __init__(self, url: str):
+    self.url = url
+    self.on_change = []
+    self._keys = {}
+    self._lock = Lock()
+    self._last_refresh = 0
+    self.refresh()
+
+    Thread(target=self._refresh_periodically, daemon=True).start()
+
+  def get(self, kid: str):
+    '''
+      Return the key and algorithm for a kid, refreshing the JWKS if it is unknown. Returns None if it is not found.
+    '''
+    key = self._keys.get(kid)
+    if key is None and self.refresh():
+      key = self._keys.get(kid)
+
+    return key
+
+  def refresh(self):
+    '''
+      Fetch the JWKS unless it was fetched in the last `_min_refresh_interval` seconds. Returns True if fetched.
+    '''
+    with self._lock:
+      if time.monotonic() - self._last_refresh < self._min_refresh_interval and self._last_refresh > 0:
+        return False
+      self._last_refresh = time.monotonic()
+
+      try:
+        jwks = requests.get(self.url, timeout=self._timeout).json()
+        keys = {k['kid']: (jwt.algorithms.RSAAlgorithm.from_jwk(k), k.get('alg', 'RS256'))
+                for k in jwks['keys'] if k.get('use', 'sig') == 'sig' and k.get('kty') == 'RSA'}
+      except Exception as e:
+        print(f'Could not refresh JWKS - {e}')
+        return False
+
+      removed = self._keys.keys() - keys.keys()
+      self._keys = keys
+
+    if len(removed) > 0:
+      print(f'Keys {sorted(removed)} were removed from the JWKS.')
+      for callback in self.on_change:
+        callback()
+
+    return True
+
+  def _refresh_periodically(self):
+    while True:
+      time.sleep(self._refresh_interval)
+      self.refresh()
+
+
+class TokenCache():
+  '''
+    Bounded cache of verified tokens, each expiring at its `exp`. The least recently used tokens are evicted once
+    `max_size` is reached. Tokens without an `exp` are not cached.
+
+    Parameters
+    ----------
+    - max_size: int default=10000 - Maximum number of tokens
+  '''
+
+  def __init__(self, max_size: int = 10000):
+    self.max_size = max_size
+    self._tokens = OrderedDict()
+    self._lock = Lock()
+
+  def get(self, token: str):
+    '''
+      Return the decoded token if it was verified. Raises jwt.ExpiredSignatureError if it has expired since.
+    '''
+    with self._lock:
+      decoded_token = self._tokens.get(token)
+      if decoded_token is None:
+        return None
+
+      if decoded_token['exp'] <= time.time():
+        del self._tokens[token]
+        raise jwt.ExpiredSignatureError('Signature has expired')
+
+      self._tokens.move_to_end(token)
+      return decoded_token
+
+  def set(self, token: str, decoded_token: dict):
+    if 'exp' not in decoded_token:
+      return
+
+    with self._lock:
+      self._tokens[token] = decoded_token
+      while len(self._tokens) > self.max_size:
+        self._tokens.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._tokens.clear()
+
+
+keys = KeyStore(jwks_url)
+tokens = TokenCache()
+# Tokens signed with a removed key are verified again
+keys.on_change.append(tokens.clear)
 
 class TokenVerifier:
   def __init__(self, roles: list = []):
@@ -25,18 +146,10 @@ class TokenVerifier:
 
     try:
       token = authorization.split(" ")[1]
-      header = jwt.get_unverified_header(token)
-      key = None
-      for k in jwks["keys"]:
-        if k["kid"] == header["kid"]:
-          key = k
-          break
-      if not key:
-        raise HTTPException(status_code=401, detail="Invalid token")
-          
-      public_key = jwt.algorithms.RSAAlgorithm.from_jwk(key)
-      decoded_token = jwt.decode(token, public_key, algorithms=[header['alg']],
-                                 options={"verify_aud": False})
+      decoded_token = tokens.get(token)
+      if decoded_token is None:
+        decoded_token = self._verify(token)
+        tokens.set(token, decoded_token)
 
       # Verify roles
       for role in self.roles:
@@ -49,4 +162,13 @@ class TokenVerifier:
       raise HTTPException(status_code=401, detail="Token expired")
     
     except jwt.InvalidTokenError:
-      raise HTTPException(status_code=401, detail="Invalid token")
\ No newline at end of file
+      raise HTTPException(status_code=401, detail="Invalid token")
+
+  def _verify(self, token: str):
+    header = jwt.get_unverified_header(token)
+    key = keys.get(header.get('kid'))
+    if not key:
+      raise HTTPException(status_code=401, detail="Invalid token")
+
+    public_key, algorithm = key
+    return jwt.decode(token, public_key, algorithms=[algorithm], options={"verify_aud": False})
\ No newline at end of file
@@ -1,9 +1,106 @@
 import json
+import gzip
 import hashlib
+from fastapi import Response, HTTPException
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
 
 
 def generate_etag(data: str) -> str:
     if type(data) == dict:
         data = json.dumps(data)
 
-    return hashlib.md5(data.encode()).hexdigest()
\ No newline at end of file
+    return hashlib.md5(data.encode()).hexdigest()
+
+
+def parse_bbox(bbox: str) -> tuple:
+  '''
+    Parse a `min lon,min lat,max lon,max lat` query parameter. Raises a 400 if it is invalid.
+  '''
+  if bbox is None:
+    return None
+
+  try:
+    bbox = tuple(float(x) for x in bbox.split(','))
+  except ValueError:
+    bbox = ()
+
+  if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+    raise HTTPException(status_code=400, detail='bbox must be min lon,min lat,max lon,max lat')
+
+  return bbox
+
+
+class PreparedResponse():
+  '''
+    JSON payload serialized, compressed (gzip and brotli if installed) and hashed once, so requests are served from
+    the bytes and a conditional request is a string comparison. Each encoding has its own ETag.
+
+    Parameters
+    ----------
+    - data: dict - Payload
+  '''
+
+  _media_type = 'application/json'
+  _preference = ['br', 'gzip', 'identity']
+
+  def __init__(self, data: dict):
+    body = json.dumps(data)
+    etag = generate_etag(body)
+    body = body.encode()
+
+    self._bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+      self._bodies['br'] = brotli.compress(body, quality=11)
+
+    # Cloudflare tunnel requires string ETag
+    self._etags = {encoding: f'"{etag}"' if encoding == 'identity' else f'"{etag}-{encoding}"'
+                   for encoding in self._bodies}
+    self._etag_set = set(self._etags.values())
+
+  def response(self, accept_encoding: str = None, if_none_match: str = None):
+    '''
+      Return the response in the preferred encoding the client accepts, or 304 if it has the payload.
+
+      Parameters
+      ----------
+      - accept_encoding: str optional - Accept-Encoding header
+      - if_none_match: str optional - If-None-Match header
+    '''
+    encoding = self._negotiate(accept_encoding)
+    headers = {'ETag': self._etags[encoding], 'Vary': 'Accept-Encoding'}
+    if encoding != 'identity':
+      headers['Content-Encoding'] = encoding
+
+    if if_none_match is not None:
+      # Weak ETags of any encoding of the payload match
+      if any(tag.strip().removeprefix('W/') in self._etag_set for tag in if_none_match.split(',')):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=self._bodies[encoding], media_type=self._media_type, headers=headers)
+
+  def _negotiate(self, accept_encoding: str):
+    if not accept_encoding:
+      return 'identity'
+
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+      coding, _, params = item.strip().partition(';')
+      q = 1.0
+      if params.strip().startswith('q='):
+        try:
+          q = float(params.strip()[2:])
+        except ValueError:
+          q = 0.0
+      accepted[coding.strip()] = q
+
+    # Preferred encoding with q > 0. identity is acceptable unless excluded.
+    for encoding in self._preference:
+      default = accepted.get('*', 1.0 if encoding == 'identity' else 0.0)
+      if encoding in self._bodies and accepted.get(encoding, default) > 0:
+        return encoding
+
+    return 'identity'
\ No newline at end of file
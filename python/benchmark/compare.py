@@ -0,0 +1,50 @@
+import sys
+import json
+import pandas as pd
+from argparse import ArgumentParser
+
+
+# Run from the python directory - python -m benchmark.compare base.json new.json
+metrics = ['wall_s', 'peak_rss_mb', 'disk_high_water_mb', 's3_received_bytes', 's3_sent_bytes']
+
+parser = ArgumentParser(description='Compare two benchmark results. Exits with 1 if a stage regressed and 2 if no stages '
+                                    'can be compared.')
+parser.add_argument('base', help='Results JSON of the baseline version')
+parser.add_argument('new', help='Results JSON of the new version')
+parser.add_argument('--metrics', nargs='+', choices=metrics, default=['wall_s', 'peak_rss_mb'],
+                    help='Metrics which fail the comparison if they regress (default: wall_s peak_rss_mb)')
+parser.add_argument('--threshold', type=float, default=0.1, help='Relative increase counted as a regression')
+args = parser.parse_args()
+
+with open(args.base) as f:
+  base = json.load(f)
+with open(args.new) as f:
+  new = json.load(f)
+
+print(f'Base: {base["version"]} ({base["created"]})')
+print(f'New: {new["version"]} ({new["created"]})')
+if base['params'] != new['params']:
+  print('Warning: the benchmarks were run with different parameters.')
+
+base_stages = {stage['stage']: stage for stage in base['stages']}
+rows = []
+for stage in new['stages']:
+  if stage['stage'] not in base_stages or stage.get('error') or base_stages[stage['stage']].get('error'):
+    continue
+
+  for metric in metrics:
+    before, after = base_stages[stage['stage']][metric], stage[metric]
+    change = (after - before) / before if before else 0
+    rows.append({'stage': stage['stage'], 'metric': metric, 'base': before, 'new': after, 'change': change,
+                 'regression': metric in args.metrics and change > args.threshold})
+
+if len(rows) == 0:
+  print('\nNo stages to compare. The results share no stages which ran without errors in both.')
+  sys.exit(2)
+
+df = pd.DataFrame(rows)
+print(df.to_string(index=False, formatters={'change': '{:+.1%}'.format}))
+
+if df['regression'].any():
+  print(f'\n{df["regression"].sum()} regressions above {args.threshold:.0%}.')
+  sys.exit(1)
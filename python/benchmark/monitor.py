@@ -0,0 +1,112 @@
+import os
+import time
+import psutil
+from threading import Thread, Event, Lock
+
+
+class S3Counter():
+  '''
+    Count the bytes sent to and received from S3 by boto3 clients.
+    Reads which don't go through boto3 (eg GDAL reading presigned URLs) are not counted.
+  '''
+
+  def __init__(self):
+    self.sent = 0
+    self.received = 0
+    self._lock = Lock()
+
+  def register(self, s3):
+    s3.meta.events.register('before-send.s3', self._before_send)
+    s3.meta.events.register('after-call.s3.GetObject', self._after_get_object)
+
+  def _before_send(self, request, **kwargs):
+    with self._lock:
+      self.sent += int(request.headers.get('Content-Length', 0))
+
+  def _after_get_object(self, http_response, **kwargs):
+    with self._lock:
+      self.received += int(http_response.headers.get('Content-Length', 0))
+
+
+class StageMonitor():
+  '''
+    Measure a benchmark stage - wall time, peak RSS of the process and its children (eg dask and ingest workers),
+    high-water of the disk used in a directory and the bytes moved. The peaks are sampled so very short spikes can be
+    missed.
+
+    Parameters
+    ----------
+    - name: str - Stage name
+    - directory: str - Directory to track the disk usage of (temporary files and caches)
+    - counters: dict - {name: callable} returning a running count of bytes moved eg from a S3Counter
+    - exclude_pids: list optional - Child processes not to count (eg the S3 stand-in)
+    - items: int default=1 - Number of items processed in the stage to report the time per item
+  '''
+
+  _interval = 0.05
+
+  def __init__(self, name: str, directory: str, counters: dict, exclude_pids: list = [], items: int = 1):
+    self.name = name
+    self.directory = directory
+    self.counters = counters
+    self.exclude_pids = set(exclude_pids)
+    self.items = items
+    self.result = None
+    self._process = psutil.Process()
+    self._stop = Event()
+
+  def __enter__(self):
+    self._counts = {name: counter() for name, counter in self.counters.items()}
+    self._disk_baseline = self._disk_usage()
+    self._start_rss = self._rss()
+    self._peak_rss = self._start_rss
+    self._peak_disk = 0
+    self._thread = Thread(target=self._sample, daemon=True)
+    self._thread.start()
+    self._started = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    wall = time.perf_counter() - self._started
+    self._stop.set()
+    self._thread.join()
+
+    self.result = {
+      'stage': self.name,
+      'items': self.items,
+      'wall_s': round(wall, 3),
+      'wall_per_item_s': round(wall / max(self.items, 1), 4),
+      'start_rss_mb': round(self._start_rss / 1024**2, 1),
+      'peak_rss_mb': round(self._peak_rss / 1024**2, 1),
+      'disk_high_water_mb': round(self._peak_disk / 1024**2, 1),
+      **{f'{name}_bytes': counter() - self._counts[name] for name, counter in self.counters.items()},
+      'error': None if exc_value is None else str(exc_value)
+    }
+
+  def _sample(self):
+    while not self._stop.wait(self._interval):
+      self._peak_rss = max(self._peak_rss, self._rss())
+      self._peak_disk = max(self._peak_disk, self._disk_usage() - self._disk_baseline)
+
+  def _rss(self):
+    rss = 0
+    for process in [self._process] + self._process.children(recursive=True):
+      if process.pid in self.exclude_pids:
+        continue
+      try:
+        rss += process.memory_info().rss
+      except psutil.Error:
+        pass
+
+    return rss
+
+  def _disk_usage(self):
+    size = 0
+    for root, _, files in os.walk(self.directory):
+      for file in files:
+        try:
+          size += os.path.getsize(os.path.join(root, file))
+        except OSError:
+          pass
+
+    return size
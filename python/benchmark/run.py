@@ -0,0 +1,311 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import rasterio
+import requests
+import subprocess
+import multiprocessing.util
+import numpy as np
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime
+from tempfile import mkdtemp
+from threading import Lock
+
+
+# Run from the python directory - python -m benchmark.run
+stages = ['ingest', 'rgba', 'treecover', 'combined', 'incremental', 'raster_map_blocks', 'update_layers',
+          'filter_dates']
+
+parser = ArgumentParser(description='Benchmark the GLAD ARD pipeline and API offline on synthetic tiles. '
+                                    'S3 is a local stand-in and the db is SQLite unless configured otherwise.')
+parser.add_argument('--stages', nargs='+', choices=stages, default=stages,
+                    help='Stages to run (default: all). The tiles a stage needs are ingested and processed first if '
+                         'the stages before it did not.')
+parser.add_argument('--size', type=int, default=1000, help='Width and height of the tiles in pixels (GLAD: 4004)')
+parser.add_argument('--intervals', type=int, default=12, help='Number of intervals ingested per tile')
+parser.add_argument('--incremental-intervals', type=int, default=2,
+                    help='Number of intervals added before the incremental stage')
+parser.add_argument('--tiles', type=int, default=1, help='Number of tiles')
+parser.add_argument('--cloud-cover', type=float, default=0.3, help='Mean cloud cover of the images')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--parallel', action='store_true', help='Ingest intervals in parallel')
+parser.add_argument('--io-workers', type=int, default=4, help='Download/upload threads for parallel ingestion')
+parser.add_argument('--cpu-workers', type=int, default=2, help='Masking/COG processes for parallel ingestion')
+parser.add_argument('--scheduler', default='threads', help='Dask scheduler for the block tasks')
+parser.add_argument('--workers', type=int, help='Number of dask workers (default: number of CPUs)')
+parser.add_argument('--memory-limit', type=int, help='Memory limit per dask worker in MB')
+parser.add_argument('--raster-cache', type=int, default=0, help='Size of the local raster cache in MB (default: off)')
+parser.add_argument('--api-tiles', type=int, default=100, help='Number of tiles in the index for the API stages')
+parser.add_argument('--api-intervals', type=int, default=300, help='Number of intervals per tile for the API stages')
+parser.add_argument('--api-requests', type=int, default=50, help='Number of /layers requests to filter dates for')
+parser.add_argument('--s3-url', help='S3 bucket URL of a running stand-in (eg MinIO) with S3_ACCESS_KEY and '
+                                     'S3_SECRET_KEY set. A moto server is started if not provided.')
+parser.add_argument('--postgres', action='store_true', help='Use the Postgres db from the POSTGRES_* variables')
+parser.add_argument('--workdir', help='Working directory for temporary files and caches (default: a new '
+                                      'temporary directory which is removed)')
+parser.add_argument('--output', help='Results JSON file (default: benchmark-<timestamp>.json)')
+parser.add_argument('--quiet', action='store_true', help='Hide the output of the stages')
+
+# The ingestion worker processes import this module. Only the main process runs the benchmark.
+if __name__ == '__main__':
+  args = parser.parse_args()
+
+  output = os.path.abspath(args.output or f'benchmark-{datetime.now().strftime("%Y%m%d%H%M%S")}.json')
+  repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  workdir = os.path.abspath(args.workdir or mkdtemp(prefix='geomap-benchmark-'))
+  os.makedirs(os.path.join(workdir, 'tmp'), exist_ok=True)
+
+
+  def start_s3():
+    '''
+      Start a moto server as the S3 stand-in. Returns the process.
+    '''
+    with socket.socket() as s:
+      s.bind(('127.0.0.1', 0))
+      port = s.getsockname()[1]
+
+    process = subprocess.Popen([sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+      try:
+        requests.get(f'http://127.0.0.1:{port}', timeout=1)
+        break
+      except requests.ConnectionError:
+        time.sleep(0.1)
+
+    os.environ.update(S3_URL=f'http://127.0.0.1:{port}/geomap-benchmark', S3_ACCESS_KEY='benchmark',
+                      S3_SECRET_KEY='benchmark', AWS_DEFAULT_REGION='us-east-1')
+    return process
+
+  def git_version():
+    try:
+      return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=repo, capture_output=True, text=True,
+                            check=True).stdout.strip()
+    except Exception:
+      return None
+
+
+  s3_process = None
+  if args.s3_url:
+    os.environ['S3_URL'] = args.s3_url
+  else:
+    s3_process = start_s3()
+
+  os.environ.setdefault('PUBLIC_S3_URL', os.environ['S3_URL'])
+  os.environ['RASTER_CACHE_SIZE'] = str(args.raster_cache)
+  if not args.postgres:
+    os.environ['SQLITE_DB'] = os.path.join(workdir, 'geomap.sqlite')
+
+  # The temporary directory of multiprocessing (the forkserver of the ingestion pool) is created outside workdir as
+  # it is only removed at exit, after workdir
+  multiprocessing.util.get_temp_dir()
+
+  # Caches relative to the working directory (interval table, raster cache) and temporary files are kept in workdir
+  os.chdir(workdir)
+  os.environ['TMPDIR'] = os.path.join(workdir, 'tmp')
+  sys.path.insert(0, repo)
+
+  import tempfile
+  tempfile.tempdir = os.environ['TMPDIR']
+
+  from lib.glad import GLAD
+  from lib.util import DaskScheduler, raster_map_blocks
+  from lib.rgba import fill_series
+  from benchmark.synthetic import SyntheticTile, interval_table, tile_ids, tile_geojson
+  from benchmark.monitor import S3Counter, StageMonitor
+
+
+  class SyntheticGLAD(GLAD):
+    '''
+      GLAD with the raw images generated locally instead of downloaded from glad.umd.edu.
+    '''
+
+    # There are no remote images to sample
+    _prescreen = False
+
+    def __init__(self, tiles: dict):
+      super().__init__()
+      self._tiles = tiles
+      self._source_lock = Lock()
+      self.source_bytes = 0
+
+    def _download_image_raw(self, tile_id: str, interval_id: int, tdir: str):
+      tmp_file_tif = os.path.join(tdir, 'temp.tif')
+      size = self._tiles[tile_id].write(tmp_file_tif, interval_id - 1)
+      with self._source_lock:
+        self.source_bytes += size
+
+      return tmp_file_tif
+
+
+  tiles = {tile_id: SyntheticTile(tile_id, size=args.size, intervals=args.intervals + args.incremental_intervals,
+                                  cloud_cover=args.cloud_cover, seed=args.seed + i)
+           for i, tile_id in enumerate(tile_ids(args.tiles))}
+  table, dates = interval_table()
+  GLAD._cache.set('interval_table', table)
+  GLAD._cache.set('interval_dates', dates)
+  GLAD._cache.delete('interval_calendar')
+  GLAD._cache.set('tile_geojson', tile_geojson(tile_ids(max(args.tiles, args.api_tiles))))
+
+  glad = SyntheticGLAD(tiles)
+  try:
+    glad._s3.create_bucket(Bucket=glad._s3_bucket)
+  except glad._s3.exceptions.BucketAlreadyOwnedByYou:
+    pass
+
+  s3_counter = S3Counter()
+  s3_counter.register(glad._s3)
+  counters = {'s3_received': lambda: s3_counter.received, 's3_sent': lambda: s3_counter.sent,
+              'glad_received': lambda: glad.source_bytes}
+  exclude_pids = [s3_process.pid] if s3_process is not None else []
+
+
+  def monitor(stage: str, items: int = 1):
+    return StageMonitor(stage, workdir, counters, exclude_pids=exclude_pids, items=items)
+
+  def scheduler():
+    return DaskScheduler(args.scheduler, workers=args.workers, memory_limit=args.memory_limit)
+
+  def ingest(ids: list):
+    for tile_id in tiles:
+      if args.parallel:
+        glad.process_images_raw(tile_id, ids, io_workers=args.io_workers, cpu_workers=args.cpu_workers)
+      else:
+        with glad.deferred_index():
+          for id in ids:
+            try:
+              glad.process_image_raw(tile_id, id)
+            except Exception as e:
+              print(f'Failed with error - {e}')
+
+  def prepare(stage: str, ids: list, processed: bool = False):
+    '''
+      Ingest (and with `processed` process the levels of) the tiles a stage needs if the stages before it did not, so a
+      stage can also be run on its own. Not measured as part of the stage.
+    '''
+    if any(len(glad.list_images(tile_id)) == 0 for tile_id in tiles):
+      print(f'Ingesting the tiles for the {stage} stage...', file=sys.stderr)
+      ingest(ids)
+    for tile_id in tiles:
+      if len(glad.list_images(tile_id)) == 0:
+        raise Exception(f'No valid images ingested for tile {tile_id}, which the {stage} stage needs. Run it with a '
+                        'lower --cloud-cover or more --intervals.')
+
+    if processed and any(glad._get_state_meta(tile_id, level) is None for tile_id in tiles 
+                         for level in ['rgba', 'treecover']):
+      print(f'Processing the tiles for the {stage} stage...', file=sys.stderr)
+      with scheduler() as s:
+        for tile_id in tiles:
+          glad.process_images(tile_id, scheduler=s)
+
+  def run_stage(stage: str):
+    ids = list(range(1, args.intervals + 1))
+
+    if stage == 'ingest':
+      with monitor(stage, items=len(tiles) * len(ids)) as m:
+        ingest(ids)
+
+    elif stage in ['rgba', 'treecover', 'combined']:
+      prepare(stage, ids)
+      with monitor(stage, items=len(tiles)) as m, scheduler() as s:
+        for tile_id in tiles:
+          if stage == 'rgba':
+            glad.process_images_rgba(tile_id, scheduler=s)
+          elif stage == 'treecover':
+            glad.process_images_treecover(tile_id, scheduler=s)
+          else:
+            glad.process_images(tile_id, scheduler=s)
+
+    elif stage == 'incremental':
+      prepare(stage, ids, processed=True)
+      ingest(list(range(args.intervals + 1, args.intervals + args.incremental_intervals + 1)))
+      with monitor(stage, items=len(tiles)) as m, scheduler() as s:
+        for tile_id in tiles:
+          glad.process_images(tile_id, incremental=True, scheduler=s)
+
+    elif stage == 'raster_map_blocks':
+      # RGBA stack with clouds to fill
+      tile = next(iter(tiles.values()))
+      input_files, output_files = [], []
+      for i in range(args.intervals):
+        image = tile.image(i)
+        rgba = np.concatenate([image[[2, 1, 0]] // 40, np.full(image[:1].shape, 255)]).astype(np.uint8)
+        rgba[:, image[7] != 1] = 0
+        input_files.append(os.path.join(workdir, 'tmp', f'{i}-rgba.tif'))
+        output_files.append(os.path.join(workdir, 'tmp', f'{i}-filled.tif'))
+        with rasterio.open(input_files[-1], 'w', **tile.profile(count=4, dtype='uint8')) as dst:
+          dst.write(rgba)
+
+      with monitor(stage, items=len(input_files)) as m, scheduler() as s:
+        raster_map_blocks(input_files, output_files, block_size=500,
+                          fn_map_blocks=lambda block, dim: fill_series(block.values), scheduler=s)
+
+      for file in input_files + output_files:
+        os.remove(file)
+
+    elif stage in ['update_layers', 'filter_dates']:
+      # Index of tiles with all intervals processed, on top of the ones processed by the pipeline stages
+      index = glad._manifest.get_index()
+      for tile_id in tile_ids(args.api_tiles):
+        index['tiles'].setdefault(tile_id, {str(id): ['raw', 'rgba', 'treecover'] 
+                                            for id in range(1, args.api_intervals + 1)})
+      glad._s3.put_object(Bucket=glad._s3_bucket, Key=glad._manifest._index_key(), Body=json.dumps(index).encode())
+
+      from api.services import glad as api
+      s3_counter.register(api.glad._s3)
+
+      if stage == 'update_layers':
+        with monitor(stage) as m:
+          api.update_layers()
+
+      else:
+        layers = api.update_layers()
+        start, end = dates.to_numpy().min(), dates.to_numpy().max()
+        rng = np.random.default_rng(args.seed)
+        request_dates = [datetime.fromtimestamp(x)
+                         for x in rng.uniform(start.astype(int) / 1e9, end.astype(int) / 1e9, args.api_requests)]
+        # Same as the /layers endpoint
+        with monitor(stage, items=args.api_requests) as m:
+          for date in request_dates:
+            layers.to_json(date=date)
+
+    return m.result
+
+
+  results = {
+    'version': git_version(),
+    'created': datetime.now().isoformat(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'params': vars(args),
+    'stages': []
+  }
+
+  try:
+    for stage in args.stages:
+      print(f'Running stage {stage}...', file=sys.stderr)
+      with redirect_stdout(open(os.devnull, 'w') if args.quiet else sys.stdout):
+        try:
+          result = run_stage(stage)
+        except Exception as e:
+          result = {'stage': stage, 'error': str(e)}
+      results['stages'].append(result)
+      print(json.dumps(result), file=sys.stderr)
+
+  finally:
+    if s3_process is not None:
+      s3_process.terminate()
+    if args.workdir is None:
+      os.chdir(repo)
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  with open(output, 'w') as f:
+    json.dump(results, f, indent=2)
+
+  print(f'Results saved to {output}')
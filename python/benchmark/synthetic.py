@@ -0,0 +1,145 @@
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+from datetime import datetime, timedelta
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+
+# GLAD ARD qf band values used https://glad.umd.edu/Potapov/ARD/ARD_manual_v1.1.pdf pg 21
+QF_LAND = 1
+QF_WATER = 2
+QF_CLOUD = 3
+QF_CLOUD_SHADOW = 4
+QF_VALID_OTHER = 15
+
+# Typical values of the bands (blue, green, red, nir, swir1, swir2, temp) per land cover
+_forest = [300, 500, 300, 3500, 1500, 600, 2950]
+_cleared = [700, 900, 1200, 2200, 2500, 1500, 3050]
+_water = [600, 500, 300, 150, 80, 50, 2900]
+_cloud = [6500, 6400, 6300, 6600, 4500, 3000, 2700]
+
+
+def interval_table(start_year: int = 2000, end_year: int = None):
+  '''
+    Synthetic 16 day interval table like GLAD's. 23 intervals per year numbered from 1 at `start_year`.
+    Returns (interval_table, interval_dates) with the years as index and the interval of the year as columns.
+  '''
+  end_year = end_year or datetime.now().year
+  years = list(range(start_year, end_year + 1))
+  columns = list(range(1, 24))
+  table = pd.DataFrame([[(year - start_year) * 23 + column for column in columns] for year in years],
+                       index=pd.Index(years, name='Year'), columns=columns)
+  dates = pd.DataFrame([[datetime(year, 1, 1) + timedelta(days=16 * column - 1) for column in columns] for year in years],
+                       index=table.index, columns=columns).astype('datetime64[ns]')
+  return table, dates
+
+def tile_ids(n: int):
+  '''
+    `n` Tile IDs of a synthetic grid in the format '054W_03S'
+  '''
+  return [f'{50 + i // 10:03d}W_{i % 10:02d}S' for i in range(n)]
+
+def tile_geojson(tiles: list):
+  '''
+    Synthetic tiles GeoDataFrame like GLAD's for Tile IDs
+  '''
+  return gpd.GeoDataFrame({'TILE': tiles}, geometry=[box(*_tile_bounds(tile)) for tile in tiles], crs='EPSG:4326')
+
+def _tile_bounds(tile_id: str):
+  lon, lat = tile_id.split('_')
+  lon = int(lon[:-1]) * (-1 if lon[-1] == 'W' else 1)
+  lat = int(lat[:-1]) * (-1 if lat[-1] == 'S' else 1)
+  return lon, lat, lon + 1, lat + 1
+
+def smooth_noise(rng: np.random.Generator, size: int, scale: int):
+  '''
+    Spatially correlated noise in [0, 1) of shape (size, size). Random values on a grid with a spacing of `scale`
+    pixels are interpolated bilinearly so it forms patches like land cover and clouds do.
+  '''
+  n = size // scale + 2
+  grid = rng.random((n, n), dtype=np.float32)
+  x = np.linspace(0, n - 1.001, size, dtype=np.float32)
+  i = x.astype(int)
+  f = x - i
+  rows = grid[i] * (1 - f)[:, None] + grid[i + 1] * f[:, None]
+  return rows[:, i] * (1 - f) + rows[:, i + 1] * f
+
+
+class SyntheticTile():
+  '''
+    Synthetic GLAD ARD tile. Forest is cleared in patches over time and every interval has its own clouds, so the
+    images have realistic qf masks and the treecover timeseries has losses to find.
+
+    Parameters
+    ----------
+    - tile_id: str - Tile ID in the format '054W_03S'
+    - size: int default=1000 - Width and height in pixels. GLAD ARD tiles are 4004.
+    - intervals: int default=12 - Number of intervals the forest is cleared over
+    - cloud_cover: float default=0.3 - Mean cloud cover of the images. Some images are cloudier than the ingest
+        threshold, like real ones are.
+    - seed: int default=0
+  '''
+
+  def __init__(self, tile_id: str, size: int = 1000, intervals: int = 12, cloud_cover: float = 0.3, seed: int = 0):
+    self.tile_id = tile_id
+    self.size = size
+    self.intervals = intervals
+    self.cloud_cover = cloud_cover
+    self.seed = seed
+
+    rng = np.random.default_rng(seed)
+    scale = max(size // 20, 4)
+    self._water = smooth_noise(rng, size, scale) > 0.9
+    self._forest = ~self._water & (smooth_noise(rng, size, scale) < 0.7)
+    # Interval from which each pixel is cleared. Patches of 20% of the forest get cleared over the intervals.
+    loss = smooth_noise(rng, size, scale // 2)
+    self._cleared_at = np.where(self._forest & (loss < 0.2), (loss / 0.2 * intervals).astype(np.int32), -1)
+
+  def image(self, index: int):
+    '''
+      8 band (blue, green, red, nir, swir1, swir2, temp, qf) uint16 image of the `index`th interval
+    '''
+    rng = np.random.default_rng([self.seed, index])
+    size = self.size
+
+    cleared = ~self._forest | ((self._cleared_at >= 0) & (self._cleared_at <= index))
+    values = np.where(cleared[None], np.array(_cleared)[:, None, None], np.array(_forest)[:, None, None])
+    values = np.where(self._water[None], np.array(_water)[:, None, None], values)
+
+    # Cloud cover varies a lot between images
+    cover = rng.beta(2, 2 * (1 - self.cloud_cover) / max(self.cloud_cover, 0.01))
+    clouds = smooth_noise(rng, size, max(size // 10, 4)) < cover
+    shadows = ~clouds & np.roll(clouds, (size // 50, size // 50), axis=(0, 1))
+    values = np.where(clouds[None], np.array(_cloud)[:, None, None], values)
+    values = np.where(shadows[None], values // 3, values)
+
+    image = np.empty((8, size, size), dtype=np.uint16)
+    noise = rng.normal(1, 0.05, (7, size, size)).astype(np.float32)
+    image[:7] = np.clip(values * noise, 1, 10000)
+
+    qf = np.where(self._water, QF_WATER, QF_LAND)
+    qf = np.where(~self._water & (rng.random((size, size)) < 0.01), QF_VALID_OTHER, qf)
+    qf = np.where(shadows, QF_CLOUD_SHADOW, qf)
+    image[7] = np.where(clouds, QF_CLOUD, qf)
+
+    return image
+
+  def profile(self, count: int = 8, dtype: str = 'uint16'):
+    '''
+      GeoTIFF profile of the tile
+    '''
+    lon, _, _, lat = _tile_bounds(self.tile_id)
+    return {'driver': 'GTiff', 'width': self.size, 'height': self.size, 'count': count, 'dtype': dtype,
+            'crs': 'EPSG:4326', 'transform': from_origin(lon, lat, 1 / self.size, 1 / self.size), 'compress': 'lzw'}
+
+  def write(self, path: str, index: int):
+    '''
+      Write the image of the `index`th interval as a GeoTIFF like the ones served by GLAD. Returns its size in bytes.
+    '''
+    with rasterio.open(path, 'w', **self.profile()) as dst:
+      dst.write(self.image(index))
+
+    return os.path.getsize(path)
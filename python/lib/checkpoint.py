@@ -0,0 +1,163 @@
+import os
+import json
+import shutil
+import hashlib
+from threading import Lock
+from datetime import datetime
+
+from .db.ProcessRun import ProcessRun
+
+
+class RunCheckpoint():
+  '''
+    Checkpoints of a processing run of a Tile ID so an interrupted run (eg OOM, network error) is resumed instead of
+    started again. The files of the run are kept in a work directory and its checkpoints in the `process_runs` table.
+
+    A run is identified by its Tile ID, levels and a key of its inputs (eg interval IDs, parameters). A run with the same
+    key resumes the unfinished one and skips its completed work, while a run with other inputs abandons it and starts
+    in a new work directory. The work directory is removed once the run is done.
+
+    Checkpoints are named stages eg 'intermediate:rgba:123', 'stack:rgba', 'upload:rgba:123'. A stage is only marked
+    once its outputs are complete, so a file without a checkpoint is never used or uploaded. The completed blocks of a
+    stack are recorded with `blocks`.
+
+    Parameters
+    ----------
+    - tile_id: str - Tile ID
+    - levels: list - Levels of the run
+    - inputs: dict - Inputs of the run. Must be JSON serializable.
+    - root: str optional - Directory of the work directories. Defaults to PROCESS_RUN_DIR or .geomap/runs.
+  '''
+
+  _root = os.environ.get('PROCESS_RUN_DIR', os.path.join('.geomap', 'runs'))
+
+  def __init__(self, tile_id: str, levels: list, inputs: dict, root: str = None):
+    self.tile_id = tile_id
+    self.levels = '+'.join(levels)
+    self.key = hashlib.sha1(json.dumps([tile_id, levels, inputs], sort_keys=True, default=str).encode()).hexdigest()
+    self.workdir = os.path.join(root or self._root, f'{tile_id}-{self.levels}-{self.key[:12]}')
+    self._lock = Lock()
+    self._run = None
+    self._checkpoints = None
+
+  def __enter__(self):
+    now = datetime.now()
+    run = (ProcessRun.select()
+           .where(ProcessRun.key == self.key, ProcessRun.status == 'running')
+           .order_by(ProcessRun.id.desc())
+           .first())
+
+    if run is not None and os.path.isdir(run.workdir):
+      checkpoints = json.loads(run.checkpoints)
+      print(f'Resuming run {run.id} of Tile ID {self.tile_id} ({len(checkpoints.get("done", []))} checkpoints)...')
+      run.attempts += 1
+      run.updated = now
+      run.save()
+    else:
+      if run is not None:
+        self._abandon(run)
+      checkpoints = {}
+      shutil.rmtree(self.workdir, ignore_errors=True)
+      run = ProcessRun.create(key=self.key, tile_id=self.tile_id, levels=self.levels, workdir=self.workdir,
+                              created=now, updated=now)
+
+    # Interrupted runs of the tile with other inputs can't be resumed anymore
+    stale = ProcessRun.select().where(ProcessRun.tile_id == self.tile_id, ProcessRun.levels == self.levels,
+                                      ProcessRun.status == 'running', ProcessRun.id != run.id)
+    for other in stale:
+      self._abandon(other)
+
+    os.makedirs(self.workdir, exist_ok=True)
+    self._run = run
+    self._checkpoints = {'done': set(checkpoints.get('done', [])), 'blocks': checkpoints.get('blocks', {})}
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is not None:
+      # Keep the work directory to resume from
+      print(f'Run {self._run.id} of Tile ID {self.tile_id} interrupted. It is resumed from its checkpoints by the '
+            f'next run with the same inputs.')
+      return
+
+    with self._lock:
+      self._run.status = 'done'
+      self._save()
+    shutil.rmtree(self.workdir, ignore_errors=True)
+
+  def path(self, name: str):
+    '''
+      Path of a file in the work directory.
+    '''
+    return os.path.join(self.workdir, name)
+
+  def done(self, name: str, *files):
+    '''
+      If a stage is completed. If `files` are provided they must also still exist.
+    '''
+    return name in self._checkpoints['done'] and all(os.path.exists(file) for file in files)
+
+  def mark(self, name: str):
+    '''
+      Mark a stage as completed. Thread safe eg from upload callbacks.
+    '''
+    with self._lock:
+      self._checkpoints['done'].add(name)
+      self._save()
+
+  def blocks(self, name: str):
+    '''
+      Progress of the blocks of a stack. See `BlockProgress`.
+    '''
+    return BlockProgress(self, name)
+
+  def _save(self):
+    self._run.checkpoints = json.dumps({'done': sorted(self._checkpoints['done']),
+                                        'blocks': self._checkpoints['blocks']})
+    self._run.updated = datetime.now()
+    self._run.save()
+
+  def _abandon(self, run: ProcessRun):
+    print(f'Abandoning interrupted run {run.id} of Tile ID {run.tile_id}...')
+    if run.workdir != self.workdir:
+      shutil.rmtree(run.workdir, ignore_errors=True)
+    run.status = 'abandoned'
+    run.updated = datetime.now()
+    run.save()
+
+
+class BlockProgress():
+  '''
+    Blocks of a stack which are computed and written to its outputs, so an interrupted stack continues with the
+    remaining blocks. Blocks are the indexes of the windows of the stack for a block size. The progress is reset if the
+    block size changed.
+  '''
+
+  def __init__(self, checkpoint: RunCheckpoint, name: str):
+    self._checkpoint = checkpoint
+    self._name = name
+
+  def start(self, block_size: int, files: list):
+    '''
+      Start the stack with a block size and output files. Returns the set of completed blocks, empty if the outputs
+      need to be created.
+    '''
+    progress = self._checkpoint._checkpoints['blocks'].get(self._name)
+    if progress is None or progress['block_size'] != block_size or not all(os.path.exists(f) for f in files):
+      self._update({'block_size': block_size, 'done': []})
+      return set()
+
+    if len(progress['done']) > 0:
+      print(f'Resuming {self._name} with {len(progress["done"])} completed blocks...')
+    return set(progress['done'])
+
+  def add(self, blocks: list):
+    '''
+      Mark blocks as written. Only call this once the outputs of the blocks are written and closed.
+    '''
+    progress = self._checkpoint._checkpoints['blocks'][self._name]
+    self._update({'block_size': progress['block_size'], 'done': sorted(set(progress['done']) | set(blocks))})
+
+  def _update(self, progress: dict):
+    with self._checkpoint._lock:
+      self._checkpoint._checkpoints['blocks'][self._name] = progress
+      self._checkpoint._save()
\ No newline at end of file
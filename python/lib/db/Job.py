@@ -0,0 +1,43 @@
+from peewee import SQL, Model, AutoField, TextField, FixedCharField, IntegerField, DateTimeField, ForeignKeyField
+
+from .db import db
+
+
+class Job(Model):
+  '''
+    Job of the tile job queue. See `lib.job_queue.JobQueue`.
+
+    Status is one of -
+    - waiting: Waiting for the job it depends on to be done
+    - queued: Ready to be claimed once `run_after`
+    - running: Claimed by `worker` until `lease_until`, extended by its heartbeats
+    - done, failed: Finished. Failed jobs have used all their attempts or their dependency failed.
+  '''
+  id = AutoField()
+  kind = TextField()
+  tile_id = FixedCharField(8)
+  level = TextField(null=True)
+  params = TextField(default='{}')
+  status = TextField(default='queued')
+  priority = IntegerField(default=0)
+  attempts = IntegerField(default=0)
+  max_attempts = IntegerField(default=3)
+  run_after = DateTimeField()
+  depends_on = ForeignKeyField('self', null=True, backref='dependents', on_delete='SET NULL')
+  worker = TextField(null=True)
+  lease_until = DateTimeField(null=True)
+  heartbeat_at = DateTimeField(null=True)
+  error = TextField(null=True)
+  created = DateTimeField()
+  updated = DateTimeField()
+
+  class Meta:
+    database = db
+    table_name = 'jobs'
+    indexes = ((('status', 'priority', 'run_after'), False),
+               (('tile_id', 'status'), False))
+
+# Only one running job per tile
+Job.add_index(Job.tile_id, unique=True, where=SQL("status = 'running'"), name='jobs_tile_id_running')
+
+db.create_tables([Job])
\ No newline at end of file
@@ -0,0 +1,32 @@
+from peewee import Model, AutoField, FixedCharField, TextField, IntegerField, DateTimeField
+
+from .db import db
+
+
+class ProcessRun(Model):
+  '''
+    Processing run of the levels of a Tile ID and its checkpoints. See `lib.checkpoint.RunCheckpoint`.
+
+    Status is one of -
+    - running: Running or interrupted. An interrupted run is resumed from its checkpoints in `workdir`.
+    - done: Finished. Its work directory is removed.
+    - abandoned: Replaced by a run with other intervals or parameters.
+  '''
+  id = AutoField()
+  key = TextField()
+  tile_id = FixedCharField(8)
+  levels = TextField()
+  workdir = TextField()
+  status = TextField(default='running')
+  checkpoints = TextField(default='{}')
+  attempts = IntegerField(default=1)
+  created = DateTimeField()
+  updated = DateTimeField()
+
+  class Meta:
+    database = db
+    table_name = 'process_runs'
+    indexes = ((('key', 'status'), False),
+               (('tile_id', 'status'), False))
+
+db.create_tables([ProcessRun])
\ No newline at end of file
@@ -0,0 +1,30 @@
+from peewee import Model, UUIDField, FixedCharField, TextField, DateTimeField, IntegerField, BigIntegerField, \
+  FloatField
+
+from .db import db
+
+
+class RunStat(Model):
+  '''
+    Statistics of a stage of a processing run. Times and counts are summed over all the calls of the stage in the
+    run. The `run` stage holds the totals of the run and its profile if profiling was enabled.
+  '''
+  run_id = UUIDField()
+  tile_id = FixedCharField(8)
+  level = TextField()
+  stage = TextField()
+  started = DateTimeField()
+  calls = IntegerField()
+  wall_time = FloatField()
+  peak_memory = BigIntegerField(null=True)
+  bytes_downloaded = BigIntegerField()
+  bytes_uploaded = BigIntegerField()
+  blocks = IntegerField()
+  profile = TextField(null=True)
+
+  class Meta:
+    database = db
+    table_name = 'run_stats'
+    indexes = ((('tile_id', 'level', 'started'), False),)
+  
+db.create_tables([RunStat])
\ No newline at end of file
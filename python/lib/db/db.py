@@ -1,7 +1,11 @@
 import os
-from peewee import PostgresqlDatabase
+from peewee import PostgresqlDatabase, SqliteDatabase
 
-db = PostgresqlDatabase(os.environ['POSTGRES_DB'], user=os.environ['POSTGRES_USER'], password=os.environ['POSTGRES_PASSWORD'],
+# SQLite is used instead of Postgres if SQLITE_DB is set (eg offline benchmarks)
+if os.environ.get('SQLITE_DB'):
+  db = SqliteDatabase(os.environ['SQLITE_DB'], check_same_thread=False, pragmas={'journal_mode': 'wal'})
+else:
+  db = PostgresqlDatabase(os.environ['POSTGRES_DB'], user=os.environ['POSTGRES_USER'], password=os.environ['POSTGRES_PASSWORD'],
                            host=os.environ['POSTGRES_URL'], port=5432)
 
 db.connect()
\ No newline at end of file
@@ -0,0 +1,230 @@
+import os
+import time
+import random
+import requests
+from tqdm import tqdm
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+
+class DownloadError(Exception):
+  '''
+    Raised when a download fails with an error which is not retried (eg 404) or runs out of retries.
+  '''
+
+
+class Downloader():
+  '''
+    HTTP downloader for large files from a remote server (eg GLAD).
+
+    Connections are kept alive in a pooled session and the body is written in large chunks. A dropped connection is
+    resumed from the bytes already written with an HTTP Range request (`If-Range` guards against the file changing
+    in between) and retried with exponential backoff, honouring `Retry-After`. Files of at least `segment_size` from a
+    server which accepts ranges are downloaded in parallel segments, each resumed and retried on its own.
+
+    The number of connections open to a host is limited across all downloaders in the process, so parallel
+    ingestion and segments stay polite to the server.
+
+    Parameters
+    ----------
+    - auth: tuple optional - Basic auth (user, password)
+    - max_connections: int default=4 - Connections open to a host at once, shared by all downloaders of the process.
+        The limit of a host is set by the first downloader which uses it.
+    - segments: int default=4 - Parallel ranged segments of a large file. 1 disables them.
+    - segment_size: int default=64MB - Minimum size of a file and its segments to download in segments
+    - chunk_size: int default=1MB - Size of the chunks read from the connection and written to the file
+    - retries: int default=5 - Retries of a request (or segment) after a connection error or 429/5xx response
+    - backoff: float default=1 - Seconds before the first retry, doubled for every retry
+    - max_backoff: float default=60 - Maximum seconds before a retry
+    - timeout: tuple default=(10, 60) - Connect and read timeouts in seconds
+  '''
+
+  _host_limits = {}
+  _host_limits_lock = Lock()
+  _retry_status = {429, 500, 502, 503, 504}
+
+  def __init__(self, auth: tuple = None, max_connections: int = 4, segments: int = 4,
+               segment_size: int = 64 * 1024 * 1024, chunk_size: int = 1024 * 1024, retries: int = 5,
+               backoff: float = 1, max_backoff: float = 60, timeout: tuple = (10, 60)):
+    self.max_connections = max_connections
+    self.segments = segments
+    self.segment_size = segment_size
+    self.chunk_size = chunk_size
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.timeout = timeout
+
+    self._session = requests.Session()
+    self._session.auth = auth
+    # Sizes and offsets are of the file as stored
+    self._session.headers['Accept-Encoding'] = 'identity'
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections * max(segments, 1), max_retries=0)
+    self._session.mount('http://', adapter)
+    self._session.mount('https://', adapter)
+
+  def download(self, url: str, filename: str):
+    '''
+      Download a URL to `filename`. The file is written to `filename`.part and only renamed once it is complete.
+      Returns the number of bytes downloaded.
+    '''
+    part = f'{filename}.part'
+    connection = self.connection(url)
+    connection.acquire()
+    try:
+      r = self._request(url)
+      size = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+      ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+      validator = r.headers.get('ETag') or r.headers.get('Last-Modified')
+
+      with tqdm(total=size, unit='B', unit_scale=True, mininterval=10) as progress_bar:
+        if size is not None and ranges and self.segments > 1 and size >= 2 * self.segment_size:
+          # The segments take their own connections
+          r.close()
+          connection.release()
+          connection = None
+          self._download_segments(url, part, size, validator, progress_bar)
+        else:
+          self._download_stream(url, part, r, size, ranges, validator, progress_bar)
+
+    finally:
+      if connection is not None:
+        connection.release()
+
+    os.replace(part, filename)
+    return os.path.getsize(filename)
+
+  def _download_stream(self, url: str, part: str, r: requests.Response, size: int, ranges: bool, validator: str,
+                       progress_bar: tqdm):
+    '''
+      Stream the body of a response to a file. A dropped connection is resumed from the written bytes if the server
+      accepts ranges and restarted otherwise.
+    '''
+    written = 0
+    with open(part, 'wb') as f:
+      for attempt in range(self.retries + 1):
+        try:
+          if r is None:
+            r = self._request(url, start=written if ranges else 0, validator=validator)
+            if r.status_code != 206 and written > 0:
+              # The server sent the whole file eg it changed since, which may have another size
+              size = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+              validator = r.headers.get('ETag') or r.headers.get('Last-Modified')
+              progress_bar.reset(total=size)
+              written = 0
+              f.seek(0)
+              f.truncate()
+
+          with r:
+            for chunk in r.iter_content(chunk_size=self.chunk_size):
+              f.write(chunk)
+              written += len(chunk)
+              progress_bar.update(len(chunk))
+          r = None
+
+          if size is not None and written != size:
+            raise requests.exceptions.ChunkedEncodingError(f'Connection closed after {written} of {size} bytes.')
+          return
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+          r = None
+          if attempt == self.retries:
+            raise DownloadError(f'Download of {url} failed after {self.retries} retries - {e}')
+          self._wait(attempt, f'{e}. Resuming from byte {written}' if ranges else f'{e}. Restarting')
+
+  def _download_segments(self, url: str, part: str, size: int, validator: str, progress_bar: tqdm):
+    '''
+      Download a file in parallel ranged segments written to their offsets of a preallocated file.
+    '''
+    n = min(self.segments, size // self.segment_size)
+    bounds = [size * i // n for i in range(n + 1)]
+    print(f'Downloading {size} bytes in {n} segments...')
+
+    with open(part, 'wb') as f:
+      f.truncate(size)
+
+    with ThreadPoolExecutor(max_workers=n) as executor:
+      futures = [executor.submit(self._download_segment, url, part, bounds[i], bounds[i + 1], validator, progress_bar)
+                 for i in range(n)]
+      for future in futures:
+        future.result()
+
+  def _download_segment(self, url: str, part: str, start: int, end: int, validator: str, progress_bar: tqdm):
+    position = start
+    with open(part, 'r+b') as f, self.connection(url):
+      f.seek(position)
+      for attempt in range(self.retries + 1):
+        try:
+          with self._request(url, start=position, end=end - 1, validator=validator) as r:
+            if r.status_code != 206:
+              raise DownloadError(f'Server did not return the range {position}-{end - 1} of {url}. The file may '
+                                  f'have changed.')
+
+            for chunk in r.iter_content(chunk_size=self.chunk_size):
+              chunk = chunk[:end - position]
+              f.write(chunk)
+              position += len(chunk)
+              progress_bar.update(len(chunk))
+
+          if position != end:
+            raise requests.exceptions.ChunkedEncodingError(f'Segment closed at byte {position} of {start}-{end - 1}.')
+          return
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+          if attempt == self.retries:
+            raise DownloadError(f'Segment {start}-{end - 1} of {url} failed after {self.retries} retries - {e}')
+          self._wait(attempt, f'{e}. Resuming segment from byte {position}')
+
+  def _request(self, url: str, start: int = 0, end: int = None, validator: str = None):
+    '''
+      GET a URL from byte `start` (to `end`) retrying 429/5xx responses. Raises DownloadError for other errors.
+    '''
+    headers = {}
+    if start > 0 or end is not None:
+      headers['Range'] = f'bytes={start}-{end if end is not None else ""}'
+      if validator is not None:
+        headers['If-Range'] = validator
+
+    for attempt in range(self.retries + 1):
+      try:
+        r = self._session.get(url, headers=headers, stream=True, timeout=self.timeout)
+      except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        if attempt == self.retries:
+          raise DownloadError(f'Request to {url} failed after {self.retries} retries - {e}')
+        self._wait(attempt, str(e))
+        continue
+
+      if r.status_code in self._retry_status and attempt < self.retries:
+        retry_after = r.headers.get('Retry-After')
+        r.close()
+        self._wait(attempt, f'HTTP {r.status_code}', float(retry_after) if retry_after
+                   and retry_after.isdigit() else None)
+        continue
+
+      if r.status_code not in (200, 206):
+        r.close()
+        raise DownloadError(f'Request to {url} failed with HTTP {r.status_code}.')
+
+      return r
+
+  def _wait(self, attempt: int, reason: str, delay: float = None):
+    # Exponential with jitter so retries of downloads which failed together are spread out
+    if delay is None:
+      delay = min(self.backoff * 2 ** attempt, self.max_backoff) * random.uniform(0.8, 1.2)
+    print(f'{reason}. Retrying in {delay:.1f}s ({attempt + 1}/{self.retries})...')
+    time.sleep(delay)
+
+  def connection(self, url: str):
+    '''
+      Semaphore of the connections to the host of a URL, shared by all downloaders of the process. Hold it around
+      other requests to the host (eg ranged reads by GDAL) so they count towards the limit.
+    '''
+    host = urlparse(url).netloc
+    with Downloader._host_limits_lock:
+      if host not in Downloader._host_limits:
+        Downloader._host_limits[host] = BoundedSemaphore(self.max_connections)
+      return Downloader._host_limits[host]
\ No newline at end of file
@@ -1,25 +1,42 @@
 import os
 import gc
+import json
 import shutil
-import requests
 import rioxarray
 import rasterio
-import xarray as xr
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 from tqdm import tqdm
+from threading import Lock
+from multiprocessing import get_context
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from tempfile import TemporaryDirectory
 from datetime import datetime, timedelta
 from diskcache import Cache
 from boto3 import client
 from botocore.config import Config
 from botocore.exceptions import ClientError
+from rasterio.warp import transform_bounds
 
 from .db.InvalidImage import InvalidImage
 from .db.IngestParams import IngestParams
 from .db.ProcessTreecoverParams import ProcessTreecoverParams
-from .util import convert_to_cog_rio, raster_map_blocks
+from .manifest import Manifest
+from .raster_cache import RasterCache
+from .interval_calendar import IntervalCalendar
+from .tile_index import TileIndex
+from .downloader import Downloader
+from .xyz import render_tiles
+from .checkpoint import RunCheckpoint
+from .stats import run_stats, stage, add, for_level
+from .util import raster_map_blocks, S3Uploader, mask_raw_to_cog, MemoryBudget, InvalidImageError, qf_valid_mask, \
+  DaskScheduler, sample_valid_pixels, MASK_GDAL_CACHEMAX
+from .rgba import fill_series, fill_update, alpha
+from .treecover import STATE_BANDS, compute_ndvi, treecover_series, treecover_update, write_treecover, \
+  read_stack
 
 
 class GLAD():
@@ -28,7 +45,13 @@ class GLAD():
   '''
 
   _cache = Cache(__name__)
+  _calendar = None
+  _tile_index = None
   _data_cache = '.geomap'
+  # Local cache of raw images and their intermediates. Size in MB, 0 disables it.
+  _raster_cache_dir = os.environ.get('RASTER_CACHE_DIR', '.raster_cache')
+  _raster_cache_size = int(os.environ.get('RASTER_CACHE_SIZE', 10240))
+  _raster_cache_intermediates = os.environ.get('RASTER_CACHE_INTERMEDIATES', 'true').lower() == 'true'
   _base_url = "https://glad.umd.edu"
   _interval_id_url = f'{_base_url}/users/Potapov/ARD/16d_intervals.xlsx'
   _tile_geojson_url = f'{_base_url}/users/Potapov/ARD/Global_ARD_tiles.zip'
@@ -36,16 +59,35 @@ class GLAD():
   _s3_root_path = 'geomap/glad_ard2'
   _s3_public_url = os.environ['PUBLIC_S3_URL']
   _auth = ('glad', 'ardpas')
+  # Connections open to GLAD at once by a process, including the parallel segments of large images
+  _download_connections = int(os.environ.get('GLAD_MAX_CONNECTIONS', 4))
+  _download_segments = int(os.environ.get('GLAD_DOWNLOAD_SEGMENTS', 4))
+  # Screen images with a sample of their qf band before downloading them. Images are only rejected if the estimate is 
+  # below valid_image_pixels by more than _prescreen_z standard errors (one-sided ~99.5%). The ones in between are 
+  # downloaded to confirm unless not confirmed.
+  _prescreen = os.environ.get('GLAD_PRESCREEN', 'true').lower() == 'true'
+  _prescreen_blocks = 32
+  _prescreen_z = 2.58
+  # Pre-rendered XYZ tiles of the levels. Zoom range as min-max and format (png or webp).
+  _xyz_zooms = tuple(int(z) for z in os.environ.get('XYZ_ZOOMS', '6-12').split('-'))
+  _xyz_format = os.environ.get('XYZ_FORMAT', 'png')
+  _xyz_upload_workers = 16
   _valid_image_pixels = 0.7
+  _treecover_max_changed = 0.05
+  _state_min_intervals = {'rgba': 1, 'treecover': 3}
   
   def __init__(self):
-    self.get_interval_table()
-    self.get_tile_geojson()
+    # The interval calendar and tile geojson are loaded on first use
     self._s3_bucket = os.environ['S3_URL'].split('/')[-1]
     self._s3 = client('s3', aws_access_key_id=os.environ['S3_ACCESS_KEY'],
                       aws_secret_access_key=os.environ['S3_SECRET_KEY'],
                       endpoint_url=os.environ['S3_URL'][:-len(self._s3_bucket)-1],
-                      config=Config(signature_version = 'v4'))
+                      config=Config(signature_version = 'v4',
+                                    max_pool_connections=max(10, Manifest._list_workers)))
+    self._manifest = Manifest(self._s3, self._s3_bucket, self._s3_root_path)
+    self._raster_cache = RasterCache(self._s3, self._s3_bucket, self._raster_cache_dir, self._raster_cache_size)
+    self._downloader = Downloader(auth=self._auth, max_connections=self._download_connections, 
+                                  segments=self._download_segments)
 
   def get_interval_table(self):
     '''
@@ -76,6 +118,17 @@ class GLAD():
       self._interval_dates = self._cache.get('interval_dates')
                                             
     return self._interval_table, self._interval_dates
+
+  def get_calendar(self):
+    '''
+      Get the interval calendar for id <-> date lookups. Built from the interval table once and cached compactly.
+    '''
+    if GLAD._calendar is None:
+      if not 'interval_calendar' in self._cache:
+        self._cache.set('interval_calendar', IntervalCalendar.from_tables(*self.get_interval_table()))
+      GLAD._calendar = self._cache.get('interval_calendar')
+
+    return GLAD._calendar
   
   def get_tile_geojson(self):
     '''
@@ -91,6 +144,15 @@ class GLAD():
       self._tile_geojson = self._cache.get('tile_geojson')
                                             
     return self._tile_geojson
+
+  def get_tile_index(self):
+    '''
+      Get the spatial index of the tile grid for bbox and point queries. Built once per process.
+    '''
+    if GLAD._tile_index is None:
+      GLAD._tile_index = TileIndex(self.get_tile_geojson())
+
+    return GLAD._tile_index
   
   def get_valid_ids(self, tile_id: str = None):
     '''
@@ -101,13 +163,8 @@ class GLAD():
     - tile_id str: Tile ID in the format '054W_03S'. If provided then invalid IDs from db will be filtered out.
                    Invalid ID could be corrupted image or lots of cloud etc.
     '''
-    interval_table, interval_dates = self.get_interval_table()
-
     today = datetime.now() - timedelta(days=self._days_before_update)
-
-    interval_table = interval_table[interval_dates < today]
-    ids = interval_table.to_numpy().flatten()
-    ids = ids[~(np.isnan(ids))].astype(int).tolist()
+    ids = self.get_calendar().ids_before(today).tolist()
     
     if tile_id is not None:
       # Delete any invalid IDs config which may have been skipped due to a higher valid_image_pixels value earlier
@@ -128,19 +185,109 @@ class GLAD():
   def get_image_base_url(self):
     return f'{self._s3_public_url}/{self._s3_root_path}'
   
-  def process_image_raw(self, tile_id: str, interval_id: int, retry: bool = False):
+  def process_image_raw(self, tile_id: str, interval_id: int, retry: bool = False, confirm_borderline: bool = True):
     '''
       Get the image for a Tile ID and Interval ID.
+      Images which are too cloudy are rejected from a sample of their qf band before they are downloaded.
 
       Parameters
       ----------
       - tile_id: str - Tile ID in the format '054W_03S'
       - interval_id: int - Interval ID
       - retry: bool optional -  Retry processing if previously failed
+      - confirm_borderline: bool default=True - Download images whose sampled valid pixels are just below the
+          threshold to check the full qf band. Otherwise they are rejected from the sample.
     '''
-    lat = tile_id.split('_')[1]
-    s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/raw.tif'
+    valid_image_pixels = self._get_valid_image_pixels(tile_id, interval_id, retry)
+    if self._image_raw_exists(tile_id, interval_id):
+      return
+
+    with run_stats(tile_id, 'raw'), self.deferred_index(), TemporaryDirectory() as tdir:
+      self._prescreen_image_raw(tile_id, interval_id, valid_image_pixels, confirm_borderline)
+      with stage('download'):
+        tmp_file_tif = self._download_image_raw(tile_id, interval_id, tdir)
+      add('download', bytes_downloaded=os.path.getsize(tmp_file_tif))
+      self._ingest_image_raw(tile_id, interval_id, tmp_file_tif, valid_image_pixels)
+
+  def process_images_raw(self, tile_id: str, interval_ids: list, io_workers: int = 4, cpu_workers: int = 2,
+                         memory_limit: int = 4096, retry: bool = False, confirm_borderline: bool = True):
+    '''
+      Ingest images for a Tile ID in parallel. Downloads and uploads run in a thread pool while masking and
+      COG conversion run in a process pool. Each interval fails on its own without stopping the others.
+
+      Parameters
+      ----------
+      - tile_id: str - Tile ID in the format '054W_03S'
+      - interval_ids: list - Interval IDs to ingest
+      - io_workers: int default=4 - Threads for downloads/uploads (intervals in flight)
+      - cpu_workers: int default=2 - Processes for masking and COG conversion
+      - memory_limit: int default=4096 - Memory budget in MB for images being masked and converted
+      - retry: bool optional - Retry processing if previously failed
+      - confirm_borderline: bool default=True - Download images whose sampled valid pixels are just below the
+          threshold to check the full qf band (see `process_image_raw`)
 
+      Returns a dict of interval ID to error message for the failed intervals.
+    '''
+    def start_pool():
+      # Worker processes are forked from a forkserver rather than this process, which runs I/O and stats threads, so
+      # a (re)started worker never inherits a lock held by one of them (eg GDAL, boto3, logging). The server imports
+      # the masking module once so starting a worker is cheap. Scripts must guard their main module as it is imported
+      # by the workers.
+      context = get_context('forkserver')
+      context.set_forkserver_preload([mask_raw_to_cog.__module__])
+      return ProcessPoolExecutor(max_workers=cpu_workers, mp_context=context)
+
+    budget = MemoryBudget(memory_limit * 1024 * 1024)
+    pool_lock = Lock()
+    pool = [start_pool()]
+
+    def submit(*args):
+      with pool_lock:
+        return pool[0].submit(mask_raw_to_cog, *args)
+
+    def restart_pool(broken):
+      with pool_lock:
+        if pool[0] is broken:
+          print('Process pool crashed. Restarting...')
+          pool[0] = start_pool()
+
+    def ingest(interval_id):
+      valid_image_pixels = self._get_valid_image_pixels(tile_id, interval_id, retry)
+      if self._image_raw_exists(tile_id, interval_id):
+        return
+
+      self._prescreen_image_raw(tile_id, interval_id, valid_image_pixels, confirm_borderline)
+      with TemporaryDirectory() as tdir:
+        with stage('download'):
+          tmp_file_tif = self._download_image_raw(tile_id, interval_id, tdir)
+        add('download', bytes_downloaded=os.path.getsize(tmp_file_tif))
+        with budget.reserve(self._estimate_image_memory(tmp_file_tif)):
+          current_pool = pool[0]
+          try:
+            self._ingest_image_raw(tile_id, interval_id, tmp_file_tif, valid_image_pixels, submit=submit)
+          except BrokenProcessPool:
+            restart_pool(current_pool)
+            raise
+
+    errors = {}
+    try:
+      with run_stats(tile_id, 'raw'), self.deferred_index(), ThreadPoolExecutor(max_workers=io_workers) as executor:
+        futures = {executor.submit(ingest, interval_id): interval_id for interval_id in interval_ids}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+          try:
+            future.result()
+          except Exception as e:
+            errors[futures[future]] = str(e)
+            print(f'Interval {tile_id}:{futures[future]} failed with error - {e}')
+    finally:
+      pool[0].shutdown()
+
+    return errors
+
+  def _get_valid_image_pixels(self, tile_id: str, interval_id: int, retry: bool = False):
+    '''
+      Check the image is not marked invalid and get the valid_image_pixels parameter for the Tile ID.
+    '''
     # Corrupted or cloudy image
     q = InvalidImage.select().where(InvalidImage.tile_id == tile_id, 
                                     InvalidImage.interval_id == interval_id)
@@ -159,161 +306,481 @@ class GLAD():
       valid_image_pixels = self._valid_image_pixels
 
     print('Parameter valid_image_pixels:', valid_image_pixels)
+    return valid_image_pixels
+
+  def _image_raw_exists(self, tile_id: str, interval_id: int):
+    if self._manifest.has_image(tile_id, interval_id, 'raw'):
+      return True
+
+    s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/raw.tif'
+    print(f'Image {tile_id}:{interval_id} not found in S3 ({s3_key}). Downloading from GLAD...')
+    return False
+
+  def _image_raw_url(self, tile_id: str, interval_id: int):
+    lat = tile_id.split('_')[1]
+    return f'{self._base_url}/dataset/glad_ard2/{lat}/{tile_id}/{interval_id}.tif'
 
+  def _prescreen_image_raw(self, tile_id: str, interval_id: int, valid_image_pixels: float, 
+                           confirm_borderline: bool = True):
+    '''
+      Estimate the valid pixels of an image on GLAD from a sample of blocks of its qf band read with ranged requests.
+      InvalidImageError is raised without downloading images which clearly fail `valid_image_pixels`. It is not 
+      recorded as InvalidImage as the sample can be wrong, so the image is screened again by the next run and only
+      the full ingest records it. The full download goes ahead if the image can't be sampled.
+    '''
+    if not self._prescreen:
+      return
+
+    url = self._image_raw_url(tile_id, interval_id)
+    print(f'Sampling qf band of {url} ...')
     try:
-      self._s3.get_object(Bucket=self._s3_bucket, Key=s3_key)
-    
-    except ClientError as e:
-      error_code = e.response['Error']['Code']
-      if error_code != 'NoSuchKey':
-        raise e
-      
-      print(f'Image {tile_id}:{interval_id} not found in S3 ({s3_key}). Downloading from GLAD...')
-      url = f'{self._base_url}/dataset/glad_ard2/{lat}/{tile_id}/{interval_id}.tif'
+      with stage('prescreen'), self._downloader.connection(url), \
+           rasterio.Env(GDAL_HTTP_USERPWD=':'.join(self._auth), GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
+                        GDAL_HTTP_CONNECTTIMEOUT=10, GDAL_HTTP_TIMEOUT=60, GDAL_HTTP_MAX_RETRY=3, 
+                        GDAL_HTTP_RETRY_DELAY=1), rasterio.open(url) as src:
+        valid_pixel_percentage, standard_error, pixels = sample_valid_pixels(src, self._prescreen_blocks)
+    except Exception as e:
+      print(f'Could not sample the image. Downloading it - {e}')
+      return
+
+    # Borderline images are below the threshold but within the confidence bound of the estimate. They are downloaded
+    # to confirm, or rejected from the estimate if not confirmed.
+    bound = self._prescreen_z * standard_error if confirm_borderline else 0
+    if valid_pixel_percentage + bound >= valid_image_pixels:
+      print(f'Estimated valid pixels from {pixels} sampled pixels: {valid_pixel_percentage} '
+            f'(standard error {standard_error})')
+      return
+
+    reason = (f'Estimated valid pixels in image from {pixels} sampled pixels are below threshold: '
+              f'{valid_pixel_percentage} (standard error {standard_error})')
+    print(f'Error in processing image - {reason}')
+    raise InvalidImageError(reason, valid_pixel_percentage)
+
+  def _download_image_raw(self, tile_id: str, interval_id: int, tdir: str):
+    '''
+      Download the raw image from GLAD into `tdir`. Returns the downloaded file path.
+    '''
+    url = self._image_raw_url(tile_id, interval_id)
       
-      # Download the image
-      print(f'Downloading {url} ...')
-      with TemporaryDirectory() as tdir:
-        r = requests.get(url, auth=self._auth, stream=True)
-        total_size = int(r.headers.get("content-length", 0))
-        tmp_file_tif = os.path.join(tdir, 'temp.tif')
-        with tqdm(total=total_size, unit="B", unit_scale=True, mininterval=10) as progress_bar:
-          with open(tmp_file_tif, 'wb') as f:
-            for bits in r.iter_content(chunk_size=8192):
-              f.write(bits)
-              progress_bar.update(len(bits))
-
-        # Check for valid image
-        invalid_image_reason = ''
-
-        try:
-          valid_pixel_percentage = 0
-          with rasterio.open(tmp_file_tif, 'r+') as dataset:
-            # Add a mask where band 8 is value 1 or 15
-            # https://glad.umd.edu/Potapov/ARD/ARD_manual_v1.1.pdf pg 21
-            qf = dataset.read(8)
-            mask = np.logical_or(qf == 1, qf == 15) 
-            valid_pixel_percentage = mask.sum() / mask.size
-            if valid_pixel_percentage < valid_image_pixels:
-              raise Exception(f'Valid pixels in image are below threshold: {valid_pixel_percentage}')
-            else:
-              print(f'Valid pixels in image are above threshold: {valid_pixel_percentage}')
-            dataset.nodata = 0
-            for i in range(1, dataset.count + 1):
-              band = dataset.read(i)
-              band = np.where(mask, band, 0)
-              dataset.write(band, i)
-
-          tmp_file_cog = tmp_file_tif.replace('.tif', '.cog.tif')
-          convert_to_cog_rio(tmp_file_tif, tmp_file_cog)
-
-          # Upload to S3
-          print(f'Uploading {tile_id}:{interval_id} to S3 ({s3_key}).')
-          self._s3.upload_file(tmp_file_cog, self._s3_bucket, s3_key)
-          print(f'Image {tile_id}:{interval_id} uploaded to S3.')
-
-        except Exception as e:
-          invalid_image_reason = str(e) 
-          print(f'Error in processing image - {invalid_image_reason}')
-          InvalidImage.create(tile_id=tile_id, interval_id=interval_id, 
-                              reason=invalid_image_reason, valid_pixel_percentage=valid_pixel_percentage)
-          raise e
-        
-        finally:
-          gc.collect()
+    # Download the image. Dropped connections are resumed and retried, and large images are downloaded in segments.
+    print(f'Downloading {url} ...')
+    tmp_file_tif = os.path.join(tdir, 'temp.tif')
+    self._downloader.download(url, tmp_file_tif)
+
+    return tmp_file_tif
+
+  def _estimate_image_memory(self, tif: str):
+    '''
+      Estimate the peak memory in bytes to mask and convert a raw image to COG.
+    '''
+    with rasterio.open(tif) as src:
+      pixel_bytes = src.count * np.dtype(src.dtypes[0]).itemsize
+      # Masking is streamed in blocks so this is the GDAL block cache, which is filled up to the image size but no more
+      # than MASK_GDAL_CACHEMAX, and the block being masked with its copies (read, written, mask & nodata checks)
+      block_bytes = 512 * 512 * (2 * pixel_bytes + src.count + 2)
+      return min(src.width * src.height * pixel_bytes, MASK_GDAL_CACHEMAX) + block_bytes
+
+  def _ingest_image_raw(self, tile_id: str, interval_id: int, tmp_file_tif: str, valid_image_pixels: float, 
+                        submit: callable = None):
+    '''
+      Mask and convert the downloaded raw image to COG and upload it to S3. Failures of the image (eg too few valid 
+      pixels, corrupt) are recorded as InvalidImage. Failures to upload or record it (eg S3 or the manifest is 
+      unavailable) are not and are raised, so the image is ingested again by the next run.
+
+      Parameters
+      ----------
+      - submit: callable optional - Submit function of an executor to run the masking and COG conversion in
+    '''
+    tmp_file_cog = tmp_file_tif.replace('.tif', '.cog.tif')
+    # Submitted before the image is processed as failing to submit (eg to start a worker process) is not an image problem
+    future = submit(tmp_file_tif, tmp_file_cog, valid_image_pixels) if submit is not None else None
+
+    try:
+      valid_pixel_percentage = 0
+      if future is None:
+        valid_pixel_percentage, timings = mask_raw_to_cog(tmp_file_tif, tmp_file_cog, valid_image_pixels)
+      else:
+        valid_pixel_percentage, timings = future.result()
+      add('mask', wall_time=timings['mask'], calls=1)
+      add('cog', wall_time=timings['cog'], calls=1)
+
+    except BrokenProcessPool:
+      # Worker process died (eg OOM). Not an image problem so not recorded.
+      raise
+
+    except Exception as e:
+      if isinstance(e, InvalidImageError):
+        valid_pixel_percentage = e.valid_pixel_percentage
+      invalid_image_reason = str(e) 
+      print(f'Error in processing image - {invalid_image_reason}')
+      InvalidImage.create(tile_id=tile_id, interval_id=interval_id, 
+                          reason=invalid_image_reason, valid_pixel_percentage=valid_pixel_percentage)
+      raise e
+    
+    finally:
+      gc.collect()
+
+    # Upload to S3. The image is only in the manifest once this completes.
+    self._upload_image(tmp_file_cog, tile_id, interval_id, 'raw')
   
-  def process_images_rgba(self, tile_id: str):
+  def process_images(self, tile_id: str, levels: list = None, incremental: bool = False, 
+                     scheduler: DaskScheduler = None, ndvi_diff_cut_trees: float = 0.25, 
+                     ndvi_tree_lower_bound: float = 0.7, xyz: bool = False):
+    '''
+      Process levels derived from the raw images for a Tile ID in one run. Each raw image is downloaded and decoded
+      once and the intermediate of every level (eg RGBA, NDVI) is extracted from the same bands. The stacks of 
+      intermediates are then processed along time level by level on the same scheduler.
+      To add a level, add it to `_derived_levels` with a function to extract its intermediate and one to process them.
+      The run is checkpointed (see `RunCheckpoint`): a run interrupted eg by an OOM or a network error is resumed by the
+      next run with the same intervals and parameters, which skips the intermediates, blocks, uploads and levels 
+      already completed.
+
+      Parameters
+      ----------
+      - tile_id: str - Tile ID
+      - levels: list optional - Levels to process. Defaults to all derived levels ['rgba', 'treecover'].
+      - incremental: bool default=False - Only process the intervals added since the last run of each level. Falls 
+          back to a full rebuild if there is no saved state, the parameters changed or the earlier intervals changed.
+      - scheduler: DaskScheduler optional - Scheduler for the block tasks. Defaults to threads on all CPUs.
+      - ndvi_diff_cut_trees: float default=0.25 - The difference in NDVI for a tree which has been cut
+      - ndvi_tree_lower_bound: float default=0.7 - Lower bound of what a tree's NDVI would be in a dense forest
+      - xyz: bool default=False - Also render the XYZ tiles of the new and changed images (see `render_images_xyz`)
+    '''
+    derived_levels = self._derived_levels()
+    levels = levels or list(derived_levels.keys())
+    for level in levels:
+      if level not in derived_levels:
+        raise Exception(f'Unsupported level {level}.')
+
+    params = {'rgba': {}}
+    if 'treecover' in levels:
+      params['treecover'] = self._get_treecover_params(tile_id, ndvi_diff_cut_trees, ndvi_tree_lower_bound)
+
+    ids = self.list_images(tile_id)
+
+    inputs = {'interval_ids': ids, 'params': params, 'incremental': incremental}
+    with run_stats(tile_id, '+'.join(levels)), self.deferred_index(), \
+         RunCheckpoint(tile_id, levels, inputs) as checkpoint:
+      pending = [level for level in levels if not checkpoint.done(f'level:{level}')]
+
+      # Levels with a state only need the intervals added since. A level whose stack is built needs none.
+      states = {level: self._get_state(tile_id, level, ids, params[level]) if incremental else None 
+                for level in pending}
+      needed = {level: [] if checkpoint.done(f'stack:{level}') else 
+                       ids[len(states[level]['interval_ids']):] if states[level] is not None else ids 
+                for level in pending}
+
+      intermediates = self._extract_intermediates(tile_id, needed, checkpoint)
+
+      for level in pending:
+        _, process = derived_levels[level]
+        with for_level(level):
+          process(tile_id, ids, intermediates[level], checkpoint.workdir, states[level], scheduler, checkpoint, 
+                  **params[level])
+          if xyz:
+            self.render_images_xyz(tile_id, [level])
+        checkpoint.mark(f'level:{level}')
+
+  def process_images_rgba(self, tile_id: str, incremental: bool = False, scheduler: DaskScheduler = None, 
+                          xyz: bool = False):
     '''
       Process the rgba images for a Tile ID.
       This involves extracting the RGB bands and running forward fill and back fill 
       on the stack to impute missing values.
+      The last valid RGB values are saved per tile in S3 so the fill can be continued incrementally with new intervals.
+
+      Parameters
+      ----------
+      - tile_id: str - Tile ID
+      - incremental: bool default=False - Only process the intervals added since the last run. Falls back to a full
+          rebuild if there is no saved state or the earlier intervals changed.
+      - scheduler: DaskScheduler optional - Scheduler for the block tasks. Defaults to threads on all CPUs.
+      - xyz: bool default=False - Also render the XYZ tiles of the new and changed images
     '''
-    ids = self.list_images(tile_id)
+    self.process_images(tile_id, ['rgba'], incremental=incremental, scheduler=scheduler, xyz=xyz)
 
-    print(f'Processing RGBA images for Tile ID {tile_id}...')
-    with TemporaryDirectory() as tdir:
-      # Download stack of images
-      for interval_id in tqdm(ids):
-        s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/raw.tif'
-        raw_tif = os.path.join(tdir, f'{interval_id}-raw.tif')
-        rgba_tif = os.path.join(tdir, f'{interval_id}-rgba.tif')
-        
-        print(f'Downloading {s3_key} to {raw_tif}...')
-        self._s3.download_file(Bucket=self._s3_bucket, Key=s3_key, Filename=raw_tif)
-
-        print(f'Extracting RGB bands...')
-        with rasterio.open(raw_tif, mode='r') as src:
-          # red, green, blue, qf
-          rgba = src.read([3, 2, 1, 8])
-          for i in range(3):
-            rgba[i] = (rgba[i] - rgba[i].min()) / (rgba[i].max() - rgba[i].min()) * 255
-          rgba = rgba.astype(np.uint8)
+  def process_images_treecover(self, tile_id: str, ndvi_diff_cut_trees: float = 0.25, ndvi_tree_lower_bound: float = 0.7,
+                               incremental: bool = False, scheduler: DaskScheduler = None, xyz: bool = False):
+    '''
+      Process the treecover images for a Tile ID.
+      This involves computing the NDVI (NIR-RED)/(NIR+RED) to do a timeseries analysis for tree cover. 
+      NaN vaues are imputed by running forward fill and back fill on the stack.
+      The state of the timeseries is saved per tile in S3 so it can be continued incrementally with new intervals.
+
+      Parameters
+      ----------
+      - tile_id: str - Tile ID
+      - ndvi_diff_cut_trees: float default=0.25 - The difference in NDVI for a tree which has been cut
+      - ndvi_tree_lower_bound: float default=0.7 - Lower bound of what a tree's NDVI would be in a dense forest
+      - incremental: bool default=False - Only process the intervals added since the last run. Falls back to a full
+          rebuild if there is no saved state, the parameters changed or the earlier intervals changed.
+      - scheduler: DaskScheduler optional - Scheduler for the block tasks. Defaults to threads on all CPUs.
+      - xyz: bool default=False - Also render the XYZ tiles of the new and changed images
+    '''
+    self.process_images(tile_id, ['treecover'], incremental=incremental, scheduler=scheduler, 
+                        ndvi_diff_cut_trees=ndvi_diff_cut_trees, ndvi_tree_lower_bound=ndvi_tree_lower_bound, xyz=xyz)
+
+  def _derived_levels(self):
+    '''
+      Levels derived from the raw images as {level: (extract, process)}
+      - extract(read) -> np.ndarray: Intermediate (band, y, x) of a raw image. `read(band)` returns a decoded band
+          which is shared between levels.
+      - process(tile_id, ids, intermediates, tdir, state, scheduler, checkpoint, **params): Process the stack of 
+          intermediates {interval_id: tif}. `state` is the saved state to continue from or None for a full rebuild.
+          Outputs are only uploaded once they are complete and the stages completed are marked on `checkpoint`.
+    '''
+    return {'rgba': (self._extract_rgba, self._process_rgba),
+            'treecover': (self._extract_ndvi, self._process_treecover)}
+
+  def _extract_intermediates(self, tile_id: str, needed: dict, checkpoint: RunCheckpoint):
+    '''
+      Download each raw image needed by any level once and extract the intermediates of the levels which need it.
+      Raw images and intermediates are read from the local raster cache if they were processed on this node before.
+      Intermediates are written to the work directory of the run and skipped if an interrupted run extracted them.
+      `needed` is {level: interval_ids}. Returns {level: {interval_id: tif}}.
+    '''
+    derived_levels = self._derived_levels()
+    tdir = checkpoint.workdir
+    intermediates = {level: {} for level in needed}
+    interval_ids = sorted(set(id for ids in needed.values() for id in ids))
+
+    for interval_id in tqdm(interval_ids):
+      s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/raw.tif'
+      raw_tif = os.path.join(tdir, f'{interval_id}-raw.tif')
+      # The ETag is only needed to key the cache
+      etag = self._raster_cache.etag(s3_key) if self._raster_cache.enabled else None
+
+      levels = []
+      for level, ids in needed.items():
+        if interval_id not in ids:
+          continue
+
+        intermediate_tif = os.path.join(tdir, f'{interval_id}-{level}-intermediate.tif')
+        if checkpoint.done(f'intermediate:{level}:{interval_id}', intermediate_tif):
+          intermediates[level][interval_id] = intermediate_tif
+        elif self._raster_cache_intermediates and self._raster_cache.get((s3_key, etag, level), intermediate_tif):
+          print(f'Using cached {level} intermediate...')
+          intermediates[level][interval_id] = intermediate_tif
+          checkpoint.mark(f'intermediate:{level}:{interval_id}')
+        else:
+          levels.append(level)
+
+      if len(levels) == 0:
+        continue
+
+      self._raster_cache.download_file(s3_key, raw_tif, etag=etag)
+
+      with rasterio.open(raw_tif, mode='r') as src:
+        bands = {}
+        def read(band):
+          if band not in bands:
+            bands[band] = src.read(band)
+          return bands[band]
+
+        for level in levels:
+          print(f'Extracting {level} intermediate...')
+          extract, _ = derived_levels[level]
+          intermediate_tif = os.path.join(tdir, f'{interval_id}-{level}-intermediate.tif')
+          with stage('extract', level):
+            intermediate = extract(read)
+
+            new_meta = src.meta.copy()
+            new_meta['count'] = intermediate.shape[0]
+            new_meta['dtype'] = intermediate.dtype.name
+
+            with rasterio.open(intermediate_tif, 'w', **new_meta) as dst:
+              dst.write(intermediate)
+          intermediates[level][interval_id] = intermediate_tif
+          checkpoint.mark(f'intermediate:{level}:{interval_id}')
+
+          if self._raster_cache_intermediates:
+            self._raster_cache.put((s3_key, etag, level), intermediate_tif)
+
+          del intermediate
+
+      os.remove(raw_tif)
+
+      # The bands are kept by `read`, so they are freed by emptying the dict rather than deleting its name
+      bands.clear()
+      gc.collect()
+
+    return intermediates
+
+  def _get_state(self, tile_id: str, level: str, ids: list, params: dict):
+    '''
+      Get the saved state of a level if it can be continued with the current intervals and parameters.
+    '''
+    state = self._get_state_meta(tile_id, level)
+    if state is None:
+      print(f'No {level} state found. Running a full rebuild...')
+      return None
     
-          qf = src.read(8)
-          mask = np.logical_or(qf == 1, qf == 15) 
-          rgba[3] = np.where(mask, 255, 0)
+    if {key: state.get(key) for key in params} != params:
+      print(f'{level} parameters changed. Running a full rebuild...')
+      return None
     
-          new_meta = src.meta.copy()
-          new_meta['count'] = 4
-          new_meta['dtype'] = 'uint8'
+    processed_ids = state['interval_ids']
+    if ids[:len(processed_ids)] != processed_ids or len(processed_ids) < self._state_min_intervals[level]:
+      print(f'Processed {level} intervals changed. Running a full rebuild...')
+      return None
 
-          with rasterio.open(rgba_tif, 'w', **new_meta) as dst:
-            dst.write(rgba)
-          
-          os.remove(raw_tif)
+    return state
 
-        del rgba, qf, mask, new_meta
-        gc.collect()
+  def _extract_rgba(self, read: callable):
+    # red, green, blue, qf
+    rgba = np.stack([read(3), read(2), read(1), read(8)])
+    for i in range(3):
+      rgba[i] = (rgba[i] - rgba[i].min()) / (rgba[i].max() - rgba[i].min()) * 255
+    rgba = rgba.astype(np.uint8)
 
-      print(f'\nStacking and running ffill and bfill...')
-      rgba_tifs = [os.path.join(tdir, f'{interval_id}-rgba.tif') for interval_id in ids]
-      filled_tifs = [os.path.join(tdir, f'{interval_id}-filled.tif') for interval_id in ids]
+    mask = qf_valid_mask(read(8))
+    rgba[3] = np.where(mask, 255, 0)
     
-      no_data_value = 0
-      # Impute missing values along stack with ffill and bfill
+    return rgba
+
+  def _extract_ndvi(self, read: callable):
+    # red, nir, qf
+    return np.expand_dims(compute_ndvi(read(3), read(4), read(8)), axis=0)
+
+  def _process_rgba(self, tile_id: str, ids: list, intermediates: dict, tdir: str, state: dict, 
+                    scheduler: DaskScheduler, checkpoint: RunCheckpoint):
+    if state is not None:
+      self._process_rgba_incremental(tile_id, ids, intermediates, tdir, state, checkpoint)
+      return
+
+    if checkpoint.done('state:rgba'):
+      print('RGBA already processed.')
+      return
+
+    print(f'Processing RGBA images for Tile ID {tile_id}...')
+    filled_tifs = [os.path.join(tdir, f'{interval_id}-filled.tif') for interval_id in ids]
+    state_tif = os.path.join(tdir, 'rgba-state.tif')
+
+    if checkpoint.done('stack:rgba', state_tif):
+      print('RGBA stack already built.')
+    else:
+      rgba_tifs = [intermediates[interval_id] for interval_id in ids]
+
+      print(f'\nStacking and running ffill and bfill...')
+      # Impute missing values along stack with ffill and bfill on the uint8 data. Block shape is (dim=time, band, y, x)
       def fill_stack(block, dim):
-        original_dtype = block.dtype
-        masked_block = block.where(block != no_data_value, np.nan)
-        filled_block = masked_block.ffill(dim=dim).bfill(dim=dim)
-        block = filled_block.where(~np.isnan(filled_block), no_data_value)
-        block = block.astype(original_dtype)
-      
-        return block
+        return fill_series(block.values)
     
-      raster_map_blocks(rgba_tifs, filled_tifs, block_size=500, fn_map_blocks=fill_stack,
-                        no_data_value=no_data_value, last_band_mask=(0, 255))
+      raster_map_blocks(rgba_tifs, filled_tifs, block_size=500, fn_map_blocks=fill_stack, scheduler=scheduler,
+                        progress=checkpoint.blocks('stack:rgba'))
+
+      # The last filled image holds the last valid RGB values (0 where never valid)
+      with rasterio.open(filled_tifs[-1]) as src:
+        state_meta = src.profile.copy()
+        state_meta['count'] = 3
+        with rasterio.open(state_tif, 'w', **state_meta) as dst:
+          dst.write(src.read([1, 2, 3]))
+      checkpoint.mark('stack:rgba')
 
       for rgba_tif in rgba_tifs:
         os.remove(rgba_tif)
 
-      # Convert to COGS and upload to S3
-      for interval_id in tqdm(ids):
-        s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/rgba.tif'
-        filled_tif = os.path.join(tdir, f'{interval_id}-filled.tif')
-        tmp_file_cog = filled_tif.replace('.tif', '.cog.tif')
-        convert_to_cog_rio(filled_tif, tmp_file_cog, add_mask=False)
-        os.remove(filled_tif)
-        
-        # Upload to S3
-        print(f'Uploading {tile_id}:{interval_id} to S3 ({s3_key}).')
-        self._s3.upload_file(tmp_file_cog, self._s3_bucket, s3_key)
-        print(f'Image {tile_id}:{interval_id} uploaded to S3.')
-        os.remove(tmp_file_cog)
+    # Convert to COGS and stream to S3. Uploads overlap with converting the next interval.
+    with S3Uploader(self._s3, self._s3_bucket) as uploader:
+      self._upload_cogs(uploader, tile_id, ids, filled_tifs, 'rgba', checkpoint)
 
-        gc.collect()
+    # State is saved last so an interrupted run is processed again. It is marked before the file is removed so a run
+    # interrupted in between doesn't need the stack again.
+    self._upload_state(tile_id, 'rgba', state_tif, ids)
+    checkpoint.mark('state:rgba')
+    os.remove(state_tif)
 
-  def process_images_treecover(self, tile_id: str, ndvi_diff_cut_trees: float = 0.25, ndvi_tree_lower_bound: float = 0.7):
+  def _process_rgba_incremental(self, tile_id: str, ids: list, intermediates: dict, tdir: str, state: dict,
+                                checkpoint: RunCheckpoint):
     '''
-      Process the treecover images for a Tile ID.
-      This involves computing the NDVI (NIR-RED)/(NIR+RED) to do a timeseries analysis for tree cover. 
-      NaN vaues are imputed by running forward fill and back fill on the stack.
-
-      Parameters
-      ----------
-      - tile_id: str - Tile ID
-      - ndvi_diff_cut_trees: float default=0.25 - The difference in NDVI for a tree which has been cut
-      - ndvi_tree_lower_bound: float default=0.7 - Lower bound of what a tree's NDVI would be in a dense forest
+      Continue the RGBA forward fill of a Tile ID from its last valid RGB values with the intervals added since.
+      Earlier outputs are only rewritten if pixels which were never valid get back filled by the new intervals.
+      A resumed run computes the new intervals again, which is deterministic, and skips the uploads already done.
     '''
+    processed_ids = state['interval_ids']
+    new_ids = ids[len(processed_ids):]
+    if len(new_ids) == 0:
+      print(f'RGBA for Tile ID {tile_id} is up to date.')
+      return
+
+    print(f'Processing {len(new_ids)} new RGBA images for Tile ID {tile_id}...')
+    state_tif = os.path.join(tdir, 'rgba-saved-state.tif')
+    self._s3.download_file(Bucket=self._s3_bucket, Key=self._state_key(tile_id, 'rgba', 'tif'), Filename=state_tif)
+    rgba_tifs = [intermediates[interval_id] for interval_id in new_ids]
+    filled_tifs = [os.path.join(tdir, f'{interval_id}-filled.tif') for interval_id in new_ids]
+
+    with rasterio.open(state_tif) as src:
+      state_meta = src.profile.copy()
+      windows = [window for _, window in src.block_windows(1)]
+    with rasterio.open(rgba_tifs[0]) as src:
+      new_meta = src.meta.copy()
+      new_meta.update(tiled=True, blockxsize=state_meta['blockxsize'], blockysize=state_meta['blockysize'])
+
+    for filled_tif in filled_tifs:
+      with rasterio.open(filled_tif, 'w', **new_meta):
+        pass
+
+    print(f'\nContinuing ffill...')
+    patches = {}
+    with stage('map_blocks'), rasterio.open(state_tif, 'r+') as state_dst:
+      for window in tqdm(windows):
+        last = state_dst.read(window=window).reshape(3, -1)
+        rgba = []
+        for rgba_tif in rgba_tifs:
+          with rasterio.open(rgba_tif) as src:
+            rgba.append(src.read(window=window).reshape(4, -1))
+        
+        filled, last, first_valid = fill_update(np.stack(rgba), last)
+        state_dst.write(last.reshape(3, window.height, window.width), window=window)
+        for i, filled_tif in enumerate(filled_tifs):
+          with rasterio.open(filled_tif, 'r+') as dst:
+            dst.write(filled[i].reshape(4, window.height, window.width), window=window)
+
+        if first_valid.any():
+          patches[window] = first_valid
+    add('map_blocks', blocks=len(windows))
+
+    # The intermediates are kept in the work directory until the run is done so a resumed run can compute them again
+    with S3Uploader(self._s3, self._s3_bucket) as uploader:
+      self._upload_cogs(uploader, tile_id, new_ids, filled_tifs, 'rgba', checkpoint)
+      uploader.wait()
+
+      # Pixels which were never valid are missing in every earlier image, so all of them are back filled
+      if len(patches) > 0:
+        print(f'\nBack filling {len(processed_ids)} earlier RGBA images...')
+      with stage('patch'):
+        for interval_id in tqdm(processed_ids if len(patches) > 0 else []):
+          if checkpoint.done(f'patch:rgba:{interval_id}'):
+            continue
+
+          rgba_tif = os.path.join(tdir, f'{interval_id}-rgba.tif')
+          s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/rgba.tif'
+          self._s3.download_file(Bucket=self._s3_bucket, Key=s3_key, Filename=rgba_tif)
+          with rasterio.open(rgba_tif) as src:
+            rgba = src.read()
+            meta = src.meta.copy()
+          for window, first_valid in patches.items():
+            block = rgba[(slice(None), *window.toslices())].reshape(4, -1)
+            block[:3] = np.where(block[:3] == 0, first_valid, block[:3])
+            block[3] = alpha(block[:3])
+            rgba[(slice(None), *window.toslices())] = block.reshape(4, window.height, window.width)
+
+          patched_tif = os.path.join(tdir, f'{interval_id}-patched.tif')
+          with rasterio.open(patched_tif, 'w', **meta) as dst:
+            dst.write(rgba)
+          os.remove(rgba_tif)
+          self._upload_cog(uploader, patched_tif, tile_id, interval_id, 'rgba', add_mask=False, 
+                           on_uploaded=partial(self._checkpoint_upload, checkpoint, f'patch:rgba:{interval_id}', 
+                                               patched_tif))
+          uploader.wait()
+
+          del rgba
+          gc.collect()
+
+    self._upload_state(tile_id, 'rgba', state_tif, ids)
+    os.remove(state_tif)
+
+  def _get_treecover_params(self, tile_id: str, ndvi_diff_cut_trees: float, ndvi_tree_lower_bound: float):
     # Override parameters if set
     q = ProcessTreecoverParams.select().where(ProcessTreecoverParams.tile_id == tile_id)
     if len(q) > 0:
@@ -323,87 +790,352 @@ class GLAD():
 
     print('Parameter ndvi_diff_cut_trees:', ndvi_diff_cut_trees)
     print('Parameter ndvi_tree_lower_bound:', ndvi_tree_lower_bound)
-      
-    ids = self.list_images(tile_id)
 
-    print(f'Processing Treecover images for Tile ID {tile_id}...')
-    with TemporaryDirectory() as tdir:
-      # Download stack of images
-      for interval_id in tqdm(ids):
-        s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/raw.tif'
-        raw_tif = os.path.join(tdir, f'{interval_id}-raw.tif')
-        ndvi_tif = os.path.join(tdir, f'{interval_id}-ndvi.tif')
-        
-        print(f'Downloading {s3_key} to {raw_tif}...')
-        self._s3.download_file(Bucket=self._s3_bucket, Key=s3_key, Filename=raw_tif)
-
-        print(f'Computing NDVI band...')
-        with rasterio.open(raw_tif, mode='r') as src:
-          # red, nir
-          ndvi = src.read([3, 4])
-          ndvi = (ndvi[1] - ndvi[0]) / (ndvi[1] + ndvi[0])
-    
-          qf = src.read(8)
-          mask = np.logical_or(qf == 1, qf == 15) 
-          ndvi = np.where(mask, ndvi, np.nan)
-          ndvi = np.expand_dims(ndvi, axis=0)
- 
-          new_meta = src.meta.copy()
-          new_meta['count'] = 1
-          new_meta['dtype'] = 'float32'
-
-          with rasterio.open(ndvi_tif, 'w', **new_meta) as dst:
-            dst.write(ndvi)
-          
-          os.remove(raw_tif)
-
-        del ndvi, qf, mask, new_meta
-        gc.collect()
+    return {'ndvi_diff_cut_trees': ndvi_diff_cut_trees, 'ndvi_tree_lower_bound': ndvi_tree_lower_bound}
+
+  def _process_treecover(self, tile_id: str, ids: list, intermediates: dict, tdir: str, state: dict, 
+                         scheduler: DaskScheduler, checkpoint: RunCheckpoint, ndvi_diff_cut_trees: float = 0.25, 
+                         ndvi_tree_lower_bound: float = 0.7):
+    params = {'ndvi_diff_cut_trees': ndvi_diff_cut_trees, 'ndvi_tree_lower_bound': ndvi_tree_lower_bound}
+    filled_tifs = [os.path.join(tdir, f'{interval_id}-filled.tif') for interval_id in ids]
+    state_tif = os.path.join(tdir, 'treecover-state.tif')
+
+    if checkpoint.done('state:treecover'):
+      print('Treecover already processed.')
+      return
+
+    if checkpoint.done('stack:treecover', state_tif):
+      print('Treecover stack already built.')
+    else:
+      if state is not None:
+        if self._process_treecover_incremental(tile_id, ids, intermediates, tdir, state, params, checkpoint):
+          return
+
+        # The full rebuild also needs the intermediates of the processed intervals
+        intermediates.update(self._extract_intermediates(tile_id, {'treecover': state['interval_ids']}, 
+                                                         checkpoint)['treecover'])
+
+      print(f'Processing Treecover images for Tile ID {tile_id}...')
+      ndvi_tifs = [intermediates[interval_id] for interval_id in ids]
 
       print(f'\nCalculating treecover...')
-      ndvi_tifs = [os.path.join(tdir, f'{interval_id}-ndvi.tif') for interval_id in ids]
-      filled_tifs = [os.path.join(tdir, f'{interval_id}-filled.tif') for interval_id in ids]
-
-      # Timeseries analysis to convert NDVI to treecover (0 = tree, 1 = no tree)
-      # block shape is (dim=time, bands(1=ndvi), y, x)
-      def ndvi_to_treecover(block, dim):
-        # impute missing values with forward and backfill and clip outliers to known NDVI values = (-1, 1)
-        block = block.ffill(dim=dim).bfill(dim=dim).clip(max=1, min=-1)
-        mask = block.notnull()
-        # take the rolling mean (3 periods) to smoothen for seasonal variances
-        block = block.rolling({f'{dim}': 3}, min_periods=1).mean()
-        # if the difference in NDVI is more than a known value than it usually indicates that tree has been cut
-        # clip lower bounds to a known NDVI value for trees
-        block = (block < (block.max(dim=dim) - ndvi_diff_cut_trees).clip(min=ndvi_tree_lower_bound))
-        # mark all tree loss for all future time points unless re-growth detected for 3 periods
-        forestloss = block.cumsum(dim=dim)
-        regrowth = (forestloss.rolling({f'{dim}': 3}).std() == 0)
-        forestloss = forestloss.where(~regrowth)
-        block = xr.where(forestloss > 0, 1, 0)
-        block = xr.where(mask, block, np.nan)
-
-        return block
-    
-      raster_map_blocks(ndvi_tifs, filled_tifs, block_size=500, fn_map_blocks=ndvi_to_treecover)
+      # Timeseries analysis to convert NDVI to treecover (0 = tree, 1 = no tree). The state to continue the
+      # timeseries with new intervals is computed in the same pass.
+      write_treecover(ndvi_tifs, filled_tifs, state_tif, ndvi_diff_cut_trees, ndvi_tree_lower_bound, 
+                      scheduler=scheduler, progress=checkpoint.blocks('stack:treecover'))
+      checkpoint.mark('stack:treecover')
 
       for ndvi_tif in ndvi_tifs:
         os.remove(ndvi_tif)
 
-      # Convert to COGS and upload to S3
-      for interval_id in tqdm(ids):
-        s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/treecover.tif'
-        filled_tif = os.path.join(tdir, f'{interval_id}-filled.tif')
-        tmp_file_cog = filled_tif.replace('.tif', '.cog.tif')
-        convert_to_cog_rio(filled_tif, tmp_file_cog, add_mask=False)
+    # Convert to COGS and stream to S3. Uploads overlap with converting the next interval.
+    with S3Uploader(self._s3, self._s3_bucket) as uploader:
+      self._upload_cogs(uploader, tile_id, ids, filled_tifs, 'treecover', checkpoint)
+
+    # State is saved last so an interrupted run is processed again. See `_process_rgba`.
+    self._upload_state(tile_id, 'treecover', state_tif, ids, params)
+    checkpoint.mark('state:treecover')
+    os.remove(state_tif)
+
+  def _process_treecover_incremental(self, tile_id: str, ids: list, intermediates: dict, tdir: str, state: dict,
+                                     params: dict, checkpoint: RunCheckpoint):
+    '''
+      Continue the treecover timeseries of a Tile ID from its saved state with the intervals added since.
+      Earlier outputs are only rewritten where the new intervals change their values.
+      Returns False if a full rebuild is needed instead.
+    '''
+    processed_ids = state['interval_ids']
+    new_ids = ids[len(processed_ids):]
+    if len(new_ids) == 0:
+      print(f'Treecover for Tile ID {tile_id} is up to date.')
+      return True
+
+    print(f'Processing {len(new_ids)} new Treecover images for Tile ID {tile_id}...')
+    state_tif = os.path.join(tdir, 'treecover-saved-state.tif')
+    self._s3.download_file(Bucket=self._s3_bucket, Key=self._state_key(tile_id, 'treecover', 'tif'), 
+                           Filename=state_tif)
+    ndvi_tifs = [intermediates[interval_id] for interval_id in new_ids]
+    filled_tifs = [os.path.join(tdir, f'{interval_id}-filled.tif') for interval_id in new_ids]
+    new_state_tif = os.path.join(tdir, 'treecover-new-state.tif')
+
+    with rasterio.open(state_tif) as src:
+      state_meta = src.profile.copy()
+      windows = [window for _, window in src.block_windows(1)]
+    with rasterio.open(ndvi_tifs[0]) as src:
+      new_meta = src.meta.copy()
+      new_meta.update(tiled=True, blockxsize=state_meta['blockxsize'], blockysize=state_meta['blockysize'])
+      n_pixels = src.width * src.height
+
+    for filled_tif in filled_tifs:
+      with rasterio.open(filled_tif, 'w', **new_meta):
+        pass
+
+    print(f'\nContinuing treecover...')
+    changed = {}
+    with stage('map_blocks'), rasterio.open(state_tif) as src, \
+         rasterio.open(new_state_tif, 'w', **state_meta) as dst:
+      for window in tqdm(windows):
+        state = src.read(window=window).reshape(len(STATE_BANDS), -1)
+        ndvi = read_stack(ndvi_tifs, window)
+        treecover, state, dirty, new = treecover_update(ndvi, state, len(processed_ids), **params)
+        dst.write(state.reshape(-1, window.height, window.width), window=window)
+        for i, filled_tif in enumerate(filled_tifs):
+          with rasterio.open(filled_tif, 'r+') as out:
+            out.write(treecover[i].reshape(1, window.height, window.width), window=window)
+
+        if (dirty | new).any():
+          changed[window] = dirty | new
+    add('map_blocks', blocks=len(windows))
+    os.remove(state_tif)
+
+    n_changed = sum(mask.sum() for mask in changed.values())
+    print(f'{n_changed} pixels changed their history.')
+    if n_changed > n_pixels * self._treecover_max_changed:
+      print('Too many pixels changed their history. Running a full rebuild...')
+      for filled_tif in filled_tifs:
         os.remove(filled_tif)
-        
-        # Upload to S3
-        print(f'Uploading {tile_id}:{interval_id} to S3 ({s3_key}).')
-        self._s3.upload_file(tmp_file_cog, self._s3_bucket, s3_key)
-        print(f'Image {tile_id}:{interval_id} uploaded to S3.')
-        os.remove(tmp_file_cog)
+      os.remove(new_state_tif)
+      return False
+
+    patches = self._recompute_treecover_history(tile_id, processed_ids, changed, ndvi_tifs, filled_tifs, 
+                                                new_state_tif, params)
+
+    # The intermediates are kept in the work directory until the run is done so a resumed run can compute them again
+    with S3Uploader(self._s3, self._s3_bucket) as uploader:
+      self._upload_cogs(uploader, tile_id, new_ids, filled_tifs, 'treecover', checkpoint)
+      uploader.wait()
+
+      print(f'\nRewriting {len(patches)} changed Treecover images...')
+      with stage('patch'):
+        for interval_id in tqdm(sorted(patches)):
+          if checkpoint.done(f'patch:treecover:{interval_id}'):
+            continue
+
+          treecover_tif = os.path.join(tdir, f'{interval_id}-treecover.tif')
+          s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/treecover.tif'
+          self._s3.download_file(Bucket=self._s3_bucket, Key=s3_key, Filename=treecover_tif)
+          with rasterio.open(treecover_tif) as src:
+            treecover = src.read(1)
+            meta = src.meta.copy()
+          for window, (mask, values) in patches[interval_id].items():
+            block = treecover[window.toslices()].ravel()
+            block[mask] = values
+            treecover[window.toslices()] = block.reshape(window.height, window.width)
+
+          patched_tif = os.path.join(tdir, f'{interval_id}-patched.tif')
+          with rasterio.open(patched_tif, 'w', **meta) as dst:
+            dst.write(treecover, 1)
+          os.remove(treecover_tif)
+          self._upload_cog(uploader, patched_tif, tile_id, interval_id, 'treecover', add_mask=False,
+                           on_uploaded=partial(self._checkpoint_upload, checkpoint, f'patch:treecover:{interval_id}', 
+                                               patched_tif))
+          uploader.wait()
+
+          del treecover
+          gc.collect()
+
+    self._upload_state(tile_id, 'treecover', new_state_tif, ids, params)
+    os.remove(new_state_tif)
+
+    return True
+
+  def _recompute_treecover_history(self, tile_id: str, processed_ids: list, changed: dict, ndvi_tifs: list, 
+                                   filled_tifs: list, state_tif: str, params: dict):
+    '''
+      Recompute the full timeseries of pixels whose history is changed by new intervals. The NDVI history of
+      only the changed windows is read from the raw COGs.
+      The new outputs and state are fixed in place and the changes to earlier outputs are returned as 
+      {interval_id: {window: (pixel mask, values)}}
+    '''
+    if len(changed) == 0:
+      return {}
+
+    print(f'\nReading NDVI history of {len(changed)} changed blocks...')
+    history = {window: np.empty((len(processed_ids), mask.sum()), np.float32) for window, mask in changed.items()}
+    with stage('history'), rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR'):
+      for i, interval_id in enumerate(tqdm(processed_ids)):
+        s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/raw.tif'
+        url = self._s3.generate_presigned_url('get_object', Params={'Bucket': self._s3_bucket, 'Key': s3_key})
+        with rasterio.open(url) as src:
+          for window, mask in changed.items():
+            red, nir, qf = src.read([3, 4, 8], window=window)
+            history[window][i] = compute_ndvi(red, nir, qf).ravel()[mask]
+
+    patches = {}
+    with rasterio.open(state_tif, 'r+') as state_dst:
+      for window, mask in changed.items():
+        ndvi = np.concatenate([history[window], read_stack(ndvi_tifs, window)[:, mask]])
+        treecover, state = treecover_series(ndvi, **params)
+        previous, _ = treecover_series(history[window], **params)
+
+        for i, interval_id in enumerate(processed_ids):
+          diff = (treecover[i] != previous[i]) & ~(np.isnan(treecover[i]) & np.isnan(previous[i]))
+          if diff.any():
+            pixels = np.zeros(mask.shape, bool)
+            pixels[np.flatnonzero(mask)[diff]] = True
+            patches.setdefault(interval_id, {})[window] = (pixels, treecover[i][diff])
+
+        for i, filled_tif in enumerate(filled_tifs):
+          with rasterio.open(filled_tif, 'r+') as dst:
+            block = dst.read(1, window=window).ravel()
+            block[mask] = treecover[len(processed_ids) + i]
+            dst.write(block.reshape(1, window.height, window.width), window=window)
+
+        block = state_dst.read(window=window).reshape(len(STATE_BANDS), -1)
+        block[:, mask] = state
+        state_dst.write(block.reshape(-1, window.height, window.width), window=window)
+
+    return patches
+
+  def render_images_xyz(self, tile_id: str, levels: list = None, zooms: tuple = None, fmt: str = None):
+    '''
+      Render the images of a Tile ID as XYZ tiles of the WebMercator grid, uploaded under 
+      `{tile_id}/{interval_id}/xyz/{level}/{z}/{x}/{y}.{fmt}` with a TileJSON `{tile_id}/{interval_id}/{level}-xyz.json`
+      and recorded in the manifest as the level `{level}-xyz`. Only images which changed since their tiles were 
+      rendered (or were rendered with other zooms or format) are rendered, so it can follow every processing run.
+
+      Parameters
+      ----------
+      - tile_id: str - Tile ID
+      - levels: list optional - Levels to render. Defaults to ['rgba', 'treecover'].
+      - zooms: tuple optional - (min zoom, max zoom). Defaults to XYZ_ZOOMS.
+      - fmt: str optional - ['png', 'webp']. Defaults to XYZ_FORMAT.
+    '''
+    levels = levels or list(self._derived_levels().keys())
+    zooms = list(zooms or self._xyz_zooms)
+    fmt = fmt or self._xyz_format
+    images = self._manifest.get_images(tile_id)
+
+    for level in levels:
+      stale = [id for id, image_levels in images.items() if level in image_levels and 
+               image_levels.get(f'{level}-xyz', {}).get('source') != 
+               {'etag': image_levels[level]['etag'], 'zooms': zooms, 'format': fmt}]
+      if len(stale) == 0:
+        continue
+
+      print(f'Rendering {level} XYZ tiles of {len(stale)} images for Tile ID {tile_id} '
+            f'(zooms {zooms[0]}-{zooms[1]})...')
+      with self.deferred_index():
+        for interval_id in tqdm(sorted(stale)):
+          self._render_image_xyz(tile_id, interval_id, level, images[interval_id][level]['etag'], zooms, fmt)
+
+  def _render_image_xyz(self, tile_id: str, interval_id: int, level: str, etag: str, zooms: list, fmt: str):
+    prefix = f'{self._s3_root_path}/{tile_id}/{interval_id}'
+    with TemporaryDirectory() as tdir:
+      tif = os.path.join(tdir, f'{level}.tif')
+      with stage('download'):
+        self._s3.download_file(Bucket=self._s3_bucket, Key=f'{prefix}/{level}.tif', Filename=tif)
+      add('download', bytes_downloaded=os.path.getsize(tif))
+
+      # Tiles of an earlier render which are empty now must not be left behind
+      self._delete_prefix(f'{prefix}/xyz/{level}/')
+
+      size = 0
+      with stage('xyz'), ThreadPoolExecutor(max_workers=self._xyz_upload_workers) as executor:
+        futures = []
+        for z, x, y, tile in render_tiles(tif, level, zooms, fmt):
+          futures.append(executor.submit(self._s3.put_object, Bucket=self._s3_bucket, 
+                                         Key=f'{prefix}/xyz/{level}/{z}/{x}/{y}.{fmt}', Body=tile, 
+                                         ContentType=f'image/{fmt}'))
+          size += len(tile)
+        for future in futures:
+          future.result()
+      add('upload', bytes_uploaded=size)
+
+      with rasterio.open(tif) as src:
+        bounds = list(transform_bounds(src.crs, 'EPSG:4326', *src.bounds))
+
+    tilejson = {'tilejson': '3.0.0', 'tiles': [f'{self.get_image_base_url()}/{tile_id}/{interval_id}/xyz/{level}/'
+                                                '{z}/{x}/{y}.' + fmt],
+                'minzoom': zooms[0], 'maxzoom': zooms[1], 'bounds': bounds}
+    r = self._s3.put_object(Bucket=self._s3_bucket, Key=f'{prefix}/{level}-xyz.json', 
+                            Body=json.dumps(tilejson).encode(), ContentType='application/json')
+    self._manifest.add_image(tile_id, interval_id, f'{level}-xyz', size, r['ETag'], 
+                             meta={'source': {'etag': etag, 'zooms': zooms, 'format': fmt}})
+
+  def get_xyz_source(self):
+    '''
+      Zoom range and format of the pre-rendered XYZ tiles.
+    '''
+    return {'minzoom': self._xyz_zooms[0], 'maxzoom': self._xyz_zooms[1], 'format': self._xyz_format}
+
+  def _get_state_meta(self, tile_id: str, level: str):
+    try:
+      r = self._s3.get_object(Bucket=self._s3_bucket, Key=self._state_key(tile_id, level, 'json'))
+      return json.loads(r['Body'].read())
+    
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'NoSuchKey':
+        raise e
+      
+      return None
+
+  def _upload_state(self, tile_id: str, level: str, state_tif: str, ids: list, params: dict = {}):
+    '''
+      Upload the state of a level and the intervals and parameters it was computed with.
+    '''
+    print(f'Uploading {level} state for Tile ID {tile_id}...')
+    with stage('upload'):
+      self._s3.upload_file(state_tif, self._s3_bucket, self._state_key(tile_id, level, 'tif'), 
+                           Config=S3Uploader.transfer_config)
+    add('upload', bytes_uploaded=os.path.getsize(state_tif))
+    state_meta = {'interval_ids': ids, 'updated': datetime.now().isoformat(), **params}
+    self._s3.put_object(Bucket=self._s3_bucket, Key=self._state_key(tile_id, level, 'json'), 
+                        Body=json.dumps(state_meta).encode(), ContentType='application/json')
+
+  def _state_key(self, tile_id: str, level: str, ext: str):
+    return f'{self._s3_root_path}/{tile_id}/state/{level}.{ext}'
+
+  def _upload_image(self, file: str, tile_id: str, interval_id: int, level: str):
+    '''
+      Upload an image to S3 and record it in the tile manifest.
+    '''
+    s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/{level}.tif'
+    print(f'Uploading {tile_id}:{interval_id} to S3 ({s3_key}).')
+    with stage('upload'):
+      self._s3.upload_file(file, self._s3_bucket, s3_key, Config=S3Uploader.transfer_config)
+    add('upload', bytes_uploaded=os.path.getsize(file))
+    self._record_upload(tile_id, interval_id, level)
+
+  def _upload_cog(self, uploader: S3Uploader, input_geotiff: str, tile_id: str, interval_id: int, level: str, 
+                  add_mask: bool = True, on_uploaded: callable = None):
+    '''
+      Convert a GeoTIFF to COG in memory and queue it on `uploader` to stream to S3. 
+      It is recorded in the tile manifest once uploaded and then `on_uploaded()` is called.
+    '''
+    s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/{level}.tif'
+    print(f'Uploading {tile_id}:{interval_id} to S3 ({s3_key}).')
+
+    def uploaded(_):
+      self._record_upload(tile_id, interval_id, level)
+      if on_uploaded is not None:
+        on_uploaded()
+
+    uploader.upload_cog(input_geotiff, s3_key, add_mask=add_mask, callback=uploaded)
+
+  def _upload_cogs(self, uploader: S3Uploader, tile_id: str, ids: list, files: list, level: str, 
+                   checkpoint: RunCheckpoint):
+    '''
+      Upload the outputs of a level for intervals which an interrupted run didn't upload. Each output is removed once 
+      uploaded so it is kept to resume from if its upload fails.
+    '''
+    for interval_id, file in zip(tqdm(ids), files):
+      if checkpoint.done(f'upload:{level}:{interval_id}'):
+        continue
 
-        gc.collect()
+      self._upload_cog(uploader, file, tile_id, interval_id, level, add_mask=False, 
+                       on_uploaded=partial(self._checkpoint_upload, checkpoint, f'upload:{level}:{interval_id}', file))
+      gc.collect()
+
+  def _checkpoint_upload(self, checkpoint: RunCheckpoint, name: str, file: str):
+    checkpoint.mark(name)
+    os.remove(file)
+
+  def _record_upload(self, tile_id: str, interval_id: int, level: str):
+    s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/{level}.tif'
+    head = self._s3.head_object(Bucket=self._s3_bucket, Key=s3_key)
+    self._manifest.add_image(tile_id, interval_id, level, head['ContentLength'], head['ETag'])
+    print(f'Image {tile_id}:{interval_id} uploaded to S3.')
 
   def get_image(self, tile_id: str, interval_id: int, level: str = 'raw'):
     '''
@@ -426,9 +1158,7 @@ class GLAD():
     
     s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/{level}.tif'
 
-    interval_table, interval_dates = self.get_interval_table()
-    idx = np.where(interval_table.to_numpy().flatten() == interval_id)[0][0]
-    date = interval_dates.to_numpy().flatten()[idx]
+    date = np.datetime64(self.get_calendar().date(interval_id), 'ns')
 
     # Generate a URL for the S3 object
     url = f'{self._s3_public_url}/{s3_key}'
@@ -443,27 +1173,67 @@ class GLAD():
     return ds
   
   def list_images(self, tile_id: str):
-    prefix = f'{self._s3_root_path}/{tile_id}/'
-    ids = self._s3.list_objects_v2(Bucket=self._s3_bucket, Prefix=prefix, Delimiter='/')['CommonPrefixes']
-    ids = sorted([int(id['Prefix'].replace(prefix, '').split('/')[0]) for id in ids])
-    return ids
+    return sorted(self._manifest.get_images(tile_id).keys())
   
-  def list_tiles(self, full: bool = False):
-    prefix = f'{self._s3_root_path}/'
-    tiles = self._s3.list_objects_v2(Bucket=self._s3_bucket, Prefix=prefix, Delimiter='/')['CommonPrefixes']
-    tiles = sorted([tile['Prefix'].replace(prefix, '').split('/')[0] for tile in tiles])
+  def list_tiles(self, full: bool = False, index: dict = None, tile_ids: list = None):
+    '''
+      List the Tile IDs with images, or their images with dates if `full`.
+
+      Parameters
+      ----------
+      - full: bool default=False - Return {tile_id: [{'ID': int, 'Date': Timestamp, 'Levels': [level]}]}
+      - index: dict optional - Global index to list from eg from `get_tiles_index`. Read from S3 if not provided.
+      - tile_ids: list optional - Only list these Tile IDs
+    '''
+    if index is None:
+      index = self._manifest.get_index()
+    tiles = index['tiles']
+    if tile_ids is not None:
+      tiles = {tile: tiles[tile] for tile in tile_ids if tile in tiles}
 
-    if full:
-      interval_table, interval_dates = self.get_interval_table()
-      interval_table = interval_table.to_numpy().flatten()
-      interval_dates = interval_dates.to_numpy().flatten()
+    if not full:
+      return sorted(tiles.keys())
 
-      tiles = {tile: self.list_images(tile) for tile in tiles}
-      for tile in tiles:
-        tiles[tile] = [{'ID': id, 'Date': pd.Timestamp(interval_dates[np.where(interval_table == id)[0][0]])} 
-                       for id in tiles[tile]]
+    calendar = self.get_calendar()
+    levels = tiles
+    tiles = {tile: sorted(int(id) for id in tiles[tile]) for tile in sorted(tiles.keys())}
+    for tile in tiles:
+      tiles[tile] = [{'ID': id, 'Date': pd.Timestamp(date), 'Levels': levels[tile][str(id)]} 
+                     for id, date in zip(tiles[tile], calendar.dates_of(tiles[tile]))]
 
     return tiles
+
+  def get_tiles_index(self, etag: str = None):
+    '''
+      Get the global index of the tiles {'tiles': {tile_id: {interval_id: [level]}}} and its ETag. The index is None
+      if it has not changed since `etag`.
+
+      Parameters
+      ----------
+      - etag: str optional - ETag of the index read previously
+    '''
+    return self._manifest.get_index_if_changed(etag)
+
+  def deferred_index(self):
+    '''
+      Context manager which writes the changes of the global index of the images recorded in it once on exit rather
+      than for every image (see `Manifest.deferred_index`). The runs of a tile use it, wrap a loop of runs in it to
+      write the index once for all of them.
+    '''
+    return self._manifest.deferred_index()
+
+  def rebuild_manifest(self, tile_id: str = None):
+    '''
+      Rebuild the S3 manifest from a listing of S3. 
+
+      Parameters
+      ----------
+      - tile_id str optional: Tile ID in the format '054W_03S'. Rebuilds all tiles and the global index if not provided.
+    '''
+    if tile_id is None:
+      return self._manifest.rebuild()
+    else:
+      return self._manifest.rebuild_tile(tile_id)
   
   def delete_tile(self, tile_id: str):
     '''
@@ -473,15 +1243,8 @@ class GLAD():
       ----------
       - tile_id str: Tile ID in the format '054W_03S'
     '''
-    s3_key = f'{self._s3_root_path}/{tile_id}/'
-    
-    try:
-      keys = self._s3.list_objects_v2(Bucket=self._s3_bucket, Prefix=s3_key)['Contents']
-      keys = {'Objects': [{'Key': key['Key']} for key in keys]}
-      self._s3.delete_objects(Bucket=self._s3_bucket, Delete=keys)
-    
-    except Exception as e:
-      pass
+    self._delete_prefix(f'{self._s3_root_path}/{tile_id}/')
+    self._manifest.remove_images(tile_id)
 
   def delete_image(self, tile_id: str, interval_id: int):
     '''
@@ -492,15 +1255,26 @@ class GLAD():
       - tile_id str: Tile ID in the format '054W_03S'
       - interval_id int: Interval ID
     '''
-    s3_key = f'{self._s3_root_path}/{tile_id}/{interval_id}/'
-    
+    self._delete_prefix(f'{self._s3_root_path}/{tile_id}/{interval_id}/')
+    self._manifest.remove_images(tile_id, interval_id)
+
+  def _delete_prefix(self, prefix: str):
+    '''
+      Delete all objects under a S3 prefix, a page (up to 1000 keys) per request.
+    '''
     try:
-      keys = self._s3.list_objects_v2(Bucket=self._s3_bucket, Prefix=s3_key)['Contents']
-      keys = {'Objects': [{'Key': key['Key']} for key in keys]}
-      self._s3.delete_objects(Bucket=self._s3_bucket, Delete=keys)
-    
+      for page in self._s3.get_paginator('list_objects_v2').paginate(Bucket=self._s3_bucket, Prefix=prefix):
+        keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if len(keys) == 0:
+          continue
+
+        r = self._s3.delete_objects(Bucket=self._s3_bucket, Delete={'Objects': keys, 'Quiet': True})
+        for error in r.get('Errors', []):
+          print(f'Could not delete {error["Key"]} - {error["Message"]}')
+
     except Exception as e:
-      pass
+      print(f'Could not delete {prefix} - {e}')
 
   def cache_clear(self):
+    self._raster_cache.clear()
     shutil.rmtree(self._data_cache, ignore_errors=True)
\ No newline at end of file
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+
+
+class IntervalCalendar():
+  '''
+    GLAD 16 day interval IDs and their end dates as sorted arrays. An interval ID is looked up by its offset into an
+    array (O(1)) and dates by binary search, both vectorized for arrays. It is small enough to pickle and load quickly
+    unlike the interval tables.
+
+    Parameters
+    ----------
+    - ids: np.ndarray - Interval IDs
+    - dates: np.ndarray - End dates of the intervals
+  '''
+
+  def __init__(self, ids: np.ndarray, dates: np.ndarray):
+    order = np.argsort(dates, kind='stable')
+    self.ids = np.asarray(ids)[order].astype(np.int32)
+    self.dates = np.asarray(dates)[order].astype('datetime64[D]')
+
+    # Dates by ID offset, NaT for missing IDs
+    self._min_id = int(self.ids.min()) if len(self.ids) > 0 else 0
+    self._by_id = np.full(int(self.ids.max()) - self._min_id + 1 if len(self.ids) > 0 else 0, np.datetime64('NaT'),
+                          dtype='datetime64[D]')
+    self._by_id[self.ids - self._min_id] = self.dates
+
+  @classmethod
+  def from_tables(cls, interval_table: pd.DataFrame, interval_dates: pd.DataFrame):
+    '''
+      Build from GLAD's interval ID and date tables (years as index, the intervals of the year as columns).
+    '''
+    ids = interval_table.to_numpy().flatten()
+    dates = interval_dates.to_numpy().flatten()
+    valid = ~np.isnan(ids.astype(float))
+    return cls(ids[valid], dates[valid])
+
+  def date(self, interval_id: int):
+    '''
+      End date of an interval ID as a Timestamp. Raises KeyError for unknown IDs.
+    '''
+    offset = int(interval_id) - self._min_id
+    if offset < 0 or offset >= len(self._by_id) or np.isnat(self._by_id[offset]):
+      raise KeyError(f'Unknown interval ID {interval_id}.')
+
+    return pd.Timestamp(self._by_id[offset])
+
+  def dates_of(self, interval_ids):
+    '''
+      End dates of an array of interval IDs. NaT for unknown IDs.
+    '''
+    offsets = np.asarray(interval_ids, dtype=np.int64) - self._min_id
+    valid = (offsets >= 0) & (offsets < len(self._by_id))
+    dates = np.full(offsets.shape, np.datetime64('NaT'), dtype='datetime64[D]')
+    dates[valid] = self._by_id[offsets[valid]]
+    return dates
+
+  def ids_of(self, dates):
+    '''
+      Interval IDs of the intervals containing an array of dates ie the first interval ending on or after each date.
+      -1 for dates after the last interval.
+    '''
+    idx = np.searchsorted(self.dates, np.asarray(dates, dtype='datetime64[D]'), side='left')
+    return np.where(idx < len(self.ids), self.ids[np.minimum(idx, len(self.ids) - 1)], -1)
+
+  def ids_before(self, date):
+    '''
+      Interval IDs ending before a date, in order.
+    '''
+    return self.ids[self.dates < np.datetime64(date, 'ns')]
\ No newline at end of file
@@ -0,0 +1,221 @@
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from peewee import PostgresqlDatabase, IntegrityError, fn
+
+from .db.db import db
+from .db.Job import Job
+
+
+class JobQueue():
+  '''
+    Queue of tile jobs (ingest, process, delete) in the `jobs` table shared by the workers of all nodes.
+
+    Workers claim the next ready job with `SELECT ... FOR UPDATE SKIP LOCKED` so they never wait on or claim the same
+    job, and only one job of a tile runs at a time. A claimed job is leased for `lease` seconds and the worker extends
+    the lease with heartbeats. Jobs whose lease expired (eg the node died) are requeued by `requeue_expired`. Failed
+    jobs are retried with exponential backoff until `max_attempts`. A job can depend on another, eg processing on
+    ingestion, and is queued once it is done (or fails with it).
+
+    Times are UTC from the clocks of the nodes, which should be synchronised.
+
+    Parameters
+    ----------
+    - lease: int default=300 - Lease of a claimed job in seconds
+    - backoff: int default=60 - Delay before the first retry in seconds, doubled for every attempt
+    - max_backoff: int default=3600 - Maximum delay before a retry in seconds
+  '''
+
+  kinds = ['ingest', 'process', 'delete']
+
+  def __init__(self, lease: int = 300, backoff: int = 60, max_backoff: int = 3600):
+    self.lease = lease
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+
+  def enqueue(self, kind: str, tile_id: str, level: str = None, params: dict = {}, depends_on: Job = None,
+              priority: int = 0, max_attempts: int = 3):
+    '''
+      Add a job. An unfinished job with the same kind, Tile ID, level and params is returned instead of adding
+      another.
+
+      Parameters
+      ----------
+      - kind: str - ['ingest', 'process', 'delete']
+      - tile_id: str - Tile ID in the format '054W_03S'
+      - level: str optional - Level for process jobs ['rgba', 'treecover', 'all']
+      - params: dict default={} - Options of the worker command eg {'parallel': True, 'io_workers': 4}
+      - depends_on: Job optional - Job which must be done before this one runs
+      - priority: int default=0 - Higher priority jobs are claimed first
+      - max_attempts: int default=3 - Attempts before the job fails
+    '''
+    if kind not in self.kinds:
+      raise Exception(f'Unsupported job kind {kind}.')
+
+    params = json.dumps(params, sort_keys=True)
+    with db.atomic():
+      existing = (Job.select()
+                  .where(Job.kind == kind, Job.tile_id == tile_id, Job.level == level, Job.params == params,
+                         Job.status.in_(['waiting', 'queued']))
+                  .first())
+      if existing is not None:
+        return existing
+
+      status = 'queued'
+      if depends_on is not None:
+        depends_on = Job.get_by_id(depends_on.id)
+        status = {'done': 'queued', 'failed': 'failed'}.get(depends_on.status, 'waiting')
+
+      now = self._now()
+      return Job.create(kind=kind, tile_id=tile_id, level=level, params=params, status=status, priority=priority,
+                        max_attempts=max_attempts, run_after=now, depends_on=depends_on, created=now, updated=now,
+                        error='Dependency failed.' if status == 'failed' else None)
+
+  def enqueue_tile(self, tile_id: str, levels: list = ['all'], ingest_params: dict = {}, process_params: dict = {},
+                   priority: int = 0):
+    '''
+      Add an ingest job for a Tile ID and process jobs for its levels which run once it is ingested.
+    '''
+    ingest = self.enqueue('ingest', tile_id, params=ingest_params, priority=priority)
+    process = [self.enqueue('process', tile_id, level=level, params=process_params, depends_on=ingest,
+                            priority=priority) for level in levels]
+    return [ingest] + process
+
+  def claim(self, worker: str, kinds: list = None):
+    '''
+      Claim the next ready job for a worker. Returns None if there is none.
+
+      Parameters
+      ----------
+      - worker: str - Worker name
+      - kinds: list optional - Only claim these kinds of jobs
+    '''
+    now = self._now()
+    running = Job.alias()
+    tile_running = (running.select(running.id)
+                    .where(running.tile_id == Job.tile_id, running.status == 'running'))
+
+    query = (Job.select()
+             .where(Job.status == 'queued', Job.run_after <= now, ~fn.EXISTS(tile_running))
+             .order_by(Job.priority.desc(), Job.id)
+             .limit(1))
+    if kinds is not None:
+      query = query.where(Job.kind.in_(kinds))
+    if isinstance(db, PostgresqlDatabase):
+      query = query.for_update('FOR UPDATE SKIP LOCKED')
+
+    try:
+      with db.atomic():
+        job = query.first()
+        if job is None:
+          return None
+
+        claimed = (Job.update(status='running', worker=worker, attempts=Job.attempts + 1, heartbeat_at=now,
+                              lease_until=now + timedelta(seconds=self.lease), updated=now)
+                   .where(Job.id == job.id, Job.status == 'queued')
+                   .execute())
+        if claimed == 0:
+          return None
+
+    except IntegrityError:
+      # Another worker started a job of the same tile
+      return None
+
+    return Job.get_by_id(job.id)
+
+  def heartbeat(self, job: Job):
+    '''
+      Extend the lease of a running job. Returns False if the worker lost the job (eg its lease expired).
+    '''
+    now = self._now()
+    return (Job.update(lease_until=now + timedelta(seconds=self.lease), heartbeat_at=now, updated=now)
+            .where(Job.id == job.id, Job.worker == job.worker, Job.status == 'running')
+            .execute()) > 0
+
+  def complete(self, job: Job):
+    '''
+      Mark a running job as done and queue the jobs waiting for it.
+    '''
+    now = self._now()
+    with db.atomic():
+      if not self._finish(job, status='done', updated=now):
+        return False
+
+      Job.update(status='queued', run_after=now, updated=now) \
+        .where(Job.depends_on == job.id, Job.status == 'waiting').execute()
+
+    return True
+
+  def fail(self, job: Job, error: str, expired: bool = False):
+    '''
+      Retry a running job after a backoff, or fail it (and the jobs waiting for it) if it has no attempts left.
+
+      Parameters
+      ----------
+      - job: Job - Job claimed by the worker
+      - error: str - Error message
+      - expired: bool default=False - Only if its lease has expired
+    '''
+    now = self._now()
+    conditions = [Job.lease_until < now] if expired else []
+    attempts = Job.get_by_id(job.id).attempts
+    if attempts < job.max_attempts:
+      return self._finish(job, *conditions, status='queued', error=error, run_after=now + self._backoff(attempts),
+                          updated=now)
+
+    with db.atomic():
+      if not self._finish(job, *conditions, status='failed', error=error, updated=now):
+        return False
+      self._fail_dependents(job, now)
+
+    return True
+
+  def release(self, job: Job):
+    '''
+      Put a running job back in the queue without counting the attempt eg when a worker shuts down.
+    '''
+    now = self._now()
+    return self._finish(job, status='queued', attempts=Job.attempts - 1, run_after=now, updated=now)
+
+  def requeue_expired(self):
+    '''
+      Requeue (or fail, if they have no attempts left) running jobs whose lease expired. Returns the number of jobs.
+    '''
+    now = self._now()
+    jobs = list(Job.select().where(Job.status == 'running', Job.lease_until < now))
+    for job in jobs:
+      print(f'Lease of job {job.id} ({job.kind} {job.tile_id}) on {job.worker} expired.')
+      self.fail(job, error=f'Lease expired on {job.worker}.', expired=True)
+
+    return len(jobs)
+
+  def counts(self, kinds: list = None):
+    '''
+      Number of jobs by status, of some kinds only if `kinds` is provided.
+    '''
+    query = Job.select(Job.status, fn.COUNT(Job.id).alias('count')).group_by(Job.status)
+    if kinds is not None:
+      query = query.where(Job.kind.in_(kinds))
+
+    return {job.status: job.count for job in query}
+
+  def _finish(self, job: Job, *conditions, **fields):
+    # Only the worker which holds the job can finish it
+    return (Job.update(worker=None, lease_until=None, **fields)
+            .where(Job.id == job.id, Job.worker == job.worker, Job.status == 'running', *conditions)
+            .execute()) > 0
+
+  def _fail_dependents(self, job: Job, now: datetime):
+    dependents = list(Job.select().where(Job.depends_on == job.id, Job.status == 'waiting'))
+    for dependent in dependents:
+      Job.update(status='failed', error=f'Dependency {job.id} failed.', updated=now) \
+        .where(Job.id == dependent.id).execute()
+      self._fail_dependents(dependent, now)
+
+  def _backoff(self, attempts: int):
+    # Exponential with jitter so retries of jobs which failed together are spread out
+    delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+  def _now(self):
+    return datetime.now(timezone.utc).replace(tzinfo=None)
\ No newline at end of file
@@ -0,0 +1,295 @@
+import json
+import time
+import random
+from datetime import datetime
+from threading import Lock
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+
+class ManifestUpdateError(Exception):
+  '''
+    Raised when a conditional write of a manifest or the index keeps conflicting with other writers.
+  '''
+
+
+class Manifest():
+  '''
+    Index of the images stored in S3 so existence checks and listings don't need to list or probe S3.
+
+    Each tile has a manifest at `{root}/{tile_id}/manifest.json` -
+      {'tile_id': str, 'updated': str, 'images': {interval_id: {level: {'size': int, 'etag': str}}}}
+
+    All tiles are summarised in a global index at `{root}/index.json` -
+      {'updated': str, 'tiles': {tile_id: {interval_id: [level, ...]}}}
+
+    Writes are conditional on the ETag read so concurrent writers retry with backoff instead of overwriting each other
+    (on S3 implementations which support conditional writes). `rebuild` recovers both from a real listing.
+    The index is shared by every tile so within `deferred_index` (eg a run of a tile) its changes are written once at
+    the end. A failed index write is not an error: the changes are kept and written with the next one, and the index
+    can always be repaired with `rebuild`.
+
+    Parameters
+    ----------
+    - s3: S3 client
+    - bucket: str - S3 bucket
+    - root_path: str - Root S3 path of the tiles
+  '''
+
+  _retries = 10
+  # Seconds before the first retry of a conflicting write, doubled for every retry
+  _backoff = 0.1
+  _max_backoff = 5
+  # Tiles listed concurrently by `rebuild`. The S3 client needs a connection pool at least as large.
+  _list_workers = 16
+
+  def __init__(self, s3, bucket: str, root_path: str):
+    self._s3 = s3
+    self._bucket = bucket
+    self._root_path = root_path
+    self._lock = Lock()
+    # Index entries of tiles changed since the index was last written ({tile_id: manifest or None if removed})
+    self._index_changes = {}
+    self._index_deferred = 0
+
+  def get_tile(self, tile_id: str):
+    '''
+      Get the manifest for a Tile ID. It is rebuilt from a listing if it does not exist yet. The manifest of a tile 
+      without images is not saved, so looking up an unknown tile does not write anything.
+    '''
+    manifest, _ = self._read(self._tile_key(tile_id))
+    if manifest is None:
+      manifest = self._list_tile(tile_id)
+      if len(manifest['images']) > 0:
+        manifest = self.rebuild_tile(tile_id, manifest=manifest)
+
+    return manifest
+
+  def get_images(self, tile_id: str):
+    '''
+      Get the images for a Tile ID as {interval_id: {level: {'size': int, 'etag': str}}}
+    '''
+    return {int(id): levels for id, levels in self.get_tile(tile_id)['images'].items()}
+
+  def has_image(self, tile_id: str, interval_id: int, level: str = 'raw'):
+    return level in self.get_tile(tile_id)['images'].get(str(interval_id), {})
+
+  def get_index(self):
+    '''
+      Get the global index of all tiles. It is rebuilt from a listing if it does not exist yet.
+    '''
+    index, _ = self._read(self._index_key())
+    if index is None:
+      index = self.rebuild()
+
+    return index
+
+  def get_index_if_changed(self, etag: str = None):
+    '''
+      Get the global index and its ETag with a conditional read. The index is None if its ETag is still `etag`, so
+      polling for changes costs a single request with no body.
+    '''
+    try:
+      condition = {'IfNoneMatch': etag} if etag is not None else {}
+      r = self._s3.get_object(Bucket=self._bucket, Key=self._index_key(), **condition)
+      return json.loads(r['Body'].read()), r['ETag']
+
+    except ClientError as e:
+      if e.response['Error']['Code'] in ['304', 'NotModified']:
+        return None, etag
+      if e.response['Error']['Code'] != 'NoSuchKey':
+        raise e
+
+    index = self.rebuild()
+    _, etag = self._read(self._index_key())
+    return index, etag
+
+  def add_image(self, tile_id: str, interval_id: int, level: str, size: int, etag: str, meta: dict = None):
+    '''
+      Record an uploaded image in the tile manifest and the global index, with optional `meta` of the image.
+    '''
+    def update_tile(manifest):
+      manifest['images'].setdefault(str(interval_id), {})[level] = {'size': size, 'etag': etag, **(meta or {})}
+      return manifest
+
+    with self._lock:
+      manifest = self._update(self._tile_key(tile_id), update_tile, self._empty_tile(tile_id))
+      self._update_index(tile_id, manifest)
+
+  @contextmanager
+  def deferred_index(self):
+    '''
+      Defer the index changes of the manifest updates in the block and write them once on exit. Can be nested, the
+      outermost block writes them.
+    '''
+    with self._lock:
+      self._index_deferred += 1
+    try:
+      yield
+    finally:
+      with self._lock:
+        self._index_deferred -= 1
+        if self._index_deferred == 0:
+          self._write_index()
+
+  def remove_images(self, tile_id: str, interval_id: int = None):
+    '''
+      Remove an interval (or the whole tile if `interval_id` is None) from the tile manifest and the global index.
+    '''
+    with self._lock:
+      if interval_id is None:
+        self._update_index(tile_id, None)
+        return
+
+      def update_tile(manifest):
+        manifest['images'].pop(str(interval_id), None)
+        return manifest
+
+      manifest = self._update(self._tile_key(tile_id), update_tile, self._empty_tile(tile_id))
+      self._update_index(tile_id, manifest)
+
+  def rebuild_tile(self, tile_id: str, update_index: bool = True, manifest: dict = None):
+    '''
+      Rebuild the manifest for a Tile ID from a listing of S3 (or `manifest` if already listed) and update the global
+      index.
+    '''
+    print(f'Rebuilding manifest for Tile ID {tile_id}...')
+    manifest = manifest or self._list_tile(tile_id)
+
+    with self._lock:
+      self._update(self._tile_key(tile_id), lambda _: manifest, self._empty_tile(tile_id))
+      if update_index:
+        self._update_index(tile_id, manifest if len(manifest['images']) > 0 else None)
+
+    return manifest
+
+  def rebuild(self):
+    '''
+      Rebuild the manifests for all tiles and the global index from a listing of S3.
+    '''
+    print('Rebuilding manifest index...')
+    prefix = f'{self._root_path}/'
+    tiles = []
+    for page in self._s3.get_paginator('list_objects_v2').paginate(Bucket=self._bucket, Prefix=prefix, Delimiter='/'):
+      tiles += [tile['Prefix'][len(prefix):].split('/')[0] for tile in page.get('CommonPrefixes', [])]
+
+    with ThreadPoolExecutor(max_workers=self._list_workers) as executor:
+      tiles = sorted(tiles)
+      manifests = dict(zip(tiles, executor.map(lambda tile_id: self.rebuild_tile(tile_id, update_index=False), tiles)))
+    index = {'updated': self._now(),
+             'tiles': {tile_id: self._index_entry(manifest) for tile_id, manifest in manifests.items()
+                       if len(manifest['images']) > 0}}
+
+    with self._lock:
+      self._update(self._index_key(), lambda _: index, index)
+      # The listing has every change which was not written yet
+      self._index_changes = {}
+
+    return index
+
+  def _update_index(self, tile_id: str, manifest: dict):
+    '''
+      Change the index entry of a Tile ID to `manifest` (removed if None). Written now unless deferred.
+      Must be called with the lock held.
+    '''
+    self._index_changes[tile_id] = manifest
+    if self._index_deferred == 0:
+      self._write_index()
+
+  def _write_index(self):
+    '''
+      Write the index changes in one update. They are kept for the next write if it fails.
+      Must be called with the lock held.
+    '''
+    if len(self._index_changes) == 0:
+      return
+
+    def update_index(index):
+      for tile_id, manifest in self._index_changes.items():
+        if manifest is None:
+          index['tiles'].pop(tile_id, None)
+        else:
+          index['tiles'][tile_id] = self._index_entry(manifest)
+      return index
+
+    try:
+      self._update(self._index_key(), update_index, {'updated': self._now(), 'tiles': {}})
+    except ManifestUpdateError as e:
+      print(f'Index not updated for Tile IDs {sorted(self._index_changes)}: {e} It is updated with the next change or '
+            'can be repaired by rebuilding the manifest.')
+      return
+
+    self._index_changes = {}
+
+  def _update(self, key: str, fn: callable, default: dict):
+    '''
+      Read-modify-write an object conditional on its ETag. Retried with exponential backoff if another writer got there
+      first. Raises ManifestUpdateError once out of retries.
+    '''
+    for attempt in range(self._retries):
+      data, etag = self._read(key)
+      data = fn(data if data is not None else default)
+      data['updated'] = self._now()
+      condition = {'IfMatch': etag} if etag is not None else {'IfNoneMatch': '*'}
+      try:
+        self._s3.put_object(Bucket=self._bucket, Key=key, Body=json.dumps(data).encode(),
+                            ContentType='application/json', **condition)
+        return data
+
+      except ClientError as e:
+        if e.response['Error']['Code'] not in ['PreconditionFailed', 'ConditionalRequestConflict']:
+          raise e
+
+      # Full jitter so writers which conflicted together don't retry together
+      if attempt < self._retries - 1:
+        time.sleep(random.uniform(0, min(self._backoff * 2 ** attempt, self._max_backoff)))
+
+    raise ManifestUpdateError(f'Could not update {key} after {self._retries} attempts.')
+
+  def _read(self, key: str):
+    try:
+      r = self._s3.get_object(Bucket=self._bucket, Key=key)
+      return json.loads(r['Body'].read()), r['ETag']
+
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'NoSuchKey':
+        raise e
+
+      return None, None
+
+  def _list_tile(self, tile_id: str):
+    '''
+      Manifest for a Tile ID from a listing of S3.
+    '''
+    manifest = self._empty_tile(tile_id)
+    prefix = f'{self._root_path}/{tile_id}/'
+    for obj in self._list(prefix):
+      parts = obj['Key'][len(prefix):].split('/')
+      # Images and the TileJSON of their XYZ tiles
+      if len(parts) != 2 or not parts[0].isdigit() or not parts[1].endswith(('.tif', '-xyz.json')):
+        continue
+      level = parts[1].rsplit('.', 1)[0]
+      manifest['images'].setdefault(parts[0], {})[level] = {'size': obj['Size'], 'etag': obj['ETag']}
+
+    return manifest
+
+  def _list(self, prefix: str):
+    for page in self._s3.get_paginator('list_objects_v2').paginate(Bucket=self._bucket, Prefix=prefix):
+      for obj in page.get('Contents', []):
+        yield obj
+
+  def _index_entry(self, manifest: dict):
+    return {id: sorted(levels.keys()) for id, levels in manifest['images'].items()}
+
+  def _empty_tile(self, tile_id: str):
+    return {'tile_id': tile_id, 'updated': self._now(), 'images': {}}
+
+  def _tile_key(self, tile_id: str):
+    return f'{self._root_path}/{tile_id}/manifest.json'
+
+  def _index_key(self):
+    return f'{self._root_path}/index.json'
+
+  def _now(self):
+    return datetime.now().isoformat()
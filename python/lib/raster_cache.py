@@ -0,0 +1,114 @@
+import os
+import hashlib
+from diskcache import Cache
+
+from .stats import stage, add
+
+
+class RasterCache():
+  '''
+    Size bounded on-disk cache of rasters downloaded from S3 so repeated processing of a tile on a worker reads
+    local disk instead of S3.
+
+    Entries are keyed by S3 key and ETag so a replaced object is never served stale, and their size and checksum are
+    checked against the ones they were stored with on every read. The least recently used entries are evicted once the size
+    limit is reached, one per file added as the rasters are of a similar size. The cache is backed by diskcache
+    (SQLite) so it is safe to share between the threads and processes of a node.
+
+    Rasters derived from an S3 object (eg intermediates) can be cached against its ETag with `get` and `put`.
+
+    Parameters
+    ----------
+    - s3: S3 client
+    - bucket: str - S3 bucket
+    - directory: str - Cache directory
+    - size_limit: int - Size limit in MB. The cache is disabled if 0. The cache directory is only created once the
+        cache is first used.
+  '''
+
+  _copy_buffer_size = 16 * 1024**2
+
+  def __init__(self, s3, bucket: str, directory: str, size_limit: int):
+    self._s3 = s3
+    self._bucket = bucket
+    self._directory = directory
+    self._size_limit = size_limit
+    self._cache_instance = None
+
+  @property
+  def enabled(self):
+    return self._size_limit > 0
+
+  @property
+  def _cache(self):
+    # Created on first use so processes which never read rasters (eg the API) don't create the directory
+    if self._cache_instance is None and self.enabled:
+      self._cache_instance = Cache(self._directory, size_limit=self._size_limit * 1024**2, 
+                                   eviction_policy='least-recently-used', cull_limit=1)
+    return self._cache_instance
+
+  def etag(self, key: str):
+    return self._s3.head_object(Bucket=self._bucket, Key=key)['ETag']
+
+  def download_file(self, key: str, filename: str, etag: str = None):
+    '''
+      Download an S3 object to `filename` from the cache, or from S3 if it is not cached. Returns its ETag, or None if
+      the cache is disabled and it was not provided.
+    '''
+    if etag is None and self.enabled:
+      etag = self.etag(key)
+
+    if self.get((key, etag), filename):
+      print(f'Copied cached {key} to {filename}.')
+      return etag
+
+    print(f'Downloading {key} to {filename}...')
+    with stage('download'):
+      self._s3.download_file(Bucket=self._bucket, Key=key, Filename=filename)
+    add('download', bytes_downloaded=os.path.getsize(filename))
+    self.put((key, etag), filename)
+
+    return etag
+
+  def get(self, key: tuple, filename: str):
+    '''
+      Copy a cached file to `filename`. Returns False if it is not cached or the cached copy is corrupt.
+    '''
+    if self._cache is None:
+      return False
+
+    value, tag = self._cache.get(key, read=True, tag=True)
+    if value is None:
+      return False
+
+    digest = hashlib.blake2b(digest_size=16)
+    with stage('cache'), value as src, open(filename, 'wb') as dst:
+      while chunk := src.read(self._copy_buffer_size):
+        digest.update(chunk)
+        dst.write(chunk)
+
+    if tag != f'{os.path.getsize(filename)}-{digest.hexdigest()}':
+      print(f'Cached {key} is corrupt. Evicting...')
+      self._cache.delete(key)
+      os.remove(filename)
+      return False
+
+    return True
+
+  def put(self, key: tuple, filename: str):
+    '''
+      Add a file to the cache. Evicts the least recently used files if the size limit is reached.
+    '''
+    if self._cache is None:
+      return
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+      while chunk := f.read(self._copy_buffer_size):
+        digest.update(chunk)
+      f.seek(0)
+      self._cache.set(key, f, read=True, tag=f'{os.path.getsize(filename)}-{digest.hexdigest()}')
+
+  def clear(self):
+    if self._cache is not None:
+      self._cache.clear()
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+# No data value of the RGB bands. A pixel is missing in a band where its value is 0.
+NO_DATA_VALUE = 0
+
+
+def fill_series(rgba: np.ndarray):
+  '''
+    Impute missing values of an RGBA stack with forward fill and back fill along time, in place on the integer data.
+    Each RGB band is filled independently using 0 as the no data value and the alpha band is recomputed.
+
+    Parameters
+    ----------
+    - rgba: np.ndarray - RGBA of shape (time, band, ...) uint8 with 0 for missing values
+
+    Returns the filled `rgba`
+  '''
+  _ffill(rgba[:, :3])
+  _bfill(rgba[:, :3])
+  for t in range(len(rgba)):
+    rgba[t, 3] = alpha(rgba[t, :3])
+  
+  return rgba
+
+def fill_update(rgba: np.ndarray, last: np.ndarray):
+  '''
+    Continue the forward fill of an RGBA stack with new intervals from the last valid RGB values, in place.
+    Pixels which were never valid before are back filled with their first valid value in the new intervals.
+
+    Parameters
+    ----------
+    - rgba: np.ndarray - RGBA of the new intervals of shape (time, band, pixels) uint8 with 0 for missing values
+    - last: np.ndarray - Last valid RGB values of shape (3, pixels) uint8 with 0 where never valid
+
+    Returns (filled RGBA of the new intervals, new last valid RGB values, first valid RGB values of pixels which were
+    never valid before with 0 elsewhere). The earlier intervals need to be filled with the first valid values.
+  '''
+  never_valid = last == NO_DATA_VALUE
+  np.copyto(rgba[0, :3], last, where=rgba[0, :3] == NO_DATA_VALUE)
+  fill_series(rgba)
+  first_valid = np.where(never_valid, rgba[0, :3], NO_DATA_VALUE).astype(rgba.dtype)
+
+  return rgba, rgba[-1, :3].copy(), first_valid
+
+def alpha(rgb: np.ndarray):
+  '''
+    Alpha band which is transparent where none of the RGB bands are valid. `rgb` is of shape (3, ...)
+  '''
+  return np.where(np.all(rgb == NO_DATA_VALUE, axis=0), 0, 255).astype(np.uint8)
+
+def _ffill(a: np.ndarray):
+  for t in range(1, len(a)):
+    np.copyto(a[t], a[t - 1], where=a[t] == NO_DATA_VALUE)
+
+def _bfill(a: np.ndarray):
+  for t in range(len(a) - 2, -1, -1):
+    np.copyto(a[t], a[t + 1], where=a[t] == NO_DATA_VALUE)
@@ -0,0 +1,220 @@
+import os
+import io
+import time
+import uuid
+import pstats
+import psutil
+import cProfile
+import tracemalloc
+from datetime import datetime
+from threading import Thread, Event, Lock
+from contextlib import contextmanager, nullcontext
+
+
+_current = None
+
+
+class RunStats():
+  '''
+    Statistics of the stages (eg download, mask, cog, stack, map_blocks, write, upload) of a run for a Tile ID and
+    level, saved to the `run_stats` table. A stage sums its wall time, bytes downloaded and uploaded and blocks over
+    every time it is entered, from any thread, and keeps the peak memory (RSS of the process and its children)
+    sampled while it runs.
+
+    Set GEOMAP_PROFILE to `cprofile` and/or `tracemalloc` (comma separated) to also profile the run. The top
+    functions by cumulative time (main thread) and the top allocations are saved with the totals of the run in the
+    `run` stage, and the cProfile stats are dumped to GEOMAP_PROFILE_DIR (default .geomap/profiles).
+
+    Use `run_stats` to start a run, and `stage` and `add` to record into the current run from anywhere. Stages are
+    recorded for the level of the run or the one set with `for_level`.
+
+    Parameters
+    ----------
+    - tile_id: str - Tile ID
+    - level: str - Level of the run eg 'raw', 'rgba'. Stages can be recorded for another level.
+  '''
+
+  _interval = 0.1
+  _profile_top = 30
+  _profile_dir = os.environ.get('GEOMAP_PROFILE_DIR', os.path.join('.geomap', 'profiles'))
+
+  def __init__(self, tile_id: str, level: str):
+    self.run_id = uuid.uuid4()
+    self.tile_id = tile_id
+    self.level = level
+    self.stages = {}
+    self.current_level = level
+    self._active = {}
+    self._lock = Lock()
+    self._stop = Event()
+    self._process = psutil.Process()
+    self._profilers = [p.strip() for p in os.environ.get('GEOMAP_PROFILE', '').split(',') if p.strip() != '']
+    self._cprofile = None
+
+  def __enter__(self):
+    self._started = datetime.now()
+    self._start_time = time.perf_counter()
+    self._active[(self.level, 'run')] = 1
+    self._stage(self.level, 'run')
+    self._thread = Thread(target=self._sample, daemon=True)
+    self._thread.start()
+
+    if 'tracemalloc' in self._profilers:
+      tracemalloc.start()
+    if 'cprofile' in self._profilers:
+      self._cprofile = cProfile.Profile()
+      self._cprofile.enable()
+
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    profile = self._stop_profilers()
+    self._stop.set()
+    self._thread.join()
+    self.add('run', self.level, wall_time=time.perf_counter() - self._start_time, calls=1)
+    self.stages[(self.level, 'run')]['profile'] = profile
+
+    self.print()
+    self.save()
+
+  @contextmanager
+  def stage(self, name: str, level: str = None):
+    '''
+      Time a stage. Counts can be added to it with `add`.
+    '''
+    key = (level or self.current_level, name)
+    with self._lock:
+      self._stage(*key)
+      self._active[key] = self._active.get(key, 0) + 1
+
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add(name, key[0], wall_time=time.perf_counter() - started, calls=1)
+      with self._lock:
+        self._active[key] -= 1
+
+  def add(self, name: str, level: str = None, **counts):
+    '''
+      Add to the counts of a stage - wall_time, calls, bytes_downloaded, bytes_uploaded, blocks
+    '''
+    with self._lock:
+      stage = self._stage(level or self.current_level, name)
+      for key, value in counts.items():
+        stage[key] += value
+
+  def print(self):
+    for (level, name), stage in self.stages.items():
+      peak_memory = f'{stage["peak_memory"] / 1024**2:.0f}MB' if stage['peak_memory'] is not None else '-'
+      print(f'{level}/{name}: {stage["wall_time"]:.2f}s in {stage["calls"]} calls, peak memory {peak_memory}, '
+            f'{stage["bytes_downloaded"] / 1024**2:.1f}MB downloaded, {stage["bytes_uploaded"] / 1024**2:.1f}MB '
+            f'uploaded, {stage["blocks"]} blocks')
+
+  def save(self):
+    '''
+      Save the stats to the `run_stats` table. Failures are printed and don't fail the run.
+    '''
+    try:
+      from .db.RunStat import RunStat
+
+      RunStat.insert_many([{'run_id': self.run_id, 'tile_id': self.tile_id, 'level': level, 'stage': name,
+                            'started': self._started, **stage} for (level, name), stage in self.stages.items()]).execute()
+    except Exception as e:
+      print(f'Could not save run stats - {e}')
+
+  def _stage(self, level: str, name: str):
+    return self.stages.setdefault((level, name), {'calls': 0, 'wall_time': 0, 'peak_memory': None,
+                                                  'bytes_downloaded': 0, 'bytes_uploaded': 0, 'blocks': 0,
+                                                  'profile': None})
+
+  def _sample(self):
+    while not self._stop.wait(self._interval):
+      rss = self._rss()
+      with self._lock:
+        for key, active in self._active.items():
+          if active > 0:
+            stage = self.stages[key]
+            stage['peak_memory'] = max(stage['peak_memory'] or 0, rss)
+
+  def _rss(self):
+    rss = 0
+    for process in [self._process] + self._process.children(recursive=True):
+      try:
+        rss += process.memory_info().rss
+      except psutil.Error:
+        pass
+
+    return rss
+
+  def _stop_profilers(self):
+    profile = []
+    if self._cprofile is not None:
+      self._cprofile.disable()
+      os.makedirs(self._profile_dir, exist_ok=True)
+      path = os.path.join(self._profile_dir, f'{self.tile_id}-{self.level}-{self.run_id}.prof')
+      self._cprofile.dump_stats(path)
+      print(f'Saved cProfile stats to {path}.')
+
+      s = io.StringIO()
+      pstats.Stats(self._cprofile, stream=s).sort_stats('cumulative').print_stats(self._profile_top)
+      profile.append(s.getvalue())
+
+    if tracemalloc.is_tracing() and 'tracemalloc' in self._profilers:
+      snapshot = tracemalloc.take_snapshot()
+      _, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+
+      profile.append(f'tracemalloc peak: {peak / 1024**2:.1f}MB')
+      profile += [str(stat) for stat in snapshot.statistics('lineno')[:self._profile_top]]
+
+    return '\n'.join(profile) if len(profile) > 0 else None
+
+
+@contextmanager
+def run_stats(tile_id: str, level: str):
+  '''
+    Record the stats of a run for a Tile ID and level. Runs started inside another run are part of the outer run.
+  '''
+  global _current
+  if _current is not None:
+    yield _current
+    return
+
+  with RunStats(tile_id, level) as stats:
+    _current = stats
+    try:
+      yield stats
+    finally:
+      _current = None
+
+def stage(name: str, level: str = None):
+  '''
+    Time a stage of the current run. Does nothing outside a run.
+  '''
+  if _current is None:
+    return nullcontext()
+
+  return _current.stage(name, level)
+
+def add(name: str, level: str = None, **counts):
+  '''
+    Add to the counts of a stage of the current run. Does nothing outside a run.
+  '''
+  if _current is not None:
+    _current.add(name, level, **counts)
+
+@contextmanager
+def for_level(level: str):
+  '''
+    Record the stages of the current run for another level eg a level of a run processing several levels.
+  '''
+  if _current is None:
+    yield
+    return
+
+  previous, _current.current_level = _current.current_level, level
+  try:
+    yield
+  finally:
+    _current.current_level = previous
@@ -0,0 +1,77 @@
+import numpy as np
+import geopandas as gpd
+from shapely import STRtree
+from shapely.geometry import box, Point
+
+
+class TileIndex():
+  '''
+    Spatial index (STRtree) of the GLAD ARD tile grid for viewport (bbox) and point queries, so responses only carry
+    the tiles in view.
+
+    Parameters
+    ----------
+    - tiles: gpd.GeoDataFrame - Tile grid with the Tile IDs in a `TILE` column, in lon/lat
+  '''
+
+  _max_simplified = 8
+
+  def __init__(self, tiles: gpd.GeoDataFrame):
+    self._tiles = tiles.reset_index(drop=True)
+    self.tile_ids = self._tiles['TILE'].to_numpy()
+    self._tree = STRtree(self._tiles.geometry.to_numpy())
+    self._simplified = {}
+
+  def query_bbox(self, bbox: tuple, tile_ids: set = None):
+    '''
+      Tile IDs intersecting a bbox, sorted.
+
+      Parameters
+      ----------
+      - bbox: tuple - (min lon, min lat, max lon, max lat)
+      - tile_ids: set optional - Only return these Tile IDs eg the processed tiles
+    '''
+    return sorted(self._filter(self.tile_ids[self._query_bbox(bbox)], tile_ids))
+
+  def query_point(self, lon: float, lat: float):
+    '''
+      Tile ID at a lon/lat or None. The first by Tile ID on shared edges.
+    '''
+    idx = self._tree.query(Point(lon, lat), predicate='intersects')
+    return min(self.tile_ids[idx]) if len(idx) > 0 else None
+
+  def to_geo_dict(self, bbox: tuple = None, tile_ids: set = None, simplify: float = None):
+    '''
+      GeoJSON dict of the tiles intersecting a bbox (all if None).
+
+      Parameters
+      ----------
+      - bbox: tuple optional - (min lon, min lat, max lon, max lat)
+      - tile_ids: set optional - Only include these Tile IDs
+      - simplify: float optional - Tolerance in degrees to simplify the geometries with
+    '''
+    idx = self._query_bbox(bbox) if bbox is not None else np.arange(len(self._tiles))
+    if tile_ids is not None:
+      idx = idx[np.isin(self.tile_ids[idx], list(tile_ids))]
+
+    idx = np.sort(idx)
+    tiles = self._tiles.iloc[idx]
+    if simplify:
+      tiles = tiles.set_geometry(gpd.GeoSeries(self._simplify(simplify)[idx], index=tiles.index, crs=tiles.crs))
+
+    return tiles.to_geo_dict()
+
+  def _query_bbox(self, bbox: tuple):
+    return self._tree.query(box(*bbox), predicate='intersects')
+
+  def _filter(self, ids: np.ndarray, tile_ids: set):
+    return ids if tile_ids is None else [id for id in ids if id in tile_ids]
+
+  def _simplify(self, tolerance: float):
+    # Simplified geometries are kept for the last few tolerances
+    if tolerance not in self._simplified:
+      if len(self._simplified) >= self._max_simplified:
+        self._simplified.pop(next(iter(self._simplified)))
+      self._simplified[tolerance] = self._tiles.geometry.simplify(tolerance, preserve_topology=True).to_numpy()
+
+    return self._simplified[tolerance]
\ No newline at end of file
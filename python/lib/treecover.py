@@ -0,0 +1,274 @@
+import gc
+import time
+import dask
+import rasterio
+import numpy as np
+from tqdm import tqdm
+from rasterio.windows import Window
+
+from .util import qf_valid_mask, block_windows, DaskScheduler
+from .stats import stage, add
+
+
+# Per pixel state needed to continue the treecover timeseries with new intervals
+# - f3, f2, f1: last 3 filled NDVI values (oldest first)
+# - asum: running sum of the 3 period rolling mean
+# - max: max of the rolling mean
+# - cl3, cl2, cl1: last 3 cumulative tree loss values (oldest first)
+# - amean, assqdm: running mean and sum of squared differences of the 3 period rolling std
+STATE_BANDS = ['f3', 'f2', 'f1', 'asum', 'max', 'cl3', 'cl2', 'cl1', 'amean', 'assqdm']
+
+# The rolling mean/std are computed by bottleneck in xarray. These reproduce its moving window arithmetic
+# (operation order and precision) so results are bit-identical and can be continued from a saved state.
+_window = 3
+_window_inv = 1.0 / _window
+_count_inv = np.float32(1.0 / _window)
+
+
+def compute_ndvi(red: np.ndarray, nir: np.ndarray, qf: np.ndarray):
+  '''
+    NDVI (NIR-RED)/(NIR+RED) as float32 with NaN where the qf band is not valid.
+    Integer bands are not upcast before the arithmetic, same as the GLAD ARD raw images have always been processed.
+  '''
+  with np.errstate(divide='ignore', invalid='ignore'):
+    ndvi = (nir - red) / (nir + red)
+  return np.where(qf_valid_mask(qf), ndvi, np.nan).astype(np.float32)
+
+def treecover_series(ndvi: np.ndarray, ndvi_diff_cut_trees: float, ndvi_tree_lower_bound: float):
+  '''
+    Treecover timeseries (0 = tree, 1 = no tree) for a stack of NDVI values.
+
+    Parameters
+    ----------
+    - ndvi: np.ndarray - NDVI of shape (time, pixels) with NaN for missing values
+    - ndvi_diff_cut_trees: float - The difference in NDVI for a tree which has been cut
+    - ndvi_tree_lower_bound: float - Lower bound of what a tree's NDVI would be in a dense forest
+
+    Returns (treecover of shape (time, pixels) float32, state of shape (len(STATE_BANDS), pixels) float64)
+  '''
+  n_pixels = ndvi.shape[1]
+  # Back fill is the first valid value
+  first = np.take_along_axis(ndvi, np.argmax(~np.isnan(ndvi), axis=0)[None], axis=0)[0].astype(np.float32)
+  valid = ~np.isnan(first)
+  state = np.zeros((len(STATE_BANDS), n_pixels), np.float64)
+  state[[0, 1, 2, 4]] = np.nan
+  state[2] = first
+
+  treecover, state, _, _ = _run(ndvi, valid, state, 0, ndvi_diff_cut_trees, ndvi_tree_lower_bound)
+  return treecover, state
+
+def treecover_update(ndvi: np.ndarray, state: np.ndarray, length: int, ndvi_diff_cut_trees: float,
+                     ndvi_tree_lower_bound: float):
+  '''
+    Continue a treecover timeseries with new intervals from its saved state.
+    Pixels where the new intervals change the history are flagged instead of being computed -
+    - dirty: the max NDVI moved the tree loss threshold, so past tree loss needs to be recomputed
+    - new: pixels which were never valid before, so the history is back filled with the first new value
+
+    Parameters
+    ----------
+    - ndvi: np.ndarray - NDVI of the new intervals of shape (time, pixels) with NaN for missing values
+    - state: np.ndarray - State of shape (len(STATE_BANDS), pixels) from `treecover_series` or `treecover_update`
+    - length: int - Number of intervals the state was computed from. Must be at least 3.
+    - ndvi_diff_cut_trees: float - The difference in NDVI for a tree which has been cut
+    - ndvi_tree_lower_bound: float - Lower bound of what a tree's NDVI would be in a dense forest
+
+    Returns (treecover of the new intervals, new state, dirty mask, new mask). Values of dirty and new pixels are
+    undefined in the returned treecover and state.
+  '''
+  if length < _window:
+    raise Exception(f'Treecover state needs at least {_window} intervals. Found {length}.')
+
+  was_valid = ~np.isnan(state[2])
+  new = ~was_valid & ~np.isnan(ndvi).all(axis=0)
+  treecover, state, threshold, threshold_old = _run(ndvi, was_valid, state, length, ndvi_diff_cut_trees, 
+                                                    ndvi_tree_lower_bound)
+  dirty = was_valid & (threshold != threshold_old)
+
+  return treecover, state, dirty, new
+
+def _run(ndvi: np.ndarray, valid: np.ndarray, state: np.ndarray, start: int, ndvi_diff_cut_trees: float,
+         ndvi_tree_lower_bound: float):
+  '''
+    Fused treecover kernel. Runs the whole recurrence along time with (pixels,) sized float32/int32 state:
+    1 pass for the fill and rolling mean into the output buffer and 1 pass for the tree loss.
+    `state` holds the values before `start`. Pixels which are not `valid` have NaN treecover.
+  '''
+  # Ring buffers of the last 3 values indexed by interval % 3. Missing pixels are 0 so they don't change the sums.
+  f_ring = np.empty((_window, ndvi.shape[1]), np.float32)
+  cl_ring = np.empty((_window, ndvi.shape[1]), np.int32)
+  for k in range(_window):
+    f_ring[(start - _window + k) % _window] = state[k]
+    cl_ring[(start - _window + k) % _window] = state[5 + k]
+  f_ring[:, ~valid] = 0
+  prev = f_ring[(start - 1) % _window].copy()
+  asum = state[3].astype(np.float32)
+  maxv_old = state[4].astype(np.float32)
+
+  # Forward fill, clip outliers to known NDVI values = (-1, 1) and take the rolling mean (3 periods) to smoothen 
+  # for seasonal variances
+  treecover = np.empty(ndvi.shape, np.float32)
+  for t in range(len(ndvi)):
+    i = start + t
+    f = np.where(np.isnan(ndvi[t]), prev, ndvi[t])
+    np.clip(f, -1, 1, out=f)
+    if i < _window:
+      asum = asum + f
+      treecover[t] = asum / np.float32(i + 1)
+    else:
+      asum = asum + (f - f_ring[i % _window])
+      np.multiply(asum, _count_inv, out=treecover[t])
+    f_ring[i % _window] = f
+    prev = f
+
+  treecover[:, ~valid] = np.nan
+  maxv = np.fmax(maxv_old, np.max(treecover, axis=0, initial=-np.inf))
+  maxv[~valid] = np.nan
+  threshold = _threshold(maxv, ndvi_diff_cut_trees, ndvi_tree_lower_bound)
+
+  # Tree loss only needs to be tracked for pixels with any loss. The rest have 0 cumulative loss and std state.
+  loss = treecover < threshold
+  active = np.flatnonzero((cl_ring[(start - 1) % _window] > 0) | loss.any(axis=0))
+  loss = loss[:, active]
+  cl_active = cl_ring[:, active]
+  loss, amean, assqdm = _treecover(loss, cl_active, state[8, active], state[9, active], start)
+  cl_ring[:, active] = cl_active
+
+  # Mark all tree loss for all future time points unless re-growth detected for 3 periods
+  treecover[:] = np.where(valid, 0, np.nan)
+  treecover[:, active] = np.where(valid[active], loss, np.nan)
+
+  n = start + len(ndvi)
+  f_state = np.stack([f_ring[(n - _window + k) % _window] for k in range(_window)])
+  f_state = np.where(valid, f_state, np.nan)
+  if n < _window:
+    f_state[:_window - n] = np.nan
+  state = state.copy()
+  state[0:3] = f_state
+  state[3] = asum
+  state[4] = maxv
+  state[5:8] = 0
+  state[8:10] = 0
+  for k in range(_window):
+    state[5 + k, active] = cl_ring[(n - _window + k) % _window, active]
+  state[8, active] = amean
+  state[9, active] = assqdm
+  
+  return treecover, state, threshold, _threshold(maxv_old, ndvi_diff_cut_trees, ndvi_tree_lower_bound)
+
+def _threshold(maxv: np.ndarray, ndvi_diff_cut_trees: float, ndvi_tree_lower_bound: float):
+  '''
+    If the difference in NDVI is more than a known value than it usually indicates that tree has been cut.
+    Clip lower bounds to a known NDVI value for trees.
+  '''
+  return (maxv - ndvi_diff_cut_trees).clip(min=ndvi_tree_lower_bound)
+
+def _treecover(loss: np.ndarray, cl_ring: np.ndarray, amean: np.ndarray, assqdm: np.ndarray, start: int):
+  '''
+    Cumulative tree loss and its 3 period rolling std, which is 0 when re-growth is detected. Returns the treecover
+    (1 where there is tree loss without re-growth) and updates `cl_ring` in place.
+  '''
+  amean = amean.astype(np.float64)
+  assqdm = assqdm.astype(np.float64)
+  cl = cl_ring[(start - 1) % _window].copy() if start > 0 else np.zeros(loss.shape[1], np.int32)
+  ai, aold, delta = (np.empty(loss.shape[1], np.float64) for _ in range(3))
+  treecover = np.empty(loss.shape, np.float32)
+  for t in range(len(loss)):
+    i = start + t
+    cl += loss[t]
+    ai[:] = cl
+    if i < _window:
+      np.subtract(ai, amean, out=delta)
+      amean += delta / (i + 1)
+      ai -= amean
+      ai *= delta
+      assqdm += ai
+      regrowth = np.sqrt(assqdm / (i + 1)) == 0 if i == _window - 1 else False
+    else:
+      aold[:] = cl_ring[i % _window]
+      np.subtract(ai, aold, out=delta)
+      aold -= amean
+      amean += delta * _window_inv
+      ai -= amean
+      ai += aold
+      ai *= delta
+      assqdm += ai
+      np.maximum(assqdm, 0, out=assqdm)
+      regrowth = np.sqrt(assqdm * _window_inv) == 0
+    cl_ring[i % _window] = cl
+    np.logical_and(~regrowth, cl > 0, out=treecover[t], casting='unsafe')
+  return treecover, amean, assqdm
+
+def write_treecover(ndvi_tifs: list, output_tifs: list, state_tif: str, ndvi_diff_cut_trees: float, 
+                    ndvi_tree_lower_bound: float, block_size: int = 512, scheduler: DaskScheduler = None,
+                    progress = None):
+  '''
+    Compute the treecover timeseries for a stack of NDVI GeoTIFFs block by block with the fused kernel. 
+    Writes the treecover to `output_tifs` and its state to `state_tif` with a band per STATE_BANDS.
+    Blocks are computed on `scheduler` and an interrupted run continues from `progress` (see `raster_map_blocks`).
+  '''
+  scheduler = scheduler or DaskScheduler()
+  block_size = scheduler.block_size(ndvi_tifs, block_size)
+
+  with rasterio.open(ndvi_tifs[0]) as src:
+    new_meta = src.meta.copy()
+    new_meta.update(tiled=True, blockxsize=block_size, blockysize=block_size, sparse_ok=True)
+    windows = [window for _, window in block_windows(src.width, src.height, block_size)]
+
+  completed = progress.start(block_size, output_tifs + [state_tif]) if progress is not None else set()
+  if len(completed) == 0:
+    for output_tif in output_tifs:
+      with rasterio.open(output_tif, 'w', **new_meta):
+        pass
+    with rasterio.open(state_tif, 'w', **state_profile(new_meta, block_size)):
+      pass
+
+  def run(window):
+    started = time.perf_counter()
+    ndvi = read_stack(ndvi_tifs, window)
+    stacked = time.perf_counter()
+    treecover, state = treecover_series(ndvi, ndvi_diff_cut_trees, ndvi_tree_lower_bound)
+    return treecover, state, {'stack': stacked - started, 'map_blocks': time.perf_counter() - stacked}
+
+  remaining = [i for i in range(len(windows)) if i not in completed]
+  tasks = [dask.delayed(run)(windows[i]) for i in remaining]
+  batch_size = scheduler.workers
+
+  print(f'Computing treecover on a stack of {len(ndvi_tifs)} tifs in {len(windows)} blocks of {block_size}...')
+  with tqdm(total=len(windows), initial=len(completed)) as progress_bar:
+    for i in range(0, len(tasks), batch_size):
+      with stage('compute'):
+        blocks = scheduler.compute(tasks[i:i + batch_size])
+      for index, (treecover, state, timings) in zip(remaining[i:i + batch_size], blocks):
+        window = windows[index]
+        add('stack', wall_time=timings['stack'], calls=1)
+        add('map_blocks', wall_time=timings['map_blocks'], calls=1, blocks=1)
+        with stage('write'):
+          for band_index, output_tif in enumerate(output_tifs):
+            with rasterio.open(output_tif, 'r+') as dst:
+              dst.write(treecover[band_index].reshape(1, window.height, window.width), window=window)
+          with rasterio.open(state_tif, 'r+') as state_dst:
+            state_dst.write(state.reshape(-1, window.height, window.width), window=window)
+        progress_bar.update(1)
+
+      if progress is not None:
+        progress.add(remaining[i:i + batch_size])
+
+      del blocks
+      gc.collect()
+
+def state_profile(meta: dict, block_size: int = 512):
+  profile = meta.copy()
+  profile.update(driver='GTiff', count=len(STATE_BANDS), dtype='float64', nodata=None, tiled=True, sparse_ok=False,
+                 blockxsize=block_size, blockysize=block_size, compress='zstd', zstd_level=1, predictor=3)
+  return profile
+
+def read_stack(tifs: list, window: Window):
+  '''
+    Read a window of single band GeoTIFFs as an array of shape (time, pixels)
+  '''
+  stack = np.empty((len(tifs), window.height * window.width), np.float32)
+  for i, tif in enumerate(tifs):
+    with rasterio.open(tif) as src:
+      stack[i] = src.read(1, window=window).ravel()
+  return stack
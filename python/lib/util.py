@@ -1,99 +1,521 @@
 import os
 import gc
-import warnings
+import json
+import time
 import rasterio
-import shutil
+import threading
+import dask
+import importlib.util
 import xarray as xr
 import numpy as np
 from tqdm import tqdm
-from tempfile import TemporaryDirectory
+from datetime import datetime
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from rio_cogeo.cogeo import cog_translate
+from rio_cogeo.utils import get_maximum_overview_level
 from rasterio import MemoryFile
+from rasterio.windows import Window
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as copy_raster
 from rio_cogeo.profiles import cog_profiles
+from boto3.s3.transfer import TransferConfig
 
+from .stats import stage, add
 
-warnings.filterwarnings(action='ignore', category=UserWarning, 
-                        message="Consolidated metadata is currently not part in the Zarr format 3 specification. It "
-                                "may not be supported by other zarr implementations and may change in the future.")
 
+class InvalidImageError(Exception):
+  '''
+    Raised when an image fails validation. Carries the valid pixel percentage so it can be recorded
+    even when raised in a worker process.
+  '''
+  def __init__(self, message: str, valid_pixel_percentage: float = 0):
+    super().__init__(message, valid_pixel_percentage)
+    self.valid_pixel_percentage = valid_pixel_percentage
+
+  def __str__(self):
+    return self.args[0]
+
+
+class MemoryBudget():
+  '''
+    Memory budget shared between threads. Reservations block until enough of the budget is free.
+    A single reservation larger than the whole budget is allowed once nothing else is reserved.
+
+    Parameters
+    ----------
+    - limit: int - Budget in bytes
+  '''
+  def __init__(self, limit: int):
+    self.limit = limit
+    self.reserved = 0
+    self._condition = threading.Condition()
+
+  @contextmanager
+  def reserve(self, size: int):
+    with self._condition:
+      self._condition.wait_for(lambda: self.reserved == 0 or self.reserved + size <= self.limit)
+      self.reserved += size
+    try:
+      yield
+    finally:
+      with self._condition:
+        self.reserved -= size
+        self._condition.notify_all()
+
+
+# GDAL block cache in bytes of masking and converting a raw image to COG. Bounds the memory of an ingestion worker.
+MASK_GDAL_CACHEMAX = 256 * 1024 ** 2
+
+
+def qf_valid_mask(qf: np.ndarray):
+  '''
+    Valid pixel mask for a GLAD ARD qf band. Valid where qf is 1 or 15.
+    https://glad.umd.edu/Potapov/ARD/ARD_manual_v1.1.pdf pg 21
+  '''
+  return np.logical_or(qf == 1, qf == 15)
+
+def sample_valid_pixels(src: rasterio.DatasetReader, sample_blocks: int = 32):
+  '''
+    Estimate the share of valid pixels of a GLAD ARD image from a systematic sample of the blocks of its qf band
+    (band 8), spread evenly over the rows and columns of blocks so clouds in one part of the image don't dominate it.
+    Only the sampled blocks are read, so a remote image (eg over /vsicurl/) is screened with a few ranged reads.
+    Returns (share of valid pixels, standard error of the share, number of pixels sampled). The standard error is
+    computed from the variance between the sampled blocks and is 0 if every block is read.
+
+    Parameters
+    ----------
+    - src: rasterio.DatasetReader - Open raw image
+    - sample_blocks: int default=32 - Approximate number of blocks of the qf band to read
+  '''
+  blocks = dict(src.block_windows(8))
+  rows = max(i for i, _ in blocks) + 1
+  cols = max(j for _, j in blocks) + 1
+
+  # Sample rows and columns of blocks in proportion to the block grid (eg only rows for a striped image), each at
+  # the centre of an equal share of the grid
+  sample_cols = min(cols, max(1, round(np.sqrt(sample_blocks * cols / rows))))
+  sample_rows = min(rows, max(1, round(sample_blocks / sample_cols)))
+  windows = [blocks[(int((i + 0.5) * rows / sample_rows), int((j + 0.5) * cols / sample_cols))]
+             for i in range(sample_rows) for j in range(sample_cols)]
 
-def convert_to_cog_rio(input_geotiff: str, output_cog: str, add_mask: bool = True):
+  valid = np.empty(len(windows))
+  pixels = np.empty(len(windows))
+  for k, window in enumerate(windows):
+    qf = src.read(8, window=window)
+    valid[k] = qf_valid_mask(qf).sum()
+    pixels[k] = qf.size
+
+  share = valid.sum() / pixels.sum()
+  n = len(windows)
+  if n < 2:
+    return share, np.inf if n < len(blocks) else 0.0, int(pixels.sum())
+
+  # Standard error of a ratio estimate with the finite population correction
+  weights = pixels / pixels.mean()
+  variance = (1 - n / len(blocks)) * np.sum((weights * (valid / pixels - share)) ** 2) / (n * (n - 1))
+  return share, float(np.sqrt(variance)), int(pixels.sum())
+
+def mask_raw_to_cog(input_geotiff: str, output_cog: str, valid_image_pixels: float, block_size: int = 512):
+  '''
+    Mask a raw GLAD ARD image with its qf band (band 8) and convert it to a COG.
+    The masked blocks are written once, with an internal mask, to an uncompressed GeoTIFF tiled like the COG. Its
+    overviews are then added and it is copied to the COG, which puts the overviews ahead of the data as a COG needs.
+    This is the temporary file `cog_translate` would write, so the image is masked in the same pass instead of being
+    written masked and then again by `cog_translate`. Peak memory is bounded by the blocks and the GDAL block cache
+    (MASK_GDAL_CACHEMAX) rather than the image size and the peak disk use is the uncompressed image and the COG.
+    The masking is not done in a VRT fed to `cog_translate` as GDAL computes the derived bands of a VRT by reading the
+    raw image again for every band and window, which made the conversion ~75x slower.
+    Kept free of db/S3 state so it can run in a worker process.
+
+    Parameters
+    ----------
+    - input_geotiff: str - Path of the raw image
+    - output_cog: str - Path of the output COG
+    - valid_image_pixels: float - Minimum share of valid pixels for the image to be accepted
+    - block_size: int default=512 - Block size of x & y dimension
+
+    Returns the valid pixel percentage and the seconds spent masking and converting as {'mask': s, 'cog': s}.
+    Raises InvalidImageError if the image is below the threshold.
+  '''
+  started = time.perf_counter()
+  with rasterio.Env(GDAL_CACHEMAX=MASK_GDAL_CACHEMAX), rasterio.open(input_geotiff) as src:
+    windows = [window for _, window in block_windows(src.width, src.height, block_size)]
+
+    # Only the qf band is read to validate the image
+    valid_pixels = sum(qf_valid_mask(src.read(8, window=window)).sum() for window in windows)
+    valid_pixel_percentage = valid_pixels / (src.width * src.height)
+    if valid_pixel_percentage < valid_image_pixels:
+      raise InvalidImageError(f'Valid pixels in image are below threshold: {valid_pixel_percentage}', valid_pixel_percentage)
+    else:
+      print(f'Valid pixels in image are above threshold: {valid_pixel_percentage}')
+
+    cog_profile = cog_profiles.get('deflate')
+    profile = src.profile.copy()
+    profile.pop('nodata', None)
+    profile.update(cog_profile, compress=None)
+    masked_tif = output_cog.replace('.tif', '.masked.tif')
+    try:
+      with rasterio.open(masked_tif, 'w', **profile) as dst:
+        for window in windows:
+          data = src.read(window=window)
+          data[:, ~qf_valid_mask(data[7])] = 0
+          dst.write(data, window=window)
+          # The mask is where any band is not 0 as if 0 was the nodata
+          dst.write_mask((data != 0).any(axis=0).astype('uint8') * 255, window=window)
+
+        overview_level = get_maximum_overview_level(src.width, src.height, minsize=block_size)
+        dst.build_overviews([2 ** level for level in range(1, overview_level + 1)], Resampling.nearest)
+        dst.update_tags(OVR_RESAMPLING_ALG='NEAREST')
+
+      masked = time.perf_counter()
+      copy_raster(masked_tif, output_cog, copy_src_overviews=True, **cog_profile)
+    finally:
+      if os.path.exists(masked_tif):
+        os.remove(masked_tif)
+
+  return valid_pixel_percentage, {'mask': masked - started, 'cog': time.perf_counter() - masked}
+
+def block_windows(width: int, height: int, block_size: int):
+  '''
+    Square windows of `block_size` covering a raster. Yields ((row, col), window).
+  '''
+  for row, y in enumerate(range(0, height, block_size)):
+    for col, x in enumerate(range(0, width, block_size)):
+      yield (row, col), Window(x, y, min(block_size, width - x), min(block_size, height - y))
+
+def convert_to_cog_memory(input_geotiff: str, add_mask: bool = True):
   '''
-    Convert a GeoTIFF to a Cloud Optimized GeoTIFF
+    Convert a GeoTIFF to a Cloud Optimized GeoTIFF in memory. Returns the MemoryFile positioned at the start,
+    which the caller must close.
 
     Parameters
     ----------
     - input_geotiff: str - Input GeoTIFF path
-    - output_cog: str - Output GeoTIFF path
     - add_mask: bool optional - Force output dataset creation with a mask.
   '''
+  memfile = MemoryFile()
   try:
-    with MemoryFile() as memfile:
-      cog_translate(input_geotiff, memfile.name, cog_profiles.get("deflate"), add_mask=add_mask)
-      with open(output_cog, 'wb') as f:
-        f.write(memfile.read())
+    cog_translate(input_geotiff, memfile.name, cog_profiles.get("deflate"), add_mask=add_mask)
+    memfile.seek(0)
+    return memfile
   except Exception as e:
-    print(f"Error converting {input_geotiff} to {output_cog}: {e}")
+    memfile.close()
+    raise e
+
+
+class S3Uploader():
+  '''
+    Upload files and COGs to S3 in background threads with concurrent multipart uploads.
+    COGs are encoded in memory and streamed straight into S3, so encoding the next COG overlaps with uploading
+    the previous ones. Use as a context manager; leaving it waits for all uploads and raises the first error.
+
+    Parameters
+    ----------
+    - s3: S3 client
+    - bucket: str - S3 bucket
+    - max_workers: int default=4 - Uploads running at the same time
+    - max_pending: int default=2 - COGs held in memory waiting for or being uploaded
+  '''
+
+  transfer_config = TransferConfig(multipart_threshold=16 * 1024 * 1024, multipart_chunksize=16 * 1024 * 1024,
+                                   max_concurrency=8)
+
+  def __init__(self, s3, bucket: str, max_workers: int = 4, max_pending: int = 2):
+    self._s3 = s3
+    self._bucket = bucket
+    self._executor = ThreadPoolExecutor(max_workers=max_workers)
+    self._pending = threading.BoundedSemaphore(max_pending)
+    self._futures = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    try:
+      self.wait(raise_errors=exc_type is None)
+    finally:
+      self._executor.shutdown()
+
+  def upload_cog(self, input_geotiff: str, key: str, add_mask: bool = True, callback: callable = None):
+    '''
+      Convert a GeoTIFF to a COG in memory and queue its upload. Blocks while `max_pending` COGs are in memory.
+      The input GeoTIFF can be removed as soon as this returns.
+
+      Parameters
+      ----------
+      - input_geotiff: str - Input GeoTIFF path
+      - key: str - S3 key
+      - add_mask: bool optional - Force output dataset creation with a mask.
+      - callback: callable optional - Called with the key once the upload completes
+    '''
+    self._pending.acquire()
+    try:
+      with stage('cog'):
+        memfile = convert_to_cog_memory(input_geotiff, add_mask=add_mask)
+    except Exception as e:
+      self._pending.release()
+      raise e
+
+    def upload():
+      try:
+        # The transfer may close the file once it is read, so the size is taken first
+        memfile.seek(0, os.SEEK_END)
+        size = memfile.tell()
+        memfile.seek(0)
+        with stage('upload'):
+          self._s3.upload_fileobj(memfile, self._bucket, key, Config=self.transfer_config)
+        add('upload', bytes_uploaded=size)
+      finally:
+        memfile.close()
+        self._pending.release()
+      if callback is not None:
+        callback(key)
+
+    self._futures.append(self._executor.submit(upload))
+
+  def upload_file(self, file: str, key: str, callback: callable = None):
+    '''
+      Queue the upload of a file. The file must be kept until the upload completes.
+    '''
+    def upload():
+      with stage('upload'):
+        self._s3.upload_file(file, self._bucket, key, Config=self.transfer_config)
+      add('upload', bytes_uploaded=os.path.getsize(file))
+      if callback is not None:
+        callback(key)
+
+    self._futures.append(self._executor.submit(upload))
+
+  def wait(self, raise_errors: bool = True):
+    '''
+      Wait for all queued uploads. Raises the first error unless `raise_errors` is False.
+    '''
+    futures, self._futures = self._futures, []
+    errors = [future.exception() for future in futures]
+    errors = [e for e in errors if e is not None]
+    if raise_errors and len(errors) > 0:
+      raise errors[0]
+
+
+class DaskScheduler():
+  '''
+    Scheduler for the block tasks of `raster_map_blocks`. Use as a context manager around a run: a local distributed
+    cluster is started on enter and closed on exit, and the task stream of every compute is saved to `report_dir` as
+    JSON (plus a dask performance report for the distributed scheduler if bokeh is installed).
+
+    Parameters
+    ----------
+    - scheduler: str default='threads' - ['threads', 'processes', 'distributed']
+    - workers: int optional - Number of workers. Defaults to the number of CPUs.
+    - memory_limit: int optional - Memory limit per worker in MB. Blocks are sized to fit in it and distributed workers
+        spill to disk and restart when they go over it.
+    - report_dir: str optional - Directory to save the task stream and performance report of the run to
+    - report_name: str default='raster_map_blocks' - Name prefix of the report files
+  '''
+
+  schedulers = ['threads', 'processes', 'distributed']
+  # Memory of a block task relative to the stack it reads
+  _block_overhead = 3
+  # Share of the worker memory limit for a block task. The rest is headroom for the worker process itself.
+  _block_memory_fraction = 0.5
+
+  def __init__(self, scheduler: str = 'threads', workers: int = None, memory_limit: int = None, 
+               report_dir: str = None, report_name: str = 'raster_map_blocks'):
+    if scheduler not in self.schedulers:
+      raise Exception(f'Unsupported scheduler {scheduler}.')
+    
+    self.scheduler = scheduler
+    self.workers = workers or os.cpu_count()
+    self.memory_limit = memory_limit
+    self._report_dir = report_dir
+    self._report_name = report_name
+    self._task_stream = []
+    self._client = None
+    self._cluster = None
+    self._performance_report = None
+    self._started = datetime.now().strftime('%Y%m%dT%H%M%S')
+
+  def __enter__(self):
+    if self.scheduler == 'distributed':
+      from dask.distributed import LocalCluster, Client
+
+      self._cluster = LocalCluster(n_workers=self.workers, threads_per_worker=1, processes=True,
+                                   memory_limit=f'{self.memory_limit}MB' if self.memory_limit else 0)
+      self._client = Client(self._cluster)
+      print(f'Dask dashboard: {self._client.dashboard_link}')
+
+      if self._report_dir is not None:
+        if importlib.util.find_spec('bokeh') is not None:
+          from dask.distributed import performance_report
+          self._performance_report = performance_report(filename=self._report_path('performance-report.html'))
+          self._performance_report.__enter__()
+        else:
+          print('bokeh is not installed. Skipping performance report...')
+
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    try:
+      if self._performance_report is not None:
+        self._performance_report.__exit__(exc_type, exc_value, traceback)
+      self.save_report()
+    finally:
+      if self._client is not None:
+        self._client.close()
+        self._cluster.close()
+      self._performance_report = self._client = self._cluster = None
+
+  def compute(self, tasks: list):
+    '''
+      Compute a list of dask.delayed tasks and record their task stream.
+    '''
+    if self.scheduler == 'distributed':
+      if self._client is None:
+        raise Exception('Distributed scheduler must be used as a context manager.')
+      
+      from dask.distributed import get_task_stream
+
+      with get_task_stream(self._client) as ts:
+        results = dask.compute(*tasks)
+      self._task_stream += [{'key': str(task['key']), 'worker': task['worker'], 
+                             'start': min(s['start'] for s in task['startstops']), 
+                             'stop': max(s['stop'] for s in task['startstops']),
+                             'startstops': [{'action': s['action'], 'start': s['start'], 'stop': s['stop']} 
+                                            for s in task['startstops']]} for task in ts.data]
+      return results
+    
+    from dask.diagnostics import Profiler
+
+    with Profiler() as profiler:
+      results = dask.compute(*tasks, scheduler=self.scheduler, num_workers=self.workers)
+    self._task_stream += [{'key': str(task.key), 'worker': task.worker_id, 'start': task.start_time, 
+                           'stop': task.end_time} for task in profiler.results]
+    return results
+
+  def block_size(self, input_files: list, block_size: int):
+    '''
+      Largest block size up to `block_size` where a block task on a stack of `input_files` fits in the memory limit.
+      Rounded down to a multiple of 16.
+    '''
+    if self.memory_limit is not None:
+      with rasterio.open(input_files[0]) as src:
+        bytes_per_pixel = len(input_files) * src.count * np.dtype(src.dtypes[0]).itemsize * self._block_overhead
+      block_budget = self.memory_limit * 1024 * 1024 * self._block_memory_fraction
+      block_size = min(block_size, int(np.sqrt(block_budget / bytes_per_pixel)))
+
+    return max(16, block_size // 16 * 16)
+
+  def save_report(self):
+    '''
+      Save the task stream recorded so far to `report_dir` and print a summary.
+    '''
+    if self._report_dir is None or len(self._task_stream) == 0:
+      return
+
+    task_stream, self._task_stream = self._task_stream, []
+    busy = sum(task['stop'] - task['start'] for task in task_stream)
+    wall = max(task['stop'] for task in task_stream) - min(task['start'] for task in task_stream)
+    report = {'scheduler': self.scheduler, 'workers': self.workers, 'memory_limit': self.memory_limit, 
+              'tasks': len(task_stream), 'wall_time': wall, 'busy_time': busy, 
+              'utilization': busy / (wall * self.workers) if wall > 0 else 0, 'task_stream': task_stream}
+    
+    path = self._report_path('task-stream.json')
+    with open(path, 'w') as f:
+      json.dump(report, f, default=str)
+    print(f'Saved task stream of {len(task_stream)} tasks to {path}. Utilization: {report["utilization"]:.0%}')
+
+  def _report_path(self, suffix: str):
+    os.makedirs(self._report_dir, exist_ok=True)
+    return os.path.join(self._report_dir, f'{self._report_name}-{self._started}-{suffix}')
+
 
 def raster_map_blocks(input_files: list, output_files: list, block_size: int, fn_map_blocks: callable, 
-                      no_data_value = np.nan, last_band_mask: tuple = None):
+                      no_data_value = np.nan, last_band_mask: tuple = None, scheduler: DaskScheduler = None,
+                      progress = None):
   '''
-    Convert a stack of raster GeoTIFFs to Xarray Dataset and apply a map_blocks function. Then convert back to GeoTIFF files
-    for output.
+    Apply a map_blocks function along a stack of raster GeoTIFFs and write the results to GeoTIFF files.
+    The stack is built lazily: each (index, band, y, x) block is read from windows of the input files, passed to the
+    function and written straight to the same window of the output files. Nothing but the outputs is written to disk.
 
     Parameters
     ----------
     - input_files: list - List of input file paths
     - output_files: list - List of output file paths
-    - block_size: int - Block size of x & y dimension. Used to optimize for memory
+    - block_size: int - Block size of x & y dimension. Used to optimize for memory. Rounded down to a multiple of 16
+        so blocks line up with the output tiles.
     - fn_map_blocks: function - Function to apply map_blocks. Signature is (block, dim) -> (block)
     - no_data_value: optional - If the no data value to impute is other than NaN
     - last_band_mask: tuple optional - If the last band is a mask band then it may need to be re-computed after map_blocks is run.
         Pass a tuple of `(value where no_data_value, value where no no_data_value)`. Eg for rgba int dtype it can be (0, 255); for 
         single band float it can be (False, True)
+    - scheduler: DaskScheduler optional - Scheduler of the block tasks. Defaults to threads on all CPUs. The block size
+        is reduced to fit in its memory limit.
+    - progress: BlockProgress optional - Checkpoint of the written blocks. Blocks written by an interrupted run are
+        skipped and its outputs are kept.
   '''
-  with TemporaryDirectory() as tdir:
-    print('Stacking tifs in Xarray...')
-    stack_paths = []
-    for i, file in tqdm(enumerate(input_files), total=len(input_files)):
-      ds = xr.open_dataset(file, engine='rasterio', decode_coords='all', mask_and_scale=False).drop_vars('spatial_ref')
-      ds = ds.chunk({'band': 1, 'x': block_size, 'y': block_size})
-      zarr_file_temp = os.path.join(tdir, f'{i}.zarr')
-      ds.to_zarr(zarr_file_temp, mode='w', encoding={"band_data": {"fill_value": no_data_value}})
-      stack_paths.append(zarr_file_temp)
-
-    print('\nWriting to stacked zarr...')
-    stack = xr.concat([xr.open_zarr(file, mask_and_scale=False) for file in stack_paths], dim='index')
-    stack = stack.chunk({'index': len(input_files), 'band': 1, 'x': block_size, 'y': block_size})
-    zarr_file_stacked = os.path.join(tdir, 'stacked.zarr')
-    stack.to_zarr(zarr_file_stacked, mode='w', encoding={"band_data": {"fill_value": no_data_value}})
-
-    for file in stack_paths:
-      shutil.rmtree(file)
-
-    stack = xr.open_zarr(zarr_file_stacked, mask_and_scale=False)
-    stack['band_data'] = stack['band_data'].map_blocks(fn_map_blocks, kwargs={'dim': 'index'}, 
-                                                       template=stack['band_data'])
-
-    zarr_file_filled = os.path.join(tdir, 'filled.zarr')
-    print('\nApplying map_blocks on stacked zarr...')
-    stack.to_zarr(zarr_file_filled, mode='w')
-    shutil.rmtree(zarr_file_stacked)
-    
-    stack = xr.open_zarr(zarr_file_filled, mask_and_scale=False)['band_data']
+  scheduler = scheduler or DaskScheduler()
+  block_size = scheduler.block_size(input_files, block_size)
 
-    print('\nWriting to tifs...')
-    for index in tqdm(stack['index'].values):
-      with rasterio.open(input_files[index], mode='r') as src:
-        bands = stack.isel(index=index).values
-        if last_band_mask is not None:
-          num_bands = bands.shape[0] - 1
-          mask = np.all(bands[0:num_bands] == no_data_value, axis=0)
-          bands[num_bands] = np.where(mask, last_band_mask[0], last_band_mask[1])
+  with rasterio.open(input_files[0], mode='r') as src:
+    windows = [window for _, window in block_windows(src.width, src.height, block_size)]
 
+  completed = progress.start(block_size, output_files) if progress is not None else set()
+
+  # Empty tiled outputs which are filled in block by block
+  if len(completed) == 0:
+    for input_file, output_file in zip(input_files, output_files):
+      with rasterio.open(input_file, mode='r') as src:
         new_meta = src.meta.copy()
+        new_meta.update(tiled=True, blockxsize=block_size, blockysize=block_size, sparse_ok=True)
+        with rasterio.open(output_file, 'w', **new_meta):
+          pass
+
+  remaining = [i for i in range(len(windows)) if i not in completed]
+  tasks = [dask.delayed(_map_block)(input_files, windows[i], fn_map_blocks, no_data_value, last_band_mask) 
+           for i in remaining]
+  batch_size = scheduler.workers
+
+  print(f'Applying map_blocks on a stack of {len(input_files)} tifs in {len(windows)} blocks of {block_size}...')
+  with tqdm(total=len(windows), initial=len(completed)) as progress_bar:
+    for i in range(0, len(tasks), batch_size):
+      with stage('compute'):
+        blocks = scheduler.compute(tasks[i:i + batch_size])
+      for index, (bands, timings) in zip(remaining[i:i + batch_size], blocks):
+        add('stack', wall_time=timings['stack'], calls=1)
+        add('map_blocks', wall_time=timings['map_blocks'], calls=1, blocks=1)
+        with stage('write'):
+          for band_index, output_file in enumerate(output_files):
+            with rasterio.open(output_file, mode='r+') as dst:
+              dst.write(bands[band_index], window=windows[index])
+        progress_bar.update(1)
 
-        with rasterio.open(output_files[index], 'w', **new_meta) as dst:
-          dst.write(bands)
+      if progress is not None:
+        progress.add(remaining[i:i + batch_size])
 
+      del blocks
       gc.collect()
+
+def _map_block(input_files: list, window: Window, fn_map_blocks: callable, no_data_value, last_band_mask: tuple):
+  '''
+    Read a window of every input file as a (index, band, y, x) block and apply the map_blocks function to it.
+    Returns the block and the seconds spent as {'stack': s, 'map_blocks': s}.
+  '''
+  started = time.perf_counter()
+  stack = []
+  for file in input_files:
+    with rasterio.open(file, mode='r') as src:
+      stack.append(src.read(window=window))
+  stack = np.stack(stack)
+  stacked = time.perf_counter()
+
+  block = xr.DataArray(stack, dims=('index', 'band', 'y', 'x'), 
+                       coords={'index': np.arange(stack.shape[0]), 'band': np.arange(1, stack.shape[1] + 1)})
+  bands = np.asarray(fn_map_blocks(block, dim='index')).astype(stack.dtype, copy=False)
+
+  if last_band_mask is not None:
+    num_bands = bands.shape[1] - 1
+    mask = np.all(bands[:, 0:num_bands] == no_data_value, axis=1)
+    bands[:, num_bands] = np.where(mask, last_band_mask[0], last_band_mask[1])
+
+  return bands, {'stack': stacked - started, 'map_blocks': time.perf_counter() - stacked}
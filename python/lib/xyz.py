@@ -0,0 +1,107 @@
+import warnings
+import rasterio
+import numpy as np
+import morecantile
+from rasterio import MemoryFile
+from rasterio.warp import reproject, Resampling, transform_bounds
+from rasterio.transform import from_bounds
+from rasterio.errors import NotGeoreferencedWarning
+
+
+# Color ramp of the treecover layer as (value, RGB) stops interpolated linearly. NaN is transparent.
+# It is also the style of the layer in the API so pre-rendered tiles look the same as the styled COGs.
+TREECOVER_RAMP = [(0, [20, 90, 50]), (1, [250, 0, 0])]
+# Gamma of the RGBA layer
+RGBA_GAMMA = 1.1
+
+TILE_SIZE = 256
+FORMATS = {'png': 'PNG', 'webp': 'WEBP'}
+
+_tms = morecantile.tms.get('WebMercatorQuad')
+
+
+def colorize(level: str, data: np.ndarray):
+  '''
+    Render the bands of a level as RGBA uint8 of shape (4, y, x) like the styles of the layers.
+    - treecover: (1, y, x) float with NaN for no data, colored with TREECOVER_RAMP
+    - rgba: (4, y, x) uint8 with the gamma applied to the RGB bands
+  '''
+  if level == 'treecover':
+    values = data[0]
+    stops = np.array([value for value, _ in TREECOVER_RAMP], np.float32)
+    colors = np.array([color for _, color in TREECOVER_RAMP], np.float32)
+    clipped = np.clip(np.nan_to_num(values, nan=stops[0]), stops[0], stops[-1])
+    rgba = np.empty((4, *values.shape), np.uint8)
+    for band in range(3):
+      rgba[band] = np.rint(np.interp(clipped, stops, colors[:, band]))
+    rgba[3] = np.where(np.isnan(values), 0, 255)
+    return rgba
+
+  if level == 'rgba':
+    rgba = data.copy()
+    lut = np.rint(255 * (np.arange(256) / 255) ** (1 / RGBA_GAMMA)).astype(np.uint8)
+    rgba[:3] = lut[data[:3]]
+    return rgba
+
+  raise Exception(f'Unsupported level {level}.')
+
+def render_tiles(tif: str, level: str, zooms: tuple, fmt: str = 'png'):
+  '''
+    Render a GeoTIFF of a level as XYZ tiles of the WebMercator grid. Each zoom is rendered from the overview closest
+    to its resolution, read once. Tiles without any visible pixel are skipped.
+    Yields (z, x, y, encoded tile).
+
+    Parameters
+    ----------
+    - tif: str - GeoTIFF (eg COG with overviews) of the level
+    - level: str - ['rgba', 'treecover']
+    - zooms: tuple - (min zoom, max zoom)
+    - fmt: str default='png' - ['png', 'webp']
+  '''
+  if fmt not in FORMATS:
+    raise Exception(f'Unsupported tile format {fmt}.')
+
+  with rasterio.open(tif) as src:
+    bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+    overviews = src.overviews(1)
+    res = src.res[0]
+
+  for zoom in range(zooms[0], zooms[1] + 1):
+    # Largest overview which is still at least as fine as the tiles
+    tile_res = 360 / 2 ** zoom / TILE_SIZE
+    overview_level = None
+    for i, factor in enumerate(overviews):
+      if res * factor <= tile_res:
+        overview_level = i
+
+    with rasterio.open(tif, overview_level=overview_level) as src:
+      data = src.read()
+      src_transform = src.transform
+      src_crs = src.crs
+      nodata = np.nan if data.dtype.kind == 'f' else None
+
+    for tile in _tms.tiles(*bounds, [zoom]):
+      xy = _tms.xy_bounds(tile)
+      tile_data = np.full((data.shape[0], TILE_SIZE, TILE_SIZE), np.nan if nodata is not None else 0, data.dtype)
+      reproject(data, tile_data, src_transform=src_transform, src_crs=src_crs, src_nodata=nodata,
+                dst_transform=from_bounds(*xy, TILE_SIZE, TILE_SIZE), dst_crs='EPSG:3857', dst_nodata=nodata,
+                resampling=Resampling.nearest)
+
+      rgba = colorize(level, tile_data)
+      if not rgba[3].any():
+        continue
+
+      yield tile.z, tile.x, tile.y, encode(rgba, fmt)
+
+def encode(rgba: np.ndarray, fmt: str = 'png'):
+  '''
+    Encode an RGBA uint8 tile of shape (4, y, x) as an image.
+  '''
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore', NotGeoreferencedWarning)
+    with MemoryFile() as memfile:
+      options = {'lossless': True} if fmt == 'webp' else {}
+      with memfile.open(driver=FORMATS[fmt], width=rgba.shape[2], height=rgba.shape[1], count=4, dtype='uint8',
+                        **options) as dst:
+        dst.write(rgba)
+      return memfile.read()
\ No newline at end of file
@@ -0,0 +1,143 @@
+import os
+import re
+import pytest
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lib.downloader import Downloader
+
+
+class RangeServer():
+  '''
+    Local HTTP stand-in for a file server. Serves `data` with Range & If-Range support (unless `ranges` is False).
+    The first response to each Range header of `drop_at` (None for the whole file) drops the connection after
+    `drop_after` bytes, as a flaky connection would. The file is replaced by `changed` (with a new ETag) once a
+    connection is dropped.
+    The Range header of every request is recorded in `requests`.
+  '''
+  def __init__(self, data: bytes, ranges: bool = True, drop_after: int = None, drop_at: tuple = (None,), 
+               changed: bytes = None):
+    self.data = data
+    self.etag = '"1"'
+    self.ranges = ranges
+    self.drop_after = drop_after
+    self.drop_at = set(drop_at)
+    self.changed = changed
+    self.requests = []
+    self._lock = threading.Lock()
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def do_GET(self):
+        with server._lock:
+          data, etag = server.data, server.etag
+          server.requests.append(self.headers.get('Range'))
+
+        start, end = 0, len(data) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        partial = server.ranges and match is not None and self.headers.get('If-Range', etag) == etag
+        if partial:
+          start = int(match.group(1))
+          end = int(match.group(2)) if match.group(2) else end
+
+        with server._lock:
+          drop = server.drop_after is not None and self.headers.get('Range') in server.drop_at
+          server.drop_at.discard(self.headers.get('Range'))
+
+        body = data[start:end + 1]
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        if server.ranges:
+          self.send_header('Accept-Ranges', 'bytes')
+        if partial:
+          self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.end_headers()
+
+        if drop:
+          self.wfile.write(body[:server.drop_after])
+          self.wfile.flush()
+          self.close_connection = True
+          with server._lock:
+            if server.changed is not None:
+              server.data, server.etag, server.changed = server.changed, '"2"', None
+        else:
+          self.wfile.write(body)
+
+      def log_message(self, *args):
+        pass
+
+    self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self.url = f'http://127.0.0.1:{self._server.server_port}/image.tif'
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+  def close(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+
+@pytest.fixture
+def data():
+  return os.urandom(512 * 1024)
+
+@pytest.fixture
+def serve():
+  servers = []
+  def serve(*args, **kwargs):
+    servers.append(RangeServer(*args, **kwargs))
+    return servers[-1]
+  yield serve
+  for server in servers:
+    server.close()
+
+def downloader(**kwargs):
+  return Downloader(chunk_size=16 * 1024, backoff=0, **kwargs)
+
+
+def test_download_resumes_dropped_connection(tmp_path, data, serve):
+  server = serve(data, drop_after=100 * 1024)
+  filename = tmp_path / 'image.tif'
+
+  size = downloader(segments=1).download(server.url, str(filename))
+
+  assert size == len(data)
+  assert filename.read_bytes() == data
+  assert not os.path.exists(f'{filename}.part')
+  # Resumed from the bytes written before the connection dropped
+  assert len(server.requests) == 2
+  assert 0 < int(re.match(r'bytes=(\d+)-$', server.requests[1]).group(1)) <= 100 * 1024
+
+def test_download_segments_resume_on_their_own(tmp_path, data, serve):
+  # Every segment drops its first connection half way
+  segments = [f'bytes={i * 128 * 1024}-{(i + 1) * 128 * 1024 - 1}' for i in range(4)]
+  server = serve(data, drop_after=64 * 1024, drop_at=segments)
+  filename = tmp_path / 'image.tif'
+
+  downloader(segments=4, segment_size=128 * 1024).download(server.url, str(filename))
+
+  assert filename.read_bytes() == data
+  resumed = [f'bytes={i * 128 * 1024 + 64 * 1024}-{(i + 1) * 128 * 1024 - 1}' for i in range(4)]
+  # The first request only reads the size
+  assert sorted(server.requests[1:]) == sorted(segments + resumed)
+
+def test_download_restarts_without_ranges(tmp_path, data, serve):
+  server = serve(data, ranges=False, drop_after=100 * 1024)
+  filename = tmp_path / 'image.tif'
+
+  downloader(segments=4, segment_size=128 * 1024).download(server.url, str(filename))
+
+  assert filename.read_bytes() == data
+  assert server.requests == [None, None]
+
+def test_download_restarts_if_file_changed(tmp_path, data, serve):
+  # The file changes after the first connection drops so the resumed request (If-Range) gets the whole new file
+  changed = os.urandom(300 * 1024)
+  server = serve(data, drop_after=100 * 1024, changed=changed)
+  filename = tmp_path / 'image.tif'
+
+  downloader(segments=1).download(server.url, str(filename))
+
+  assert filename.read_bytes() == changed
+  assert len(server.requests) == 2 and server.requests[1] is not None
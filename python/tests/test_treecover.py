@@ -0,0 +1,132 @@
+import pytest
+import numpy as np
+import xarray as xr
+
+from lib.treecover import treecover_series, treecover_update
+
+
+NDVI_DIFF_CUT_TREES = 0.25
+NDVI_TREE_LOWER_BOUND = 0.7
+
+
+def xarray_treecover(ndvi: np.ndarray, ndvi_diff_cut_trees: float, ndvi_tree_lower_bound: float):
+  '''
+    The xarray closure `ndvi_to_treecover` which computed the treecover before the fused kernel, applied to a block as
+    `raster_map_blocks` did (an (index, band, y, x) block cast back to the dtype of the stack).
+  '''
+  def ndvi_to_treecover(block, dim):
+    # impute missing values with forward and backfill and clip outliers to known NDVI values = (-1, 1)
+    block = block.ffill(dim=dim).bfill(dim=dim).clip(max=1, min=-1)
+    mask = block.notnull()
+    # take the rolling mean (3 periods) to smoothen for seasonal variances
+    block = block.rolling({f'{dim}': 3}, min_periods=1).mean()
+    # if the difference in NDVI is more than a known value than it usually indicates that tree has been cut
+    # clip lower bounds to a known NDVI value for trees
+    block = (block < (block.max(dim=dim) - ndvi_diff_cut_trees).clip(min=ndvi_tree_lower_bound))
+    # mark all tree loss for all future time points unless re-growth detected for 3 periods
+    forestloss = block.cumsum(dim=dim)
+    regrowth = (forestloss.rolling({f'{dim}': 3}).std() == 0)
+    forestloss = forestloss.where(~regrowth)
+    block = xr.where(forestloss > 0, 1, 0)
+    block = xr.where(mask, block, np.nan)
+
+    return block
+
+  stack = ndvi.reshape(ndvi.shape[0], 1, 1, -1)
+  block = xr.DataArray(stack, dims=('index', 'band', 'y', 'x'),
+                       coords={'index': np.arange(stack.shape[0]), 'band': np.arange(1, stack.shape[1] + 1)})
+  return np.asarray(ndvi_to_treecover(block, dim='index')).astype(stack.dtype).reshape(ndvi.shape)
+
+def xarray_max_ndvi(ndvi: np.ndarray):
+  '''
+    Max of the filled, clipped & smoothened NDVI of `ndvi_to_treecover`, which the tree loss threshold is computed from.
+  '''
+  block = xr.DataArray(ndvi, dims=('index', 'pixel'))
+  block = block.ffill(dim='index').bfill(dim='index').clip(max=1, min=-1).rolling(index=3, min_periods=1).mean()
+  return np.asarray(block.max(dim='index'))
+
+def synthetic_ndvi(length: int, n_pixels: int = 4096, seed: int = 0):
+  '''
+    NDVI stack of shape (time, pixels) of forest with tree loss, re-growth, seasonal noise, gaps (NaN), outliers
+    outside (-1, 1), pixels which are never valid and pixels which are only valid from a later interval.
+  '''
+  rng = np.random.default_rng(seed)
+  ndvi = rng.uniform(0.6, 0.95, n_pixels) + rng.normal(0, 0.05, (length, n_pixels))
+
+  # Tree loss from a random interval, re-growing for some of the pixels
+  cut = rng.random(n_pixels) < 0.3
+  cut_at = rng.integers(0, length, n_pixels)
+  regrow_at = cut_at + rng.integers(1, 4, n_pixels)
+  t = np.arange(length)[:, None]
+  loss = cut & (t >= cut_at) & ((t < regrow_at) | (rng.random(n_pixels) < 0.5))
+  ndvi = np.where(loss, rng.uniform(0.05, 0.5, (length, n_pixels)), ndvi)
+
+  outliers = rng.random((length, n_pixels)) < 0.02
+  ndvi = np.where(outliers, rng.choice([-3.0, -1.2, 1.1, 2.5], (length, n_pixels)), ndvi)
+  ndvi[rng.random((length, n_pixels)) < 0.25] = np.nan
+  ndvi[:, rng.random(n_pixels) < 0.05] = np.nan
+  late = rng.random(n_pixels) < 0.05
+  ndvi[:, late] = np.where(t < rng.integers(1, length, n_pixels)[late], np.nan, ndvi[:, late])
+
+  return ndvi.astype(np.float32)
+
+
+@pytest.mark.parametrize('length', [3, 4, 7, 12])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_treecover_series_matches_xarray(length, seed):
+  ndvi = synthetic_ndvi(length, seed=seed)
+
+  treecover, state = treecover_series(ndvi, NDVI_DIFF_CUT_TREES, NDVI_TREE_LOWER_BOUND)
+  expected = xarray_treecover(ndvi, NDVI_DIFF_CUT_TREES, NDVI_TREE_LOWER_BOUND)
+
+  assert treecover.dtype == expected.dtype
+  assert np.isnan(expected).any() and (expected == 1).any() and (expected == 0).any()
+  np.testing.assert_array_equal(treecover, expected)
+
+  # The rolling mean rarely flips the 0/1 treecover by its last bits, so its max (in the state) is compared too
+  np.testing.assert_array_equal(state[4], xarray_max_ndvi(ndvi))
+
+@pytest.mark.parametrize('length', [3, 6, 10])
+@pytest.mark.parametrize('added', [1, 2])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_treecover_update_matches_rebuild(length, added, seed):
+  ndvi = synthetic_ndvi(length + added, seed=seed)
+  rebuilt, rebuilt_state = treecover_series(ndvi, NDVI_DIFF_CUT_TREES, NDVI_TREE_LOWER_BOUND)
+
+  _, state = treecover_series(ndvi[:length], NDVI_DIFF_CUT_TREES, NDVI_TREE_LOWER_BOUND)
+  treecover, state, dirty, new = treecover_update(ndvi[length:], state, length, NDVI_DIFF_CUT_TREES,
+                                                  NDVI_TREE_LOWER_BOUND)
+
+  # Pixels which change their history are recomputed from the whole stack, the rest are continued from the state
+  changed = dirty | new
+  assert changed.any() and not changed.all()
+  np.testing.assert_array_equal(treecover[:, ~changed], rebuilt[length:, ~changed])
+  np.testing.assert_array_equal(state[:, ~changed], rebuilt_state[:, ~changed])
+
+  history, history_state = treecover_series(ndvi[:, changed], NDVI_DIFF_CUT_TREES, NDVI_TREE_LOWER_BOUND)
+  np.testing.assert_array_equal(history, rebuilt[:, changed])
+  np.testing.assert_array_equal(history_state, rebuilt_state[:, changed])
+
+def test_treecover_update_continues_updates():
+  ndvi = synthetic_ndvi(9, seed=3)
+  rebuilt, rebuilt_state = treecover_series(ndvi, NDVI_DIFF_CUT_TREES, NDVI_TREE_LOWER_BOUND)
+
+  treecover, state = treecover_series(ndvi[:6], NDVI_DIFF_CUT_TREES, NDVI_TREE_LOWER_BOUND)
+  for start, end in [(6, 7), (7, 9)]:
+    added, state, dirty, new = treecover_update(ndvi[start:end], state, start, NDVI_DIFF_CUT_TREES,
+                                                NDVI_TREE_LOWER_BOUND)
+    treecover = np.concatenate([treecover, added])
+
+    # The history and state of the changed pixels are recomputed before the next update, as when processing a tile
+    changed = dirty | new
+    treecover[:, changed], state[:, changed] = treecover_series(ndvi[:end, changed], NDVI_DIFF_CUT_TREES,
+                                                                NDVI_TREE_LOWER_BOUND)
+
+  np.testing.assert_array_equal(treecover, rebuilt)
+  np.testing.assert_array_equal(state, rebuilt_state)
+
+def test_treecover_update_needs_3_intervals():
+  ndvi = synthetic_ndvi(3)
+  _, state = treecover_series(ndvi[:2], NDVI_DIFF_CUT_TREES, NDVI_TREE_LOWER_BOUND)
+  with pytest.raises(Exception):
+    treecover_update(ndvi[2:], state, 2, NDVI_DIFF_CUT_TREES, NDVI_TREE_LOWER_BOUND)
@@ -0,0 +1,43 @@
+from dotenv import load_dotenv
+load_dotenv(override=True)
+
+from argparse import ArgumentParser
+
+from ..lib.job_queue import JobQueue
+
+
+parser = ArgumentParser(description='Add jobs for GLAD ARD Tile IDs to the job queue. Tiles are ingested and then '
+                                    'their levels are processed. Run job_worker on the worker nodes to run them.')
+parser.add_argument('tile_ids', nargs='*', help='Tile IDs')
+parser.add_argument('--bbox', type=float, nargs=4, metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+                    help='Add the tiles intersecting a bbox')
+parser.add_argument('--levels', nargs='+', choices=['rgba', 'treecover', 'all'], default=['all'],
+                    help='Levels to process after ingestion (default: all)')
+parser.add_argument('--delete', action='store_true', help='Delete the tiles instead')
+parser.add_argument('--incremental', action='store_true', help='Only process intervals added since the last run')
+parser.add_argument('--parallel', action='store_true', help='Ingest intervals in parallel')
+parser.add_argument('--reject-borderline', action='store_true', 
+                    help='Reject images just below the valid pixels threshold from a sample of their qf band')
+parser.add_argument('--xyz', action='store_true', help='Also render the XYZ tiles of the processed images')
+parser.add_argument('--scheduler', help='Dask scheduler for the block tasks')
+parser.add_argument('--priority', type=int, default=0, help='Higher priority jobs are run first')
+args = parser.parse_args()
+
+tile_ids = list(args.tile_ids)
+if args.bbox is not None:
+  from ..lib.glad import GLAD
+  tile_ids += GLAD().get_tile_index().query_bbox(args.bbox)
+
+queue = JobQueue()
+for tile_id in sorted(set(tile_ids)):
+  if args.delete:
+    jobs = [queue.enqueue('delete', tile_id, priority=args.priority)]
+  else:
+    jobs = queue.enqueue_tile(tile_id, levels=args.levels, 
+                              ingest_params={'parallel': args.parallel, 'reject_borderline': args.reject_borderline},
+                              process_params={'incremental': args.incremental, 'scheduler': args.scheduler, 
+                                              'xyz': args.xyz},
+                              priority=args.priority)
+  print(f'{tile_id} - jobs ' + ', '.join(f'{job.id} ({" ".join(filter(None, [job.kind, job.level]))})' for job in jobs))
+
+print(f'Jobs - {queue.counts()}')
\ No newline at end of file
@@ -4,21 +4,38 @@ load_dotenv(override=True)
 from tqdm import tqdm
 from argparse import ArgumentParser
 
-from ..lib.glad import GLAD
-
 
 parser = ArgumentParser(description='Ingest valid images for GLAD ARD Tile ID')
 parser.add_argument('tile_id', help='Tile ID')
-args = parser.parse_args()
-tile_id = args.tile_id
+parser.add_argument('--parallel', action='store_true', help='Ingest intervals in parallel')
+parser.add_argument('--io-workers', type=int, default=4, help='Download/upload threads for parallel ingestion')
+parser.add_argument('--cpu-workers', type=int, default=2, help='Masking/COG processes for parallel ingestion')
+parser.add_argument('--memory-limit', type=int, default=4096, help='Memory budget in MB for parallel ingestion')
+parser.add_argument('--reject-borderline', action='store_true', 
+                    help='Reject images just below the valid pixels threshold from a sample of their qf band without '
+                         'downloading them to check the full band')
+
+# The ingestion worker processes import this module. They only need the masking module, not GLAD and its db.
+if __name__ == '__main__':
+  from ..lib.glad import GLAD
+
+  args = parser.parse_args()
+  tile_id = args.tile_id
 
-glad = GLAD()
+  glad = GLAD()
 
-valid_ids = glad.get_valid_ids(tile_id=tile_id)
-print(f'{len(valid_ids)} IDs found for ingestion.')
+  valid_ids = glad.get_valid_ids(tile_id=tile_id)
+  print(f'{len(valid_ids)} IDs found for ingestion.')
 
-for id in tqdm(valid_ids):
-  try:
-    glad.process_image_raw(tile_id=tile_id, interval_id=id)
-  except Exception as e:
-    print(f'Failed with error - {e}')
+  if args.parallel:
+    errors = glad.process_images_raw(tile_id=tile_id, interval_ids=valid_ids, io_workers=args.io_workers,
+                                     cpu_workers=args.cpu_workers, memory_limit=args.memory_limit,
+                                     confirm_borderline=not args.reject_borderline)
+    print(f'{len(valid_ids) - len(errors)} IDs ingested. {len(errors)} IDs failed.')
+  else:
+    with glad.deferred_index():
+      for id in tqdm(valid_ids):
+        try:
+          glad.process_image_raw(tile_id=tile_id, interval_id=id, confirm_borderline=not args.reject_borderline)
+        except Exception as e:
+          print(f'Failed with error - {e}')
@@ -0,0 +1,137 @@
+from dotenv import load_dotenv
+load_dotenv(override=True)
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import subprocess
+from threading import Thread, Event
+from argparse import ArgumentParser
+
+from ..lib.job_queue import JobQueue
+
+
+parser = ArgumentParser(description='Run jobs from the tile job queue. Run one on every worker node. Stop with '
+                                    'SIGINT/SIGTERM to finish the running jobs, a second time to requeue them.')
+parser.add_argument('--concurrency', type=int, default=1, help='Number of jobs run at once')
+parser.add_argument('--kinds', nargs='+', choices=JobQueue.kinds, help='Only run these kinds of jobs (default: all)')
+parser.add_argument('--name', default=f'{socket.gethostname()}-{os.getpid()}', help='Worker name')
+parser.add_argument('--poll', type=float, default=10, help='Seconds between polls when no job is ready')
+parser.add_argument('--lease', type=int, default=300, help='Lease of a claimed job in seconds')
+parser.add_argument('--backoff', type=int, default=60, help='Seconds before retrying a failed job, doubled per attempt')
+parser.add_argument('--heartbeat', type=int, default=60, help='Seconds between heartbeats extending the lease')
+parser.add_argument('--exit-when-empty', action='store_true', help='Exit once there are no unfinished jobs')
+args = parser.parse_args()
+
+queue = JobQueue(lease=args.lease, backoff=args.backoff)
+stopping = Event()
+terminating = Event()
+
+# Worker commands of the job kinds. Jobs run in their own process so a crash or leak only affects that job.
+commands = {'ingest': 'ingest_glad_ard_tile', 'process': 'process_glad_ard_tile', 'delete': 'delete_glad_ard_tile'}
+
+
+def command(job):
+  cmd = [sys.executable, '-m', f'{__package__}.{commands[job.kind]}', job.tile_id]
+  if job.level is not None:
+    cmd.append(job.level)
+
+  for key, value in json.loads(job.params).items():
+    flag = f'--{key.replace("_", "-")}'
+    if value is True:
+      cmd.append(flag)
+    elif value is not False and value is not None:
+      cmd += [flag, str(value)]
+
+  return cmd
+
+def run(job):
+  # In its own session so a Ctrl+C of the worker doesn't interrupt the job
+  process = subprocess.Popen(command(job), start_new_session=True)
+  try:
+    last_heartbeat = time.monotonic()
+    while process.poll() is None:
+      terminating.wait(1)
+      if terminating.is_set():
+        process.terminate()
+        process.wait()
+        queue.release(job)
+        print(f'Job {job.id} requeued.')
+        return
+
+      if time.monotonic() - last_heartbeat >= args.heartbeat:
+        last_heartbeat = time.monotonic()
+        if not queue.heartbeat(job):
+          print(f'Lost the lease of job {job.id}. Stopping it...')
+          process.terminate()
+          process.wait()
+          return
+
+    if process.returncode == 0:
+      queue.complete(job)
+      print(f'Job {job.id} done.')
+    else:
+      queue.fail(job, error=f'Exited with code {process.returncode}.')
+      print(f'Job {job.id} failed with exit code {process.returncode}.')
+  finally:
+    # The job is not left running if the worker stops tracking it (eg the db is unavailable for a heartbeat)
+    if process.poll() is None:
+      process.terminate()
+      process.wait()
+
+def work(name: str):
+  while not stopping.is_set():
+    try:
+      queue.requeue_expired()
+      job = queue.claim(name, kinds=args.kinds)
+      counts = queue.counts(kinds=args.kinds) if job is None else None
+    except Exception as e:
+      # eg the db is unavailable
+      print(f'[{name}] Could not claim a job - {e}')
+      stopping.wait(args.poll)
+      continue
+
+    if job is None:
+      if args.exit_when_empty and sum(counts.get(status, 0) for status in ['waiting', 'queued', 'running']) == 0:
+        return
+      stopping.wait(args.poll)
+      continue
+
+    print(f'[{name}] Running job {job.id} - {job.kind} {job.tile_id} {job.level or ""} '
+          f'(attempt {job.attempts}/{job.max_attempts})...')
+    try:
+      run(job)
+    except Exception as e:
+      print(f'Job {job.id} failed with error - {e}')
+      try:
+        queue.fail(job, error=str(e))
+      except Exception as e:
+        # eg the db is unavailable. The job is requeued once its lease expires.
+        print(f'[{name}] Could not record the failure of job {job.id} - {e}')
+
+def stop(signum, frame):
+  if stopping.is_set():
+    print('Stopping and requeueing running jobs...')
+    terminating.set()
+  else:
+    print('Stopping after the running jobs...')
+    stopping.set()
+
+
+signal.signal(signal.SIGINT, stop)
+signal.signal(signal.SIGTERM, stop)
+
+print(f'Worker {args.name} running {args.concurrency} jobs at once. Jobs - {queue.counts()}')
+threads = [Thread(target=work, args=(f'{args.name}-{i}',), daemon=True) for i in range(args.concurrency)]
+for thread in threads:
+  thread.start()
+
+# Wait in short intervals so signals are handled
+for thread in threads:
+  while thread.is_alive():
+    thread.join(timeout=1)
+
+print(f'Worker {args.name} stopped. Jobs - {queue.counts()}')
\ No newline at end of file
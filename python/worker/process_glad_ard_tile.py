@@ -4,20 +4,37 @@ load_dotenv(override=True)
 from argparse import ArgumentParser
 
 from ..lib.glad import GLAD
+from ..lib.util import DaskScheduler
 
 
-parser = ArgumentParser(description='Process RGBA for GLAD ARD Tile ID')
+parser = ArgumentParser(description='Process derived levels for GLAD ARD Tile ID')
 parser.add_argument('tile_id', help='Tile ID')
-parser.add_argument('level', help='Level', choices=['rgba', 'treecover'])
-args = parser.parse_args()
-tile_id = args.tile_id
-level = args.level
+parser.add_argument('level', help='Level (all processes every level reading each raw image once)', 
+                    choices=['rgba', 'treecover', 'all'])
+parser.add_argument('--incremental', action='store_true', help='Only process intervals added since the last run')
+parser.add_argument('--xyz', action='store_true', help='Also render the XYZ tiles of the new and changed images')
+parser.add_argument('--scheduler', help='Dask scheduler for the block tasks', choices=DaskScheduler.schedulers, 
+                    default='threads')
+parser.add_argument('--workers', help='Number of dask workers (default: number of CPUs)', type=int)
+parser.add_argument('--memory-limit', help='Memory limit per dask worker in MB', type=int)
+parser.add_argument('--report-dir', help='Directory to save the task stream and performance report of the run')
 
-glad = GLAD()
+# The dask worker processes of the processes and distributed schedulers import this module
+if __name__ == '__main__':
+  args = parser.parse_args()
+  tile_id = args.tile_id
+  level = args.level
+  incremental = args.incremental
 
-if level == 'rgba':
-  glad.process_images_rgba(tile_id=tile_id)
-elif level == 'treecover':
-  glad.process_images_treecover(tile_id=tile_id)
-else:
-  raise Exception(f'Invalid level {level}.')
+  glad = GLAD()
+
+  with DaskScheduler(args.scheduler, workers=args.workers, memory_limit=args.memory_limit, report_dir=args.report_dir,
+                     report_name=f'{tile_id}-{level}') as scheduler:
+    if level == 'rgba':
+      glad.process_images_rgba(tile_id=tile_id, incremental=incremental, scheduler=scheduler, xyz=args.xyz)
+    elif level == 'treecover':
+      glad.process_images_treecover(tile_id=tile_id, incremental=incremental, scheduler=scheduler, xyz=args.xyz)
+    elif level == 'all':
+      glad.process_images(tile_id=tile_id, incremental=incremental, scheduler=scheduler, xyz=args.xyz)
+    else:
+      raise Exception(f'Invalid level {level}.')
@@ -0,0 +1,16 @@
+from dotenv import load_dotenv
+load_dotenv(override=True)
+
+from argparse import ArgumentParser
+
+from ..lib.glad import GLAD
+
+
+parser = ArgumentParser(description='Rebuild the S3 manifest from a listing of S3')
+parser.add_argument('tile_id', nargs='?', default=None, help='Tile ID. Rebuilds all tiles and the global index if not provided.')
+args = parser.parse_args()
+tile_id = args.tile_id
+
+glad = GLAD()
+
+glad.rebuild_manifest(tile_id=tile_id)
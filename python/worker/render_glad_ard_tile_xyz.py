@@ -0,0 +1,20 @@
+from dotenv import load_dotenv
+load_dotenv(override=True)
+
+from argparse import ArgumentParser
+
+from ..lib.glad import GLAD
+
+
+parser = ArgumentParser(description='Render the XYZ tiles of the images of GLAD ARD Tile ID which changed since they '
+                                    'were last rendered')
+parser.add_argument('tile_id', help='Tile ID')
+parser.add_argument('level', help='Level', choices=['rgba', 'treecover', 'all'])
+parser.add_argument('--zooms', type=int, nargs=2, metavar=('MIN', 'MAX'), help='Zoom range (default: XYZ_ZOOMS)')
+parser.add_argument('--format', choices=['png', 'webp'], help='Tile format (default: XYZ_FORMAT)')
+args = parser.parse_args()
+
+glad = GLAD()
+
+glad.render_images_xyz(args.tile_id, levels=None if args.level == 'all' else [args.level], zooms=args.zooms, 
+                       fmt=args.format)
\ No newline at end of file